@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_chainstream
+# compares the ways a node can send its whole blockchain to a peer that has
+# none of it: one FULL_BLOCKCHAIN message, GET_BLOCKS_FROM batches, and a
+# stream of chunks from chainstream compressed with each codec. both ends run
+# in one process over a blockchain kept in a block store on disk, so the
+# blockchain itself takes no memory and what is measured is the peak memory
+# the transfer needs, sampled from /proc as it runs, along with its
+# throughput and the bytes it puts on the wire. each mode runs in its own
+# process
+
+# usage: bench_chainstream.py [-n BLOCKS] [--txs-per-block N]
+#                             [--mode {full,batches,stream-zlib,stream-none}]
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from block import Block
+from blockchain import Blockchain
+from blockchainmsg import BlockchainMessage
+from blockstore import BlockStore
+import chainstream
+from transaction import Transaction
+import wirecodec
+
+MODES = ("full", "batches", "stream-zlib", "stream-none")
+MAGIC_NUM = 7
+MINER = "127.0.0.1:10000"
+# blocks per GET_BLOCKS_FROM batch, as BlockchainNode.MAX_BLOCKS_PER_BATCH
+BATCH_BLOCKS = 500
+
+# samples the anonymous memory of this process in the background, the block
+# stores are mapped files which aren't counted
+class MemorySampler(threading.Thread):
+
+    INTERVAL = 0.005
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.baseline = anon_bytes()
+        self.peak = self.baseline
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            self.peak = max(self.peak, anon_bytes())
+            time.sleep(self.INTERVAL)
+
+    def stop(self):
+        self.stopped = True
+        self.join()
+        self.peak = max(self.peak, anon_bytes())
+
+# reads the anonymous resident memory of this process
+# returns:
+#   -the bytes of anonymous memory resident
+def anon_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+# builds the blockchain to be sent in a block store
+# params:
+#   -datadir: the directory to keep it in
+#   -length: the number of blocks
+#   -txs_per_block: the transactions carried by each block after the first
+def build_chain(datadir, length, txs_per_block):
+    store = BlockStore(datadir, BlockStore.FSYNC_NEVER)
+    prev_hash = 0
+    batch = []
+    for i in xrange(length):
+        txs = None
+        if i > 0 and txs_per_block > 0:
+            txs = [Transaction("wallet %d" % (j % 50), "payment %d of block %d" % \
+                (j, i), j % 20) for j in range(txs_per_block)]
+        block = Block(i, prev_hash, MAGIC_NUM, MINER, transactions = txs)
+        prev_hash = block.hash
+        batch.append(block)
+        if len(batch) == 1000:
+            store.extend(batch)
+            batch = []
+    store.extend(batch)
+    store.close()
+
+# sends the sender's blockchain to the receiver in one mode
+# params:
+#   -mode: one of MODES
+#   -sender: the sending Blockchain
+#   -receiver: the receiving Blockchain
+# returns:
+#   -(bytes on the wire, bytes before compression)
+def transfer(mode, sender, receiver):
+    wire_bytes = 0
+    raw_bytes = 0
+    if mode == "full":
+        payload = wirecodec.encode_message(BlockchainMessage(MINER, \
+            BlockchainMessage.FULL_BLOCKCHAIN, list(sender.blocks)))
+        wire_bytes = raw_bytes = len(payload)
+        msg = wirecodec.decode_message(payload)
+        del payload
+        receiver.examine_peer_blockchain(msg.data)
+    elif mode == "batches":
+        height = -1
+        while True:
+            blocks = sender.get_blocks_after(height, BATCH_BLOCKS)
+            if len(blocks) == 0:
+                break
+            payload = wirecodec.encode_message(BlockchainMessage(MINER, \
+                BlockchainMessage.BLOCKS, (blocks, len(sender.blocks) - 1)))
+            wire_bytes += len(payload)
+            blocks, _ = wirecodec.decode_message(payload).data
+            receiver.splice_blocks(blocks)
+            height = blocks[-1].index
+        raw_bytes = wire_bytes
+    else:
+        codec = chainstream.choose_codec([mode.partition("-")[2]])
+        for chunk, count in chainstream.encode_chunks(iter(sender.blocks)):
+            payload = wirecodec.encode_message(BlockchainMessage(MINER, \
+                BlockchainMessage.CHAIN_CHUNK, (0, codec, \
+                chainstream.compress(chunk, codec), len(sender.blocks) - 1, False)))
+            raw_bytes += len(chunk)
+            wire_bytes += len(payload)
+            _, codec, data, _, _ = wirecodec.decode_message(payload).data
+            receiver.splice_blocks(list(chainstream.decode_blocks( \
+                chainstream.decompress(data, codec))))
+    return wire_bytes, raw_bytes
+
+# measures one mode in this process
+# params:
+#   -mode: one of MODES
+#   -datadir: where the sender's blockchain is kept
+def measure(mode, datadir):
+    sender = Blockchain(MINER, BlockStore(datadir, BlockStore.FSYNC_NEVER))
+    receiver_dir = tempfile.mkdtemp(prefix = "bench_chainstream_")
+    receiver = Blockchain(MINER, BlockStore(receiver_dir, BlockStore.FSYNC_NEVER))
+    receiver.set_magic_number(MAGIC_NUM)
+    length = len(sender.blocks)
+    sampler = MemorySampler()
+    sampler.start()
+    start = time.time()
+    wire_bytes, raw_bytes = transfer(mode, sender, receiver)
+    elapsed = time.time() - start
+    sampler.stop()
+    received = len(receiver.blocks)
+    receiver.blocks.close()
+    sender.blocks.close()
+    shutil.rmtree(receiver_dir)
+    print "  %-12s %8.1f MB peak  %8.0f blocks/s  %6.1f wire bytes/block  " \
+        "ratio %4.2f%s" % (mode, (sampler.peak - sampler.baseline) / 1e6, \
+        length / elapsed, wire_bytes / float(length), \
+        raw_bytes / float(max(1, wire_bytes)), \
+        "" if received == length else "  (only %d blocks received)" % received)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_chainstream")
+    argparser.add_argument("-n", "--blocks", type=int, default=100000)
+    argparser.add_argument("--txs-per-block", dest="txs_per_block", type=int, default=2)
+    argparser.add_argument("--mode", choices=MODES, default=None)
+    argparser.add_argument("--datadir", default=None)
+    args = argparser.parse_args()
+
+    if args.mode != None:
+        measure(args.mode, args.datadir)
+    else:
+        datadir = tempfile.mkdtemp(prefix = "bench_chainstream_")
+        try:
+            build_chain(datadir, args.blocks, args.txs_per_block)
+            print "sending %d blocks with %d transactions each" % (args.blocks, \
+                args.txs_per_block)
+            for mode in MODES:
+                sys.stdout.flush()
+                subprocess.check_call([sys.executable, os.path.abspath(__file__), \
+                    "--mode", mode, "--datadir", datadir])
+        finally:
+            shutil.rmtree(datadir)
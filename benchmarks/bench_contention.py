@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_contention
+# compares how readers (GET_LATEST_BLOCK and GET_BLOCKS_FROM handlers) and a
+# writer adding blocks get on when they share one lock held across sending,
+# as the node used to, against the reader/writer lock with the published tip
+
+# usage: bench_contention.py [-r READERS] [-s SECONDS] [--send-ms MS]
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from block import Block
+from blockchain import Blockchain
+from rwlock import RWLock
+
+SENDER = "127.0.0.1:10000"
+MAGIC_NUM = 7
+BATCH = 500
+
+class SingleLockNode(object):
+
+    def __init__(self, blockchain, send_seconds):
+        self.blockchain = blockchain
+        self.send_seconds = send_seconds
+        self.lock = threading.RLock()
+
+    def latest_block(self):
+        with self.lock:
+            block = self.blockchain.get_latest_block()
+            time.sleep(self.send_seconds)
+        return block
+
+    def blocks_after(self, height):
+        with self.lock:
+            blocks = self.blockchain.get_blocks_after(height, BATCH)
+            time.sleep(self.send_seconds)
+        return blocks
+
+    def add_block(self, block):
+        with self.lock:
+            self.blockchain.add_block(block)
+
+class ReadWriteNode(object):
+
+    def __init__(self, blockchain, send_seconds):
+        self.blockchain = blockchain
+        self.send_seconds = send_seconds
+        self.chain_lock = RWLock()
+        self.tip = blockchain.get_tip()
+
+    def latest_block(self):
+        block = self.tip.block
+        time.sleep(self.send_seconds)
+        return block
+
+    def blocks_after(self, height):
+        self.chain_lock.acquire_read()
+        blocks = self.blockchain.get_blocks_after(height, BATCH)
+        self.chain_lock.release_read()
+        time.sleep(self.send_seconds)
+        return blocks
+
+    def add_block(self, block):
+        self.chain_lock.acquire_write()
+        self.blockchain.add_block(block)
+        self.tip = self.blockchain.get_tip()
+        self.chain_lock.release_write()
+
+# builds a blockchain to read from
+# params:
+#   -length: the number of blocks in the blockchain
+# returns:
+#   -the Blockchain
+def build_blockchain(length):
+    blockchain = Blockchain(SENDER)
+    blockchain.set_magic_number(MAGIC_NUM)
+    blockchain.add_block(Block(0, 0, MAGIC_NUM, SENDER))
+    for i in xrange(1, length):
+        blockchain.add_block(Block(i, blockchain.blocks[-1].hash, MAGIC_NUM, SENDER))
+    return blockchain
+
+# runs readers and a writer against a node for a while
+# params:
+#   -node: the SingleLockNode or ReadWriteNode
+#   -readers: the number of reader threads
+#   -seconds: how long to run
+# returns:
+#   -(reads per second, mean read ms, mean write wait ms, max write wait ms)
+def run(node, readers, seconds):
+    stop = threading.Event()
+    read_times = []
+    write_waits = []
+
+    def reader(n):
+        times = []
+        i = 0
+        while not stop.is_set():
+            start = time.time()
+            if i % 2 == 0:
+                node.latest_block()
+            else:
+                node.blocks_after(len(node.blockchain.blocks) - BATCH - n)
+            times.append(time.time() - start)
+            i += 1
+        read_times.extend(times)
+
+    def writer():
+        while not stop.is_set():
+            latest = node.blockchain.get_latest_block()
+            block = Block(latest.index + 1, latest.hash, MAGIC_NUM, SENDER)
+            start = time.time()
+            node.add_block(block)
+            write_waits.append(time.time() - start)
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target = reader, args = [n]) for n in range(readers)]
+    threads.append(threading.Thread(target = writer))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return len(read_times) / float(seconds), \
+        1000 * sum(read_times) / max(1, len(read_times)), \
+        1000 * sum(write_waits) / max(1, len(write_waits)), \
+        1000 * max(write_waits or [0])
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_contention")
+    argparser.add_argument("-n", "--blocks", type=int, default=20000)
+    argparser.add_argument("-r", "--readers", type=int, default=8)
+    argparser.add_argument("-s", "--seconds", type=float, default=5)
+    # time a handler spends sending its reply, which the single lock was held across
+    argparser.add_argument("--send-ms", dest="send_ms", type=float, default=1.0)
+    args = argparser.parse_args()
+
+    print "%d readers, 1 writer, %.1f ms per send" % (args.readers, args.send_ms)
+    for label, node_class in (("single lock", SingleLockNode), \
+        ("read/write lock", ReadWriteNode)):
+        node = node_class(build_blockchain(args.blocks), args.send_ms / 1000.0)
+        reads, read_ms, write_ms, write_max_ms = run(node, args.readers, args.seconds)
+        print "  %-16s %9.0f reads/s  read %7.2f ms  write wait %7.2f ms " \
+            "(max %7.2f ms)" % (label, reads, read_ms, write_ms, write_max_ms)
@@ -0,0 +1,296 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_flood
+# floods a node with requests from many peers at once and measures how long a
+# well behaved peer waits for the node to answer GET_LATEST_BLOCK before and
+# during the flood. the node runs as its own process mining with proof of
+# work so it has blocks to serve and keeps finding more, and the blocks it
+# mined, its threads, CPU and memory and the messages it shed are reported
+# alongside. every flooding peer listens for the node's replies and throws
+# them away. results are written as JSON so runs can be compared
+
+# usage: bench_flood.py [--flooders N] [--rate MPS] [--flood {get_blocks,get_chain,tx}]
+#                       [--difficulty BITS] [--warmup-seconds S]
+#                       [--quiet-seconds S] [--flood-seconds S]
+#                       [--probe-interval S] [--handler-workers N] [--async]
+#                       [--port PORT] [--output FILE] [--keep-logs]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_network import NODE_SCRIPT, fetch_metrics, metric_total, percentile, \
+    process_tree_usage, wait_for_id
+from blockchainmsg import BlockchainMessage
+from blockchainpeer import BlockchainPeer
+import chainstream
+from transaction import Transaction
+from transport import TcpTransport
+import wirecodec
+
+# listens for what the node sends a fake peer, handing each message to
+# on_message, and gives the peer's id
+class Listener(object):
+
+    def __init__(self, on_message = None):
+        self.transport = TcpTransport()
+        host, port = self.transport.listen(0)
+        self.id = "%s:%d" % (host, port)
+        self.received = 0
+        self.on_message = on_message
+        thread = threading.Thread(target = self.transport.serve, args = [self.__receive])
+        thread.daemon = True
+        thread.start()
+
+    def __receive(self, payload):
+        self.received += 1
+        if self.on_message != None:
+            self.on_message(wirecodec.decode_message(payload))
+
+    def stop(self):
+        self.transport.stop()
+
+# a peer that sends one kind of request to the node at a steady rate, or as
+# fast as the connection takes them if it can't keep up, until stopped
+class Flooder(threading.Thread):
+
+    def __init__(self, node_id, kind, number, rate):
+        threading.Thread.__init__(self, name = "Flooder-%d" % number)
+        self.daemon = True
+        self.listener = Listener()
+        host, _, port = node_id.rpartition(":")
+        self.peer = BlockchainPeer(host, int(port))
+        self.peer.protocol_version = BlockchainMessage.PROTOCOL_VERSION
+        self.kind = kind
+        self.number = number
+        self.rate = rate
+        self.stop_event = threading.Event()
+        self.sent = 0
+        self.failed = 0
+
+    def run(self):
+        self.peer.send_msg_now(self.listener.id, BlockchainMessage.PEER_INIT, \
+            BlockchainMessage.PROTOCOL_VERSION)
+        start = time.time()
+        while not self.stop_event.is_set():
+            due = start + self.sent / self.rate
+            if due > time.time():
+                self.stop_event.wait(due - time.time())
+                continue
+            if self.kind == "get_blocks":
+                msg_type, data = BlockchainMessage.GET_BLOCKS_FROM, []
+            elif self.kind == "get_chain":
+                msg_type, data = BlockchainMessage.GET_CHAIN, ([], list(chainstream.CODECS))
+            else:
+                msg_type = BlockchainMessage.SUBMIT_TX
+                data = Transaction("flood", "flood %d %d" % (self.number, self.sent), 1)
+            try:
+                self.peer.send_msg_now(self.listener.id, msg_type, data)
+            except Exception:
+                self.failed += 1
+                self.stop_event.wait(0.1)
+            self.sent += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        self.peer.close()
+        self.listener.stop()
+
+# a well behaved peer asking the node for its latest block at a steady rate
+# and timing the answers
+class Probe(threading.Thread):
+
+    # seconds to wait for an answer before counting it as missed
+    TIMEOUT = 5
+
+    def __init__(self, node_id, interval):
+        threading.Thread.__init__(self, name = "Probe")
+        self.daemon = True
+        self.listener = Listener(self.__on_message)
+        host, _, port = node_id.rpartition(":")
+        self.peer = BlockchainPeer(host, int(port))
+        # a peer from before TIP is announced blocks with INV, so the only
+        # LATEST_BLOCK it is sent is the answer to its own request
+        self.version = BlockchainMessage.PEER_EXCHANGE_VERSION
+        self.peer.protocol_version = self.version
+        self.interval = interval
+        self.answered = threading.Event()
+        self.stop_event = threading.Event()
+        # (time asked, seconds to answer or None if missed)
+        self.samples = []
+
+    def __on_message(self, msg):
+        if msg.msg_type == BlockchainMessage.LATEST_BLOCK:
+            self.answered.set()
+
+    def run(self):
+        self.peer.send_msg_now(self.listener.id, BlockchainMessage.PEER_INIT, self.version)
+        while not self.stop_event.is_set():
+            self.answered.clear()
+            asked = time.time()
+            self.peer.send_msg_now(self.listener.id, BlockchainMessage.GET_LATEST_BLOCK)
+            if self.answered.wait(self.TIMEOUT):
+                self.samples.append((asked, time.time() - asked))
+            else:
+                self.samples.append((asked, None))
+            self.stop_event.wait(max(0, asked + self.interval - time.time()))
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        self.peer.close()
+        self.listener.stop()
+
+# summarizes the probe's answers between two times
+# params:
+#   -samples: the probe's (time asked, seconds to answer or None)
+#   -start, end: the times
+# returns:
+#   -a map of latency statistics
+def latency_stats(samples, start, end):
+    answered = [rtt for asked, rtt in samples if start <= asked < end and rtt != None]
+    missed = len([rtt for asked, rtt in samples if start <= asked < end and rtt == None])
+    ms = lambda seconds: None if seconds == None else round(seconds * 1000, 1)
+    return {
+        "samples" : len(answered) + missed,
+        "missed" : missed,
+        "p50_ms" : ms(percentile(answered, 0.5)),
+        "p90_ms" : ms(percentile(answered, 0.9)),
+        "p99_ms" : ms(percentile(answered, 0.99)),
+        "max_ms" : ms(max(answered) if len(answered) > 0 else None)
+    }
+
+# counts the threads of a process
+def thread_count(pid):
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_flood")
+    argparser.add_argument("--flooders", type=int, default=16)
+    # messages a second sent by all of the flooders together
+    argparser.add_argument("--rate", type=float, default=2000)
+    argparser.add_argument("--flood", choices=["get_blocks", "get_chain", "tx"], \
+        default="get_blocks")
+    argparser.add_argument("--difficulty", type=int, default=12)
+    # seconds the node mines alone first, so it has blocks to serve
+    argparser.add_argument("--warmup-seconds", dest="warmup_seconds", type=float, default=10)
+    argparser.add_argument("--quiet-seconds", dest="quiet_seconds", type=float, default=10)
+    argparser.add_argument("--flood-seconds", dest="flood_seconds", type=float, default=30)
+    argparser.add_argument("--probe-interval", dest="probe_interval", type=float, default=0.25)
+    # passed on to the node when given
+    argparser.add_argument("--handler-workers", dest="handler_workers", type=int, default=None)
+    argparser.add_argument("--async", dest="use_event_loop", action="store_true")
+    argparser.add_argument("--port", type=int, default=12000)
+    argparser.add_argument("--output", default=None)
+    argparser.add_argument("--keep-logs", dest="keep_logs", action="store_true")
+    args = argparser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_flood_")
+    log_path = os.path.join(workdir, "node.log")
+    metrics_port = args.port + 1000
+    command = [sys.executable, NODE_SCRIPT, "-p", str(args.port), \
+        "--pow-difficulty", str(args.difficulty), "--pow-workers", "1", \
+        "--verify-workers", "0", "--metrics-port", str(metrics_port), \
+        "--outbound-peers", "0", "--max-peers", str(args.flooders + 8)]
+    if args.handler_workers != None:
+        command += ["--handler-workers", str(args.handler_workers)]
+    if args.use_event_loop:
+        command.append("--async")
+    process = subprocess.Popen(command, stdout = open(log_path, "w"), \
+        stderr = subprocess.STDOUT)
+    probe = None
+    flooders = []
+    try:
+        node_id = wait_for_id(log_path, process, 30)
+        time.sleep(args.warmup_seconds)
+
+        probe = Probe(node_id, args.probe_interval)
+        probe.start()
+        quiet_start = time.time()
+        time.sleep(args.quiet_seconds)
+
+        before = fetch_metrics(metrics_port)
+        cpu_before = process_tree_usage(process.pid)[0]
+        flood_start = time.time()
+        flooders = [Flooder(node_id, args.flood, i, args.rate / args.flooders) \
+            for i in range(args.flooders)]
+        for flooder in flooders:
+            flooder.start()
+        peak_threads = 0
+        peak_rss = 0
+        while time.time() < flood_start + args.flood_seconds:
+            peak_threads = max(peak_threads, thread_count(process.pid))
+            peak_rss = max(peak_rss, process_tree_usage(process.pid)[1])
+            time.sleep(0.5)
+        flood_end = time.time()
+        after = fetch_metrics(metrics_port)
+        cpu_seconds = process_tree_usage(process.pid)[0] - cpu_before
+        for flooder in flooders:
+            flooder.stop()
+        probe.stop()
+        if before == None or after == None:
+            raise RuntimeError("node stopped serving metrics, see %s" % workdir)
+        delta = dict((key, value - before.get(key, 0)) for key, value in after.items())
+
+        shed = {}
+        for (name, labels), value in delta.items():
+            if name == "messages_shed_total" and value > 0:
+                reason = "overloaded" if "overloaded" in labels else "rate_limited"
+                shed[reason] = shed.get(reason, 0) + int(value)
+        flood_sent = sum(flooder.sent for flooder in flooders)
+        results = {
+            "config" : vars(args),
+            "probe" : {
+                "quiet" : latency_stats(probe.samples, quiet_start, flood_start),
+                "flood" : latency_stats(probe.samples, flood_start, flood_end)
+            },
+            "flood" : {
+                "messages_sent" : flood_sent,
+                "messages_per_second" : round(flood_sent / (flood_end - flood_start)),
+                "replies_received" : sum(f.listener.received for f in flooders),
+                "send_failures" : sum(flooder.failed for flooder in flooders)
+            },
+            "node" : {
+                "blocks_mined" : int(metric_total(delta, "chain_height")),
+                "messages_handled" : int(metric_total(delta, "messages_received_total")),
+                "messages_shed" : shed,
+                "busy_signals_sent" : int(sum(value for (name, labels), value in \
+                    delta.items() if name == "busy_signals_total" and "sent" in labels)),
+                "peak_threads" : peak_threads,
+                "cpu_seconds" : round(cpu_seconds, 1),
+                "peak_rss_mb" : round(peak_rss / 1048576.0, 1)
+            }
+        }
+    finally:
+        for flooder in flooders:
+            flooder.stop_event.set()
+        if probe != None:
+            probe.stop_event.set()
+        process.terminate()
+        process.wait()
+        if not args.keep_logs:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print output
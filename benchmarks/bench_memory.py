@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_memory
+# compares the memory a blockchain takes up as a list of Block objects with a
+# __dict__ (how blocks used to be kept), a list of slotted Block objects and a
+# CompactChain. each layout is measured in its own process
+
+# usage: bench_memory.py [-n BLOCKS]
+
+import argparse
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from block import Block
+from compactchain import CompactChain
+
+LAYOUTS = ("dict", "slotted", "compact")
+MINERS = ["127.0.0.1:%d" % port for port in range(10000, 10010)]
+
+# a block laid out the way blocks were before they were slotted
+class DictBlock(object):
+
+    def __init__(self, idx, prev_hash, timestamp, data, miner, block_hash):
+        self.index = idx
+        self.previous_hash = prev_hash
+        self.timestamp = timestamp
+        self.data = data
+        self.mined_by = miner
+        self.hash = block_hash
+
+# reads the resident set size of this process
+# returns:
+#   -the resident set size in bytes
+def rss_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+# builds a chain in one layout, the hashes are made up since only the size of
+# the chain matters
+# params:
+#   -layout: one of LAYOUTS
+#   -length: the number of blocks in the chain
+# returns:
+#   -the chain
+def build_chain(layout, length):
+    if layout == "compact":
+        chain = CompactChain()
+    else:
+        chain = []
+    prev_hash = 0
+    timestamp = time.time()
+    for i in xrange(length):
+        # decoded blocks each have their own hash strings, nothing is shared
+        block_hash = hashlib.sha256(str(i)).hexdigest()
+        if layout == "dict":
+            block = DictBlock(i, prev_hash, timestamp + i, 7, MINERS[i % len(MINERS)], \
+                block_hash)
+        else:
+            block = Block.restore(i, prev_hash, timestamp + i, 7, \
+                MINERS[i % len(MINERS)], block_hash)
+        chain.append(block)
+        # a copy, as a decoded block's previous hash would be
+        prev_hash = (block_hash + " ")[:-1]
+    return chain
+
+# measures one layout in this process
+# params:
+#   -layout: one of LAYOUTS
+#   -length: the number of blocks in the chain
+def measure(layout, length):
+    before = rss_bytes()
+    start = time.time()
+    chain = build_chain(layout, length)
+    build_time = time.time() - start
+    used = rss_bytes() - before
+    start = time.time()
+    for i in xrange(0, len(chain), max(1, len(chain) // 100000)):
+        chain[i].hash
+    read_time = time.time() - start
+    print "  %-8s %8.1f MB  %6.1f bytes/block  built in %6.2f s  %8.0f reads/s" % \
+        (layout, used / 1e6, float(used) / length, build_time, \
+        min(len(chain), 100000) / read_time)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_memory")
+    argparser.add_argument("-n", "--blocks", type=int, default=1000000)
+    argparser.add_argument("--layout", choices=LAYOUTS, default=None)
+    args = argparser.parse_args()
+
+    if args.layout != None:
+        measure(args.layout, args.blocks)
+    else:
+        print "memory for %d blocks" % args.blocks
+        for layout in LAYOUTS:
+            sys.stdout.flush()
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), \
+                "-n", str(args.blocks), "--layout", layout])
@@ -0,0 +1,423 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_network
+# launches a network of blockchainnodes on localhost in a line, ring or random
+# mesh, mines with proof of work while submitting transactions, and reports
+# how long blocks take to reach every node, how long the network takes to
+# converge after a partition heals, messages and bytes sent per block and the
+# CPU and memory each node used. results are written as JSON so runs can be
+# compared. a partition freezes some nodes with SIGSTOP, and in a line the
+# frozen middle node splits the network into two halves that each keep
+# mining until it is resumed. CPU and memory are read from /proc (Linux)
+
+# usage: bench_network.py [-n NODES] [--topology {line,ring,mesh}] [--degree D]
+#                         [--difficulty BITS] [--tx-rate TPS] [--seconds S]
+#                         [--partition-seconds S] [--settle-seconds S]
+#                         [--partition-nodes I [I ...]] [--port PORT]
+#                         [--output FILE] [--keep-logs]
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from blockchainmsg import BlockchainMessage
+from blockchainpeer import BlockchainPeer
+from metrics import Metrics
+from transaction import Transaction
+
+NODE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", \
+    "blockchainnode.py")
+LOG_LINE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - .*? - (.*)$")
+TIP_MESSAGE = re.compile(r"^tip is now ([0-9a-f]{64}) at height (\d+)$")
+STARTED_MESSAGE = re.compile(r"^BLOCKCHAIN NODE STARTED - (.*)$")
+METRIC_LINE = re.compile(r"^%s([a-z_]+)(\{.*\})? (\S+)$" % Metrics.PREFIX)
+TYPE_LABEL = re.compile(r"type=\"([A-Z_]+)\"")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# works out which earlier nodes each node connects to when it starts, nodes
+# are started in order so a node can only name nodes that are already up
+# params:
+#   -topology: line, ring or mesh
+#   -count: the number of nodes
+#   -degree: the number of earlier nodes each node connects to in a mesh
+#   -rand: the random.Random choosing mesh links
+# returns:
+#   -a list of lists of node positions, one per node
+def build_topology(topology, count, degree, rand):
+    links = [[] for i in range(count)]
+    for i in range(1, count):
+        if topology == "mesh":
+            links[i] = rand.sample(range(i), min(i, degree))
+        else:
+            links[i] = [i - 1]
+    if topology == "ring" and count > 2:
+        links[count - 1].append(0)
+    return links
+
+# parses a node's log
+# params:
+#   -path: the log file
+# returns:
+#   -a list of (time, message) of every log line
+def read_log(path):
+    lines = []
+    with open(path) as f:
+        for line in f:
+            match = LOG_LINE.match(line.rstrip("\n"))
+            if match == None:
+                continue
+            stamp = time.mktime(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"))
+            lines.append((stamp + int(match.group(2)) / 1000.0, match.group(3)))
+    return lines
+
+# waits for a node to log its id
+# params:
+#   -path: the node's log file
+#   -process: the node's Popen
+#   -timeout: seconds to wait
+# returns:
+#   -the node's id, host:port
+def wait_for_id(path, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() != None:
+            raise RuntimeError("node exited early, see %s" % path)
+        for stamp, message in read_log(path):
+            match = STARTED_MESSAGE.match(message)
+            if match != None:
+                return match.group(1)
+        time.sleep(0.2)
+    raise RuntimeError("node didn't start in %d seconds, see %s" % (timeout, path))
+
+# reads a node's metrics
+# params:
+#   -port: the node's metrics port
+# returns:
+#   -a map of (name, labels) to value, or None if the node didn't answer
+def fetch_metrics(port):
+    try:
+        text = urllib2.urlopen("http://127.0.0.1:%d/metrics" % port, timeout = 2).read()
+    except Exception:
+        return None
+    metrics = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match != None:
+            metrics[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return metrics
+
+# sums a metric over its labels
+def metric_total(metrics, name):
+    return sum(value for (metric, labels), value in metrics.items() if metric == name)
+
+# adds up the CPU time and resident memory of a process and its children,
+# such as the proof of work and validation workers
+# params:
+#   -pid: the process
+# returns:
+#   -(CPU seconds, resident bytes)
+def process_tree_usage(pid):
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/%s/stat" % entry) as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                parents[int(entry)] = (int(fields[1]), fields)
+            except IOError:
+                continue
+    tree = set([pid])
+    grew = True
+    while grew:
+        grew = False
+        for child, (parent, fields) in parents.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                grew = True
+    cpu = 0.0
+    rss = 0
+    for member in tree:
+        if parents.has_key(member):
+            fields = parents[member][1]
+            cpu += (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+            rss += int(fields[21]) * PAGE_SIZE
+    return cpu, rss
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# submits transactions to random nodes at a steady rate until stopped
+class TransactionLoad(threading.Thread):
+
+    def __init__(self, node_ids, rate):
+        threading.Thread.__init__(self, name = "TransactionLoad")
+        self.daemon = True
+        self.peers = []
+        for node_id in node_ids:
+            host, _, port = node_id.rpartition(":")
+            peer = BlockchainPeer(host, int(port))
+            peer.protocol_version = BlockchainMessage.TX_VERSION
+            self.peers.append(peer)
+        self.rate = rate
+        self.stop_event = threading.Event()
+        self.submitted = 0
+        self.failed = 0
+
+    def run(self):
+        rand = random.Random(7)
+        start = time.time()
+        while not self.stop_event.is_set():
+            due = start + self.submitted / float(self.rate)
+            if due > time.time():
+                self.stop_event.wait(due - time.time())
+                continue
+            tx = Transaction("bench", "load %d" % self.submitted, rand.randint(0, 100))
+            try:
+                rand.choice(self.peers).send_msg_now("bench", \
+                    BlockchainMessage.SUBMIT_TX, tx)
+            except Exception:
+                self.failed += 1
+            self.submitted += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        for peer in self.peers:
+            peer.close()
+
+# works out how long blocks took to reach each node from the tip changes
+# the nodes logged. a block reached a node when it became the node's tip,
+# blocks a node only received as part of a batch aren't counted for it
+# params:
+#   -tips: a list per node of (time, hash, height)
+#   -start, end: only blocks first seen between these times are counted
+# returns:
+#   -a map of propagation statistics
+def propagation_stats(tips, start, end):
+    arrivals = {}
+    for node, events in enumerate(tips):
+        for stamp, block_hash, height in events:
+            arrivals.setdefault(block_hash, {}).setdefault(node, stamp)
+    first_to_all = []
+    delays = []
+    missed = 0
+    blocks = 0
+    for block_hash, seen in arrivals.items():
+        first = min(seen.values())
+        if not start <= first <= end:
+            continue
+        blocks += 1
+        missed += len(tips) - len(seen)
+        delays.extend(stamp - first for node, stamp in seen.items() if stamp != first)
+        if len(seen) == len(tips):
+            first_to_all.append(max(seen.values()) - first)
+    return {
+        "blocks" : blocks,
+        "samples" : len(delays),
+        "missed" : missed,
+        "p50_ms" : ms(percentile(delays, 0.5)),
+        "p90_ms" : ms(percentile(delays, 0.9)),
+        "p99_ms" : ms(percentile(delays, 0.99)),
+        "max_ms" : ms(max(delays or [None])),
+        "to_all_p50_ms" : ms(percentile(first_to_all, 0.5)),
+        "to_all_p90_ms" : ms(percentile(first_to_all, 0.9))
+    }
+
+def ms(seconds):
+    if seconds == None:
+        return None
+    return round(seconds * 1000, 1)
+
+# works out how long after a partition healed every node had the same tip
+# params:
+#   -tips: a list per node of (time, hash, height)
+#   -healed: when the partition healed
+# returns:
+#   -seconds until the tips agreed, or None if they never did
+def convergence_seconds(tips, healed):
+    events = sorted((stamp, node, block_hash) for node, node_tips in enumerate(tips) \
+        for stamp, block_hash, height in node_tips)
+    current = [None] * len(tips)
+    for stamp, node, block_hash in events:
+        current[node] = block_hash
+        if stamp >= healed and len(set(current)) == 1:
+            return round(stamp - healed, 3)
+    return None
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_network")
+    argparser.add_argument("-n", "--nodes", type=int, default=5)
+    argparser.add_argument("--topology", choices=["line", "ring", "mesh"], default="line")
+    # earlier nodes each node links to in a mesh
+    argparser.add_argument("--degree", type=int, default=2)
+    argparser.add_argument("--difficulty", type=int, default=17)
+    argparser.add_argument("--tx-rate", dest="tx_rate", type=float, default=50)
+    argparser.add_argument("--seconds", type=float, default=30)
+    argparser.add_argument("--partition-seconds", dest="partition_seconds", type=float, \
+        default=10)
+    argparser.add_argument("--settle-seconds", dest="settle_seconds", type=float, default=20)
+    # the nodes frozen for the partition, the middle node by default
+    argparser.add_argument("--partition-nodes", dest="partition_nodes", type=int, \
+        nargs="*", default=None)
+    argparser.add_argument("--port", type=int, default=11000)
+    argparser.add_argument("--seed", type=int, default=1)
+    argparser.add_argument("--output", default=None)
+    argparser.add_argument("--keep-logs", dest="keep_logs", action="store_true")
+    args = argparser.parse_args()
+
+    partition_nodes = args.partition_nodes
+    if partition_nodes == None:
+        partition_nodes = [args.nodes // 2]
+    links = build_topology(args.topology, args.nodes, args.degree, random.Random(args.seed))
+    workdir = tempfile.mkdtemp(prefix="bench_network_")
+    processes = []
+    node_ids = []
+    logs = []
+    load = None
+    try:
+        for i in range(args.nodes):
+            log_path = os.path.join(workdir, "node%d.log" % i)
+            command = [sys.executable, NODE_SCRIPT, "-p", str(args.port + i), \
+                "--datadir", os.path.join(workdir, "data%d" % i), \
+                "--pow-difficulty", str(args.difficulty), "--pow-workers", "1", \
+                "--verify-workers", "0", "--metrics-port", str(args.port + 1000 + i), \
+                "--outbound-peers", "0"]
+            if len(links[i]) > 0:
+                command += ["--peers"] + [node_ids[j] for j in links[i]]
+            processes.append(subprocess.Popen(command, stdout = open(log_path, "w"), \
+                stderr = subprocess.STDOUT))
+            logs.append(log_path)
+            node_ids.append(wait_for_id(log_path, processes[-1], 30))
+        print "started %d nodes in a %s: %s" % (args.nodes, args.topology, \
+            " ".join("%d->%s" % (i, links[i]) for i in range(1, args.nodes)))
+
+        # every node has to learn the magic number and mine or sync a block
+        # before measuring starts
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            metrics = [fetch_metrics(args.port + 1000 + i) for i in range(args.nodes)]
+            if all(m != None and metric_total(m, "chain_height") >= 1 for m in metrics):
+                break
+            time.sleep(0.5)
+        else:
+            raise RuntimeError("nodes didn't start mining, see %s" % workdir)
+
+        load = TransactionLoad(node_ids, args.tx_rate)
+        load.start()
+        measure_start = time.time()
+        before = [fetch_metrics(args.port + 1000 + i) for i in range(args.nodes)]
+        peak_rss = [0] * args.nodes
+        while time.time() < measure_start + args.seconds:
+            for i, process in enumerate(processes):
+                peak_rss[i] = max(peak_rss[i], process_tree_usage(process.pid)[1])
+            time.sleep(1)
+        measure_end = time.time()
+        usage = [process_tree_usage(p.pid) for p in processes]
+        after = [fetch_metrics(args.port + 1000 + i) for i in range(args.nodes)]
+
+        print "partitioning nodes %s for %.0f seconds" % (partition_nodes, \
+            args.partition_seconds)
+        for i in partition_nodes:
+            os.kill(processes[i].pid, signal.SIGSTOP)
+        time.sleep(args.partition_seconds)
+        for i in partition_nodes:
+            os.kill(processes[i].pid, signal.SIGCONT)
+        healed = time.time()
+        time.sleep(args.settle_seconds)
+        load.stop()
+    finally:
+        if load != None and load.is_alive():
+            load.stop_event.set()
+        for process in processes:
+            try:
+                os.kill(process.pid, signal.SIGCONT)
+                process.send_signal(signal.SIGINT)
+            except OSError:
+                pass
+        deadline = time.time() + 10
+        for process in processes:
+            while process.poll() == None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() == None:
+                process.kill()
+
+    tips = []
+    for path in logs:
+        tips.append([(stamp, match.group(1), int(match.group(2))) for stamp, match in \
+            ((stamp, TIP_MESSAGE.match(message)) for stamp, message in read_log(path)) \
+            if match != None])
+
+    # traffic is counted over the measured period only
+    metrics = [dict((key, value - old.get(key, 0)) for key, value in new.items()) \
+        for old, new in zip(before, after) if old != None and new != None]
+    mined = ("blocks_mined_total", "{result=\"added\"}")
+    blocks_mined = sum(m.get(mined, 0) for m in metrics)
+    messages_by_type = {}
+    for m in metrics:
+        for (name, labels), value in m.items():
+            if name == "peer_messages_sent_total":
+                kind = TYPE_LABEL.search(labels).group(1)
+                messages_by_type[kind] = messages_by_type.get(kind, 0) + value
+    messages = sum(messages_by_type.values())
+    sent_bytes = sum(metric_total(m, "peer_bytes_sent_total") for m in metrics)
+    per_block = max(1, blocks_mined)
+
+    results = {
+        "config" : {
+            "nodes" : args.nodes,
+            "topology" : args.topology,
+            "links" : links,
+            "difficulty" : args.difficulty,
+            "tx_rate" : args.tx_rate,
+            "seconds" : args.seconds,
+            "partition_nodes" : partition_nodes,
+            "partition_seconds" : args.partition_seconds
+        },
+        "propagation" : propagation_stats(tips, measure_start, measure_end),
+        "convergence" : {
+            "seconds_after_heal" : convergence_seconds(tips, healed)
+        },
+        "traffic" : {
+            "blocks_mined" : blocks_mined,
+            "messages_per_block" : round(messages / per_block, 1),
+            "bytes_per_block" : round(sent_bytes / per_block, 1),
+            "messages_by_type" : messages_by_type
+        },
+        "transactions" : {
+            "submitted" : load.submitted,
+            "failed" : load.failed
+        },
+        "nodes" : [{
+            "id" : node_ids[i],
+            "cpu_seconds" : round(usage[i][0], 2),
+            "peak_rss_mb" : round(peak_rss[i] / 1048576.0, 1),
+            "height" : metric_total(after[i] or {}, "chain_height")
+        } for i in range(args.nodes)]
+    }
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print output
+    if args.keep_logs:
+        print "logs kept in %s" % workdir
+    else:
+        shutil.rmtree(workdir)
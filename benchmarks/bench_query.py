@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_query
+# measures how many queries a second the query server answers and how long
+# they take, with and without its response cache and while new blocks keep
+# changing the tip. the server runs in this process over a blockchain built
+# in memory and clients in processes of their own send a mix of block, range,
+# tip and miner queries over connections they keep open
+
+# usage: bench_query.py [-n BLOCKS] [-c CLIENTS] [--seconds S] [--distinct N]
+#                       [--tip-interval S]
+
+import argparse
+import httplib
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_network import percentile
+from block import Block
+from blockchain import Blockchain
+from queryapi import QueryServer
+from rwlock import RWLock
+
+MAGIC_NUM = 7
+MINERS = ["127.0.0.1:%d" % (10000 + i) for i in range(5)]
+
+# builds a blockchain mined by a handful of miners
+# params:
+#   -length: the number of blocks
+# returns:
+#   -the Blockchain
+def build_blockchain(length):
+    blockchain = Blockchain(MINERS[0])
+    blockchain.set_magic_number(MAGIC_NUM)
+    rand = random.Random(1)
+    previous_hash = 0
+    for i in xrange(length):
+        block = Block(i, previous_hash, MAGIC_NUM, rand.choice(MINERS))
+        blockchain.add_block(block)
+        previous_hash = block.hash
+    return blockchain
+
+# picks the paths the clients ask for: blocks by height and by hash, pages of
+# blocks, the tip and the miners
+# params:
+#   -blockchain: the Blockchain being served
+#   -count: the number of distinct paths
+# returns:
+#   -a list of paths
+def query_paths(blockchain, count):
+    rand = random.Random(2)
+    height = blockchain.get_height()
+    paths = []
+    for i in xrange(count):
+        kind = rand.random()
+        if kind < 0.4:
+            paths.append("/blocks/%d" % rand.randint(0, height))
+        elif kind < 0.7:
+            paths.append("/blocks/hash/%s" % blockchain.get_hash_at(rand.randint(0, height)))
+        elif kind < 0.9:
+            paths.append("/blocks?start=%d&limit=20" % rand.randint(0, height))
+        elif kind < 0.95:
+            paths.append("/tip")
+        else:
+            paths.append("/miners")
+    return paths
+
+# sends queries picked at random from paths over one connection until time
+# is up, putting the latency of every query on results
+def client(port, paths, seconds, seed, results):
+    rand = random.Random(seed)
+    conn = httplib.HTTPConnection("127.0.0.1", port)
+    latencies = []
+    failures = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        start = time.time()
+        conn.request("GET", rand.choice(paths))
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            failures += 1
+        latencies.append(time.time() - start)
+    conn.close()
+    results.put((latencies, failures))
+
+# adds a block to the blockchain every interval until stopped, publishing the
+# new tip like a node does
+class TipChanger(threading.Thread):
+
+    def __init__(self, blockchain, chain_lock, state, interval):
+        threading.Thread.__init__(self, name = "TipChanger")
+        self.daemon = True
+        self.blockchain = blockchain
+        self.chain_lock = chain_lock
+        self.state = state
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.changes = 0
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.chain_lock.acquire_write()
+            latest = self.blockchain.get_latest_block()
+            self.blockchain.add_block(Block(latest.index + 1, latest.hash, MAGIC_NUM, \
+                MINERS[self.changes % len(MINERS)]))
+            self.state["tip"] = self.blockchain.get_tip()
+            self.chain_lock.release_write()
+            self.changes += 1
+
+# runs the clients against a query server and prints what they measured
+def report(label, blockchain, paths, cache_size, args, tip_interval = None):
+    chain_lock = RWLock()
+    state = { "tip" : blockchain.get_tip() }
+    server = QueryServer(blockchain, chain_lock, lambda: state["tip"], 0, \
+        cache_size = cache_size)
+    changer = None
+    if tip_interval != None:
+        changer = TipChanger(blockchain, chain_lock, state, tip_interval)
+        changer.start()
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target = client, args = (server.port, paths, \
+        args.seconds, i, results)) for i in range(args.clients)]
+    for process in clients:
+        process.start()
+    latencies = []
+    failures = 0
+    for process in clients:
+        client_latencies, client_failures = results.get()
+        latencies += client_latencies
+        failures += client_failures
+    for process in clients:
+        process.join()
+    if changer != None:
+        changer.stop_event.set()
+        changer.join()
+    server.close()
+    print "  %-32s %8.0f queries/s  p50 %6.2f ms  p99 %6.2f ms  %d failed" % (label, \
+        len(latencies) / args.seconds, percentile(latencies, 0.5) * 1000, \
+        percentile(latencies, 0.99) * 1000, failures)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_query")
+    argparser.add_argument("-n", "--blocks", type=int, default=100000)
+    argparser.add_argument("-c", "--clients", type=int, default=4)
+    argparser.add_argument("--seconds", type=float, default=10)
+    # distinct paths the clients pick from, fewer means more cache hits
+    argparser.add_argument("--distinct", type=int, default=1000)
+    # seconds between new blocks in the run with a changing tip
+    argparser.add_argument("--tip-interval", dest="tip_interval", type=float, default=1)
+    args = argparser.parse_args()
+
+    blockchain = build_blockchain(args.blocks)
+    paths = query_paths(blockchain, args.distinct)
+    print "querying %d blocks from %d clients, %d distinct paths" % (args.blocks, \
+        args.clients, len(paths))
+    report("no cache", blockchain, paths, 0, args)
+    report("cache", blockchain, paths, None, args)
+    report("cache, new block every %gs" % args.tip_interval, blockchain, paths, \
+        None, args, args.tip_interval)
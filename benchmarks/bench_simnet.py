@@ -0,0 +1,251 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_simnet
+# runs a network of nodes in one process over the simulated network in
+# simnet.py and reports how fast the simulation ran against the virtual clock
+# along with what bench_network.py measures over TCP: block propagation
+# latency, convergence after a partition heals and traffic per block, and
+# how often the nodes polled their peers' tips and how long they spent more
+# than a block behind. the nodes are split in two halves, by position, for
+# the partition. the same seed always gives the same results. with --outbound-peers the nodes also
+# find peers of their own beyond the topology, and how long it takes every
+# node to find them is reported
+
+# usage: bench_simnet.py [-n NODES] [--topology {line,ring,mesh}] [--degree D]
+#                        [--seconds S] [--block-time S] [--latency S]
+#                        [--jitter S] [--bandwidth BYTES] [--loss P]
+#                        [--partition-at S] [--partition-seconds S]
+#                        [--tx-rate TPS] [--outbound-peers N] [--max-peers N]
+#                        [--seed SEED] [--output FILE]
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_network import build_topology, convergence_seconds, propagation_stats
+from blockchain import Blockchain
+from blockchainmsg import BlockchainMessage
+from blockchainnode import BlockchainNode
+from blockchainpeer import BlockchainPeer
+from peertable import PeerTable
+from simnet import SimNetwork
+from transaction import Transaction
+
+# records the tip changes nodes log, against the virtual clock
+class TipRecorder(logging.Handler):
+
+    def __init__(self, network, positions):
+        logging.Handler.__init__(self, logging.INFO)
+        self.network = network
+        # map of host to the node's position
+        self.positions = positions
+        self.tips = [[] for i in range(len(positions))]
+
+    def emit(self, record):
+        if record.msg != "tip is now %s at height %d" or self.network.current == None:
+            return
+        block_hash, height = record.args
+        self.tips[self.positions[self.network.current.host]].append( \
+            (self.network.now, block_hash, height))
+
+# records the least, average and most outbound peers the nodes have once a
+# second of virtual time, and when every node first had its target
+def sample_peers(network, nodes, target, samples):
+    counts = [len([peer for peer in node.peers.values() if peer.outgoing]) \
+        for node in nodes]
+    samples.append((network.now, min(counts), sum(counts) / float(len(counts)), \
+        max(counts)))
+    network.call_later(1, sample_peers, network, nodes, target, samples)
+
+# submits transactions to random nodes at a steady rate of virtual time
+def submit_transactions(network, peers, rate, rand, count = [0]):
+    tx = Transaction("bench", "load %d" % count[0], rand.randint(0, 100), network.now)
+    count[0] += 1
+    rand.choice(peers).send_msg("bench", BlockchainMessage.SUBMIT_TX, tx)
+    network.call_later(1.0 / rate, submit_transactions, network, peers, rate, rand)
+
+# measures how long nodes spent more than a block behind the highest block
+# any node had, partitions included
+# params:
+#   -tips: the tip changes TipRecorder recorded for each node
+# returns:
+#   -(total node seconds behind, the 90th percentile and the most of each
+#   node's longest time behind)
+def behind_stats(tips):
+    events = sorted((stamp, node, height) for node, node_tips in enumerate(tips) \
+        for stamp, block_hash, height in node_tips)
+    heights = [-1] * len(tips)
+    since = [None] * len(tips)
+    longest = [0.0] * len(tips)
+    total = 0.0
+    top = -1
+    for stamp, node, height in events:
+        heights[node] = height
+        top = max(top, height)
+        for i in range(len(tips)):
+            behind = heights[i] < top - 1
+            if behind and since[i] == None:
+                since[i] = stamp
+            elif not behind and since[i] != None:
+                total += stamp - since[i]
+                longest[i] = max(longest[i], stamp - since[i])
+                since[i] = None
+    longest.sort()
+    return total, longest[int(len(longest) * 0.9)], longest[-1]
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_simnet")
+    argparser.add_argument("-n", "--nodes", type=int, default=200)
+    argparser.add_argument("--topology", choices=["line", "ring", "mesh"], default="mesh")
+    argparser.add_argument("--degree", type=int, default=4)
+    # seconds of virtual time to run for
+    argparser.add_argument("--seconds", type=float, default=600)
+    # the average seconds between blocks across the whole network
+    argparser.add_argument("--block-time", dest="block_time", type=float, default=10)
+    argparser.add_argument("--latency", type=float, default=0.05)
+    argparser.add_argument("--jitter", type=float, default=0.01)
+    argparser.add_argument("--bandwidth", type=float, default=None)
+    argparser.add_argument("--loss", type=float, default=0.0)
+    argparser.add_argument("--partition-at", dest="partition_at", type=float, default=300)
+    argparser.add_argument("--partition-seconds", dest="partition_seconds", type=float, \
+        default=60)
+    argparser.add_argument("--tx-rate", dest="tx_rate", type=float, default=0)
+    # peers each node finds for itself, 0 keeps to the topology
+    argparser.add_argument("--outbound-peers", dest="outbound_peers", type=int, default=0)
+    argparser.add_argument("--max-peers", dest="max_peers", type=int, default=32)
+    argparser.add_argument("--seed", type=int, default=1)
+    argparser.add_argument("--output", default=None)
+    args = argparser.parse_args()
+
+    network = SimNetwork(args.latency, args.jitter, args.bandwidth, args.loss, args.seed)
+    # every node guesses the magic number once per interval and an attempt
+    # succeeds one time in MAGIC_NUMBER_MAX, spread the attempts out so the
+    # whole network finds a block every block_time seconds
+    BlockchainNode.MINING_INTERVAL = args.nodes * args.block_time / \
+        Blockchain.MAGIC_NUMBER_MAX
+    links = build_topology(args.topology, args.nodes, args.degree, random.Random(args.seed))
+
+    transports = [network.transport() for i in range(args.nodes)]
+    # tip changes are logged at INFO and recorded, only warnings are printed
+    recorder = TipRecorder(network, dict((t.host, i) for i, t in enumerate(transports)))
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    logging.getLogger().addHandler(recorder)
+    logging.getLogger().addHandler(console)
+    logging.getLogger().setLevel(logging.INFO)
+
+    start = time.time()
+    nodes = []
+    for i in range(args.nodes):
+        nodes.append(BlockchainNode(0, [nodes[j].id for j in links[i]], \
+            transport = transports[i], \
+            peer_table = PeerTable(args.max_peers, args.outbound_peers)))
+    setup_seconds = time.time() - start
+    peer_samples = []
+    target = min(args.outbound_peers, args.nodes - 1)
+    network.call_later(0, sample_peers, network, nodes, target, peer_samples)
+
+    if args.tx_rate > 0:
+        client = network.transport()
+        peers = []
+        for node in nodes:
+            peer = BlockchainPeer(node.serverhostname, node.serverport, transport = client)
+            peer.protocol_version = BlockchainMessage.TX_VERSION
+            peers.append(peer)
+        network.call_later(0, submit_transactions, network, peers, args.tx_rate, \
+            random.Random(args.seed))
+
+    start = time.time()
+    network.run(args.partition_at)
+    measured = network.now
+    network.partition([node.id for node in nodes[:args.nodes // 2]])
+    network.run(args.partition_seconds)
+    network.heal()
+    healed = network.now
+    network.run(max(0, args.seconds - args.partition_at - args.partition_seconds))
+    run_seconds = time.time() - start
+
+    stats = network.stats()
+    mined = 0
+    for node in nodes:
+        for labels, count in node.metrics.snapshot().get("blocks_mined_total", {}).items():
+            if dict(labels).get("result") == "added":
+                mined += count
+    polls = 0
+    lag_count = 0
+    lag_sum = 0.0
+    for node in nodes:
+        snapshot = node.metrics.snapshot()
+        polls += sum(snapshot.get("sync_polls_total", {}).values())
+        for lag in snapshot.get("sync_lag_seconds", {}).values():
+            lag_count += lag["count"]
+            lag_sum += lag["sum"]
+    behind_total, behind_p90, behind_max = behind_stats(recorder.tips)
+    heights = [node.tip.height for node in nodes]
+    bootstrap = None
+    if target > 0:
+        for when, least, mean, most in peer_samples:
+            if least >= target:
+                bootstrap = round(when - network.START_TIME, 1)
+                break
+    peer_counts = [len(node.peers) for node in nodes]
+    per_block = max(1, mined)
+    results = {
+        "config" : vars(args),
+        "simulation" : {
+            "setup_seconds" : round(setup_seconds, 2),
+            "wall_seconds" : round(run_seconds, 2),
+            "virtual_seconds" : round(stats["time"], 1),
+            "speedup" : round(stats["time"] / max(run_seconds, 1e-6), 1),
+            "events" : stats["events"],
+            "events_per_second" : round(stats["events"] / max(run_seconds, 1e-6))
+        },
+        "propagation" : propagation_stats(recorder.tips, network.START_TIME, measured),
+        "convergence" : {
+            "seconds_after_heal" : convergence_seconds(recorder.tips, healed)
+        },
+        "traffic" : {
+            "messages_per_block" : round(stats["messages_sent"] / float(per_block), 1),
+            "bytes_per_block" : round(stats["bytes_sent"] / float(per_block), 1),
+            "messages_lost" : stats["messages_lost"],
+            "messages_partitioned" : stats["messages_partitioned"]
+        },
+        "sync" : {
+            "polls_per_node_per_minute" : round(polls / float(len(nodes)) / \
+                (stats["time"] / 60.0), 2),
+            "catch_ups" : lag_count,
+            "lag_mean_seconds" : round(lag_sum / max(1, lag_count), 3),
+            "behind_node_seconds" : round(behind_total),
+            "longest_behind_p90_seconds" : round(behind_p90, 1),
+            "longest_behind_max_seconds" : round(behind_max, 1)
+        },
+        "peers" : {
+            "min" : min(peer_counts),
+            "mean" : round(sum(peer_counts) / float(len(peer_counts)), 1),
+            "max" : max(peer_counts),
+            "bootstrap_seconds" : bootstrap
+        },
+        "chain" : {
+            "blocks_mined" : mined,
+            "min_height" : min(heights),
+            "max_height" : max(heights),
+            "stale_rate" : round(1 - (max(heights) + 1) / float(per_block), 3),
+            "distinct_tips" : len(set(node.tip.block.hash for node in nodes \
+                if node.tip.block != None))
+        }
+    }
+    for node in nodes:
+        node.stop()
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print output
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_tps
+# measures transaction throughput in transactions per second through each
+# stage a transaction passes: admission to the mempool, being batched into a
+# block, the block being encoded for the wire and decoded by a peer, the peer
+# validating and adding the block, and inclusion proofs being built and checked
+
+# usage: bench_tps.py [-n TRANSACTIONS] [--mempool-size N] [--payload BYTES]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from block import Block
+from blockchain import Blockchain
+from blockchainmsg import BlockchainMessage
+from mempool import Mempool
+import merkle
+from transaction import Transaction
+import wirecodec
+
+SENDER = "127.0.0.1:10000"
+MAGIC_NUM = 7
+
+# creates transactions paying random fees
+# params:
+#   -count: the number of transactions
+#   -payload_size: the size of each payload in bytes
+# returns:
+#   -a list of Transactions
+def make_transactions(count, payload_size):
+    rand = random.Random(42)
+    return [Transaction("client%d" % (i % 100), ("%08d" % i).ljust(payload_size, "x"), \
+        rand.randint(0, 1000)) for i in xrange(count)]
+
+def report(label, count, seconds):
+    print "  %-28s %10.0f tx/s" % (label, count / seconds)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_tps")
+    argparser.add_argument("-n", "--transactions", type=int, default=100000)
+    argparser.add_argument("--mempool-size", dest="mempool_size", type=int, default=20000)
+    argparser.add_argument("--payload", type=int, default=64)
+    args = argparser.parse_args()
+
+    txs = make_transactions(args.transactions, args.payload)
+    print "%d transactions, %d byte payloads, %d per block, mempool of %d" % \
+        (len(txs), args.payload, Block.MAX_TRANSACTIONS, args.mempool_size)
+
+    # admission, with the lowest paying transactions evicted once the pool fills
+    mempool = Mempool(args.mempool_size, 64 * 1024 * 1024)
+    start = time.time()
+    results = [mempool.add(tx) for tx in txs]
+    report("mempool admission", len(txs), time.time() - start)
+    print "    %d added, %d rejected for paying too little, %d held" % \
+        (results.count(Mempool.TX_ADDED), results.count(Mempool.TX_FEE_TOO_LOW), \
+        len(mempool))
+
+    # the miner's side, batching the best paying transactions into blocks
+    miner = Blockchain(SENDER, mempool = mempool)
+    miner.set_magic_number(MAGIC_NUM)
+    blocks = []
+    mined = 0
+    start = time.time()
+    while len(mempool) > 0:
+        block = miner.new_block_template()
+        miner.add_block(block)
+        blocks.append(block)
+        mined += len(block.transactions)
+    report("block assembly", mined, time.time() - start)
+    print "    %d transactions in %d blocks" % (mined, len(blocks))
+
+    start = time.time()
+    encoded = wirecodec.encode_message(BlockchainMessage(SENDER, \
+        BlockchainMessage.BLOCKS, (blocks, len(blocks) - 1)))
+    report("wire encode", mined, time.time() - start)
+    start = time.time()
+    received = wirecodec.decode_message(encoded).data[0]
+    report("wire decode", mined, time.time() - start)
+    print "    %.1f bytes per transaction on the wire" % (len(encoded) / float(mined))
+
+    # a peer validating every block, hash and Merkle root, as it arrives
+    peer = Blockchain(SENDER, mempool = Mempool(args.mempool_size))
+    peer.set_magic_number(MAGIC_NUM)
+    start = time.time()
+    for block in received:
+        if peer.add_peer_block(block) != Blockchain.BLOCK_EXTENDED:
+            print "block at height %d was rejected" % block.index
+            sys.exit(1)
+    report("validate and add", mined, time.time() - start)
+
+    txids = [tx.txid for block in blocks for tx in block.transactions]
+    start = time.time()
+    proofs = [peer.get_transaction_proof(txid) for txid in txids]
+    report("build inclusion proofs", len(txids), time.time() - start)
+    start = time.time()
+    for proof in proofs:
+        if not merkle.verify_proof(proof["txid"], proof["proof"], proof["merkle_root"]):
+            print "proof for %s didn't verify" % proof["txid"]
+            sys.exit(1)
+    report("verify inclusion proofs", len(proofs), time.time() - start)
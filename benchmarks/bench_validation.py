@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_validation
+# times validating a peer's blockchain with the hashes recomputed in process,
+# across a pool of worker processes and with a checkpoint near the tip
+
+# usage: bench_validation.py [-n BLOCKS] [-w WORKERS]
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from block import Block
+from blockchain import Blockchain
+from chainvalidator import ChainValidator
+
+SENDER = "127.0.0.1:10000"
+MAGIC_NUM = 7
+
+# builds a valid chain of blocks to validate
+# params:
+#   -length: the number of blocks in the chain
+# returns:
+#   -a list of Block objects
+def build_chain(length):
+    blocks = [Block(0, 0, MAGIC_NUM, SENDER)]
+    for i in xrange(1, length):
+        blocks.append(Block(i, blocks[-1].hash, MAGIC_NUM, SENDER))
+    return blocks
+
+# times an empty blockchain examining a peer's blockchain
+# params:
+#   -chain: the peer's blockchain
+#   -validator: the ChainValidator to validate with
+# returns:
+#   -(seconds taken, true if the peer's blockchain was adopted)
+def time_examine(chain, validator):
+    blockchain = Blockchain(SENDER, validator = validator)
+    blockchain.set_magic_number(MAGIC_NUM)
+    start = time.time()
+    blockchain.examine_peer_blockchain(chain)
+    return time.time() - start, len(blockchain.blocks) == len(chain)
+
+def report(label, chain, validator):
+    seconds, adopted = time_examine(chain, validator)
+    print "  %-28s %8.3f s  %10.0f blocks/s  %s" % (label, seconds, \
+        len(chain) / seconds, "adopted" if adopted else "REJECTED")
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_validation")
+    argparser.add_argument("-n", "--blocks", type=int, default=200000)
+    argparser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count())
+    args = argparser.parse_args()
+
+    chain = build_chain(args.blocks)
+    checkpoint = len(chain) * 9 // 10
+    print "validating %d blocks" % len(chain)
+
+    serial = ChainValidator()
+    report("in process", chain, serial)
+
+    parallel = ChainValidator(args.workers)
+    report("%d worker processes" % args.workers, chain, parallel)
+
+    checkpointed = ChainValidator(args.workers, { checkpoint : chain[checkpoint].hash })
+    report("checkpoint at %d" % checkpoint, chain, checkpointed)
+
+    # a bad hash half way through should stop the check early
+    bad = list(chain)
+    middle = len(bad) // 2
+    bad[middle] = Block.restore(bad[middle].index, bad[middle].previous_hash, \
+        bad[middle].timestamp + 1, MAGIC_NUM, SENDER, bad[middle].hash)
+    report("bad block at %d" % middle, bad, parallel)
+
+    parallel.close()
+    checkpointed.close()
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# bench_wirecodec
+# compares encode/decode throughput and size of the binary wire format
+# against pickle for FULL_BLOCKCHAIN and NEW_BLOCK messages
+
+# usage: bench_wirecodec.py [-n BLOCKS] [-r ROUNDS]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from block import Block
+from blockchainmsg import BlockchainMessage
+import wirecodec
+
+SENDER = "127.0.0.1:10000"
+
+# builds a valid chain of blocks to encode
+# params:
+#   -length: the number of blocks in the chain
+# returns:
+#   -a list of Block objects
+def build_chain(length):
+    blocks = [Block(0, 0, 7, SENDER)]
+    for i in xrange(1, length):
+        blocks.append(Block(i, blocks[-1].hash, 7, SENDER))
+    return blocks
+
+# times encoding and decoding a message with one encoding
+# params:
+#   -msg: the message to encode
+#   -encoding: the encoding to use
+#   -rounds: the number of times to encode and decode
+# returns:
+#   -(encode seconds per round, decode seconds per round, encoded size)
+def time_encoding(msg, encoding, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        encoded = wirecodec.encode_message(msg, encoding)
+    encode_time = (time.time() - start) / rounds
+    start = time.time()
+    for i in xrange(rounds):
+        wirecodec.decode_message(encoded)
+    decode_time = (time.time() - start) / rounds
+    return encode_time, decode_time, len(encoded)
+
+def report(name, msg, block_count, rounds):
+    print "%s (%d blocks)" % (name, block_count)
+    for label, encoding in (("pickle", wirecodec.PICKLE_ENCODING), \
+        ("binary", wirecodec.WIRE_VERSION)):
+        encode_time, decode_time, size = time_encoding(msg, encoding, rounds)
+        print "  %-6s encode %10.0f blocks/s  decode %10.0f blocks/s  " \
+            "%7.1f bytes/block" % (label, block_count / encode_time, \
+            block_count / decode_time, float(size) / block_count)
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="bench_wirecodec")
+    argparser.add_argument("-n", "--blocks", type=int, default=10000)
+    argparser.add_argument("-r", "--rounds", type=int, default=5)
+    args = argparser.parse_args()
+
+    chain = build_chain(args.blocks)
+    report("FULL_BLOCKCHAIN", BlockchainMessage(SENDER, \
+        BlockchainMessage.FULL_BLOCKCHAIN, chain), len(chain), args.rounds)
+    report("NEW_BLOCK", BlockchainMessage(SENDER, \
+        BlockchainMessage.NEW_BLOCK, chain[-1]), 1, args.rounds * 1000)
@@ -6,32 +6,175 @@
 # class used to represent a single block in the blockchain
 
 import logging
+import merkle
 import time
 import hashlib
+from transaction import Transaction
 
 class Block(object):
 
-    def __init__(self, idx, prev_hash, data, miner):
+    # the fields every block has, difficulty and nonce are the proof of work
+    # fields which are None for blocks that weren't mined with proof of work
+    # (and for blocks from peers that predate it). merkle_root and transactions
+    # are None for blocks that carry no transactions
+    FIELDS = ("index", "previous_hash", "timestamp", "data", "mined_by", "hash", \
+        "difficulty", "nonce", "merkle_root", "transactions")
+
+    # the most transactions a block can carry
+    MAX_TRANSACTIONS = 1000
+
+    # blocks are kept by the million so they get no __dict__. header caches
+    # the hashed contents, blocks aren't changed once hashed except through
+    # set_nonce
+    __slots__ = FIELDS + ("header",)
+
+    def __init__(self, idx, prev_hash, data, miner, difficulty = None, nonce = None, \
+        transactions = None, timestamp = None):
         self.index = idx
         self.previous_hash = prev_hash
-        self.timestamp = time.time()
+        if timestamp == None:
+            timestamp = time.time()
+        self.timestamp = timestamp
         self.data = data
         self.mined_by = miner
-        self.hash = hashlib.sha256(str(self.index) + str(self.previous_hash)
-            + str(self.timestamp) + str(self.data) + self.mined_by).hexdigest()
-        
+        self.difficulty = difficulty
+        self.nonce = nonce
+        self.merkle_root = None
+        self.transactions = None
+        if transactions:
+            self.transactions = list(transactions)
+            self.merkle_root = merkle.merkle_root(self.get_txids())
+        self.header = None
+        self.hash = self.compute_hash()
+
+    # the part of the hashed contents that doesn't change while searching for
+    # a nonce
+    # returns:
+    #   -the string to hash ahead of the nonce
+    def hash_prefix(self):
+        prefix = str(self.index) + str(self.previous_hash) + str(self.timestamp) \
+            + str(self.data) + self.mined_by
+        if self.difficulty != None:
+            prefix += str(self.difficulty)
+        if self.merkle_root != None:
+            prefix += self.merkle_root
+        return prefix
+
+    # gets the canonical serialized header, the exact string that is hashed,
+    # building it the first time it is needed
+    # returns:
+    #   -the header string
+    def get_header(self):
+        if self.header == None:
+            header = self.hash_prefix()
+            if self.nonce != None:
+                header += str(self.nonce)
+            self.header = header
+        return self.header
+
+    # computes the SHA-256 hash of the block's contents
+    # returns:
+    #   -the hash as a hex string
+    def compute_hash(self):
+        return hashlib.sha256(self.get_header()).hexdigest()
+
+    # sets the proof of work nonce and rehashes the block
+    # params:
+    #   -nonce: the nonce found by the miner
+    def set_nonce(self, nonce):
+        self.nonce = nonce
+        self.header = None
+        self.hash = self.compute_hash()
+
+    # gets the ids of the block's transactions
+    # returns:
+    #   -a list of txids in block order, empty if the block has no transactions
+    def get_txids(self):
+        if self.transactions == None:
+            return []
+        return [tx.txid for tx in self.transactions]
+
+    # determines if the block's transactions are well formed and match the
+    # Merkle root its hash commits to
+    # returns:
+    #   -true if the transactions are valid or the block has none
+    def valid_transactions(self):
+        if self.transactions == None:
+            return self.merkle_root == None
+        if not isinstance(self.transactions, list) or \
+            not 0 < len(self.transactions) <= self.MAX_TRANSACTIONS:
+            return False
+        for tx in self.transactions:
+            if not isinstance(tx, Transaction) or not tx.is_valid():
+                return False
+        txids = self.get_txids()
+        if len(set(txids)) != len(txids):
+            return False
+        return merkle.merkle_root(txids) == self.merkle_root
+
+    # builds the proof that one of the block's transactions is in the block
+    # params:
+    #   -txid: the id of the transaction
+    # returns:
+    #   -the proof from merkle.merkle_proof, or None if the transaction isn't
+    #   in the block
+    def get_merkle_proof(self, txid):
+        txids = self.get_txids()
+        if txid not in txids:
+            return None
+        return merkle.merkle_proof(txids, txids.index(txid))
+
+    # recreates a block from fields received from a peer without recomputing
+    # its hash or timestamp
+    # params:
+    #   -idx, prev_hash, timestamp, data, miner, block_hash: the block's fields
+    # returns:
+    #   -the Block
+    @classmethod
+    def restore(cls, idx, prev_hash, timestamp, data, miner, block_hash, \
+        difficulty = None, nonce = None, merkle_root = None, transactions = None):
+        block = cls.__new__(cls)
+        block.index = idx
+        block.previous_hash = prev_hash
+        block.timestamp = timestamp
+        block.data = data
+        block.mined_by = miner
+        block.hash = block_hash
+        block.difficulty = difficulty
+        block.nonce = None
+        if difficulty != None:
+            block.nonce = nonce
+        block.merkle_root = merkle_root
+        block.transactions = transactions
+        block.header = None
+        return block
+
+    # the state that is pickled, a plain dict of the fields so peers whose
+    # blocks still have a __dict__ can unpickle it
+    # returns:
+    #   -a map of field name to value
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    # restores a pickled block, fields missing from blocks pickled by older
+    # peers are None
+    # params:
+    #   -state: a map of field name to value
+    def __setstate__(self, state):
+        for name in self.FIELDS:
+            setattr(self, name, state.get(name))
+        self.header = None
+
     def __repr__(self):
         return "\n{\nindex: %d,\nprevious hash: %s,\ntimestamp: %s,\ndata: %s,\n" \
                 "hash: %s,\nmined by: %s\n}" % (self.index, self.previous_hash, \
                 self.timestamp, self.data, self.hash, self.mined_by)
 
+    # blocks are equal when they hash the same contents and claim the same hash
     def __eq__(self, other):
-        if other == None:
+        if not isinstance(other, Block):
             return False
-        idx= self.index == other.index
-        p_hash = self.previous_hash == other.previous_hash
-        ts = self.timestamp == other.timestamp
-        data = self.data == other.data
-        mb = self.mined_by == other.mined_by
-        h = self.hash = other.hash
-        return idx and p_hash and ts and data and mb and h
+        return self.hash == other.hash and self.get_header() == other.get_header()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
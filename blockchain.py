@@ -6,30 +6,157 @@
 # class used to manage and represent a node's blockchain
 
 from block import Block
+from blockstore import BlockStore
+from chainsnapshot import ChainSnapshot
+from chainvalidator import ChainValidator
+import chainvalidator
+from compactchain import CompactChain
 import logging
+import powminer
 from random import SystemRandom
 
+# an unchanging view of the end of a blockchain that can be read without a lock
+class ChainTip(object):
+
+    __slots__ = ("block", "height", "work", "magic_num")
+
+    # params:
+    #   -block: the latest block, None for an empty blockchain
+    #   -height: the height of the latest block, -1 for an empty blockchain
+    #   -work: the cumulative work of the blockchain
+    #   -magic_num: the blockchain's magic number
+    def __init__(self, block, height, work, magic_num):
+        self.block = block
+        self.height = height
+        self.work = work
+        self.magic_num = magic_num
+
 class Blockchain(object):
 
     MAGIC_NUMBER_MAX = 10
+    # number of most recent block hashes included one by one in a block locator
+    # before the locator starts skipping back exponentially
+    LOCATOR_DENSE_BLOCKS = 10
+    # the most blocks kept on side branches, the lowest are dropped first
+    MAX_SIDE_BLOCKS = 5000
+    # seconds mine_block searches for a proof of work nonce before giving up
+    POW_ROUND_SECONDS = 1
+    # snapshots are only taken at heights that are a multiple of this, so
+    # nodes at nearby heights offer the same snapshot and a pruned blockchain
+    # drops blocks this many at a time
+    SNAPSHOT_INTERVAL = 100
+    # the fewest blocks a pruned blockchain may keep, it can't reorganize onto
+    # a branch forking below the blocks it keeps
+    MIN_RETAINED_BLOCKS = 100
+
+    # outcomes of add_peer_block
+    BLOCK_EXTENDED = "extended"
+    BLOCK_REORG = "reorg"
+    BLOCK_SIDE = "side branch"
+    BLOCK_KNOWN = "known"
+    BLOCK_ORPHAN = "orphan"
+    BLOCK_INVALID = "invalid"
+    BLOCK_PRUNED = "below snapshot"
 
-    def __init__(self, minerid):
-        self.rand = SystemRandom()
-        self.blocks = []
+    # params:
+    #   -minerid: the id of the node mining blocks for this blockchain
+    #   -blocks: the list of blocks to start from, a BlockStore to keep the
+    #   blocks on disk or a CompactChain to keep them in columns, an empty list
+    #   if None
+    #   -difficulty: the proof of work difficulty (leading zero bits) every block
+    #   must meet, or None to mine by guessing the magic number
+    #   -pow_miner: the PowMiner used to mine when difficulty is set
+    #   -validator: the ChainValidator that verifies block hashes and checkpoints,
+    #   one that hashes in this process without checkpoints if None
+    #   -mempool: the Mempool new blocks take their transactions from, mined
+    #   transactions are removed from it and those in blocks that are rolled
+    #   back are put back. blocks carry no transactions if None
+    #   -rand: the random number generator picking the magic number and mining
+    #   guesses, a SystemRandom if None
+    #   -retain_blocks: the number of most recent blocks prune keeps, never
+    #   pruned if None
+    #   -snapshot_path: the file the snapshot of a pruned blockchain is kept
+    #   in, loaded if it exists. the snapshot is only kept in memory if None
+    def __init__(self, minerid, blocks = None, difficulty = None, pow_miner = None, \
+        validator = None, mempool = None, rand = None, retain_blocks = None, \
+        snapshot_path = None):
+        if rand == None:
+            rand = SystemRandom()
+        self.rand = rand
+        if blocks == None:
+            blocks = []
+        # the blocks kept, from height self.base to the latest block
+        self.blocks = blocks
+        # the snapshot standing in for the blocks below self.base once the
+        # blockchain has been pruned or started from a peer's snapshot
+        self.snapshot = None
+        self.base = 0
+        self.retain_blocks = retain_blocks
+        self.snapshot_path = snapshot_path
+        # map of block hash to its height, built the first time
+        # it is needed so loading a stored blockchain doesn't read every block
+        self.height_by_hash = None
+        # map of txid to the height of the block holding it, built the first
+        # time it is needed like height_by_hash
+        self.height_by_txid = None
+        # map of miner id to the number of blocks kept that it mined, built
+        # the first time it is needed like height_by_hash
+        self.blocks_by_miner = None
+        # blocks on competing branches that aren't part of self.blocks, indexed
+        # by hash and by height along with the cumulative work of each one
+        self.side_blocks = {}
+        self.side_work = {}
+        self.side_heights = {}
         self.magic_num = None
         self.miner = minerid
+        self.difficulty = difficulty
+        self.pow_miner = pow_miner
+        if validator == None:
+            validator = ChainValidator()
+        self.validator = validator
+        self.mempool = mempool
+        if snapshot_path != None:
+            self.__load_snapshot()
+
+    # loads the snapshot of a stored pruned blockchain, dropping any stored
+    # blocks it covers that were left behind when the node stopped part way
+    # through pruning
+    # raises:
+    #   -ValueError if the snapshot is corrupt or doesn't fit the stored blocks
+    def __load_snapshot(self):
+        snapshot = ChainSnapshot.load(self.snapshot_path)
+        if snapshot == None:
+            if len(self.blocks) > 0 and self.blocks[0].index != 0:
+                raise ValueError("stored blocks start at height %d without a " \
+                    "snapshot" % self.blocks[0].index)
+            return
+        if not chainvalidator.verify_contents(snapshot.block):
+            raise ValueError("snapshot %s has the wrong hash" % self.snapshot_path)
+        self.snapshot = snapshot
+        self.base = snapshot.height + 1
+        if len(self.blocks) > 0:
+            first = self.blocks[0].index
+            if first > self.base:
+                raise ValueError("stored blocks start at height %d but the snapshot " \
+                    "ends at %d" % (first, snapshot.height))
+            if first < self.base:
+                del self.blocks[:self.base - first]
+        logging.info("loaded %r", snapshot)
 
     # sets the magin number which is the target for mining operations
     # params:
     #   -magic_num - the value to set the magic number to or generate it randomly
     #   if None
     def set_magic_number(self, magic_num = None):
-        if magic_num == None:
+        if magic_num == None and self.get_latest_block() != None:
+            # restarting with a stored blockchain, keep mining the same target
+            self.magic_num = self.get_latest_block().data
+        elif magic_num == None:
             self.magic_num = self.rand.randint(1,self.MAGIC_NUMBER_MAX)
         else:
             self.magic_num = magic_num
 
-        logging.info("set magic number to: %d" % self.magic_num)
+        logging.info("set magic number to: %d", self.magic_num)
 
     # validates a new block based on block chain semantics to determine if it 
     # can be added to the blockchain
@@ -40,64 +167,508 @@ class Blockchain(object):
     def validate_newblock(self, new_block):
         valid_idx = False
         prev_hash_match = False
+        latest_block = self.get_latest_block()
 
         #special case - first block
-        if new_block.index == 0 and len(self.blocks) == 0:
+        if new_block.index == 0 and latest_block == None:
             valid_idx = True
             prev_hash_match = new_block.previous_hash == 0
-        elif len(self.blocks) > 0: 
-            latest_block = self.blocks[-1]
+        elif latest_block != None:
             valid_idx = new_block.index == latest_block.index + 1
             prev_hash_match = latest_block.hash == new_block.previous_hash
 
         magic_num_match = new_block.data == self.magic_num
 
-        return valid_idx and prev_hash_match and magic_num_match
+        return valid_idx and prev_hash_match and magic_num_match and \
+            self.__valid_pow(new_block) and self.validator.verify_block(new_block)
+
+    # validates a block's proof of work, the hash itself is checked by the
+    # validator. a block must claim the blockchain's difficulty, and none
+    # when the blockchain doesn't use proof of work
+    # params:
+    #   -block: the block to check
+    # returns:
+    #   -true if the block claims the blockchain's difficulty and, when proof
+    #   of work is required, its hash meets it, false otherwise
+    def __valid_pow(self, block):
+        if block.difficulty != self.difficulty:
+            return False
+        return self.difficulty == None or \
+            powminer.meets_difficulty(block.hash, block.difficulty)
 
     # adds a block to the blockchain
     # params:
     #   -block: the block to be added
     def add_block(self, block):
-        self.blocks.append(block)
+        self.__extend([block])
+
+    # removes every block at or above a height from the blockchain
+    # params:
+    #   -height: the height of the first block to remove
+    def __truncate(self, height):
+        if self.height_by_hash != None or self.height_by_txid != None or \
+            self.blocks_by_miner != None or self.mempool != None:
+            for block in self.blocks[height - self.base:]:
+                if self.height_by_hash != None:
+                    self.height_by_hash.pop(block.hash, None)
+                if self.blocks_by_miner != None:
+                    self.__count_miner(block.mined_by, -1)
+                for tx in block.transactions or []:
+                    if self.height_by_txid != None:
+                        self.height_by_txid.pop(tx.txid, None)
+                    # rolled back transactions wait to be mined again
+                    if self.mempool != None:
+                        self.mempool.add(tx)
+        del self.blocks[height - self.base:]
+
+    # appends blocks to the blockchain. the blocks are stored before the
+    # indexes and the mempool are updated, so a store that fails to write them
+    # leaves the blockchain as it was
+    # params:
+    #   -blocks: the blocks to append, in order
+    def __extend(self, blocks):
+        height = self.__next_height()
+        self.blocks.extend(blocks)
+        if self.height_by_hash != None:
+            for i in range(len(blocks)):
+                self.height_by_hash[blocks[i].hash] = height + i
+        if self.blocks_by_miner != None:
+            for block in blocks:
+                self.__count_miner(block.mined_by, 1)
+        for i in range(len(blocks)):
+            txids = blocks[i].get_txids()
+            if self.height_by_txid != None:
+                for txid in txids:
+                    self.height_by_txid[txid] = height + i
+            if self.mempool != None and len(txids) > 0:
+                self.mempool.remove(txids)
+
+    # the amount of work a block represents, the expected number of hashes
+    # needed to mine it at the blockchain's difficulty. the difficulty a peer's
+    # block claims is never trusted, so every block counts the same and the
+    # best chain is the longest one
+    # params:
+    #   -block: the block to measure, None when any block will do
+    # returns:
+    #   -the block's work
+    def block_work(self, block):
+        if self.difficulty == None:
+            return 1
+        return 1 << self.difficulty
+
+    # gets the cumulative work of the blockchain
+    # returns:
+    #   -the total work of every block in the blockchain
+    def get_chain_work(self):
+        return self.__work_at(self.get_height())
+
+    # gets the cumulative work of the blockchain up to and including a height.
+    # every block counts the same, so it is worked out from the number of
+    # blocks without reading them
+    # params:
+    #   -height: the height of the block, -1 for before the genesis block and
+    #   no lower than the snapshot's block for a pruned blockchain
+    # returns:
+    #   -the cumulative work
+    def __work_at(self, height):
+        work = (height + 1 - self.base) * self.block_work(None)
+        if self.snapshot != None:
+            work += self.snapshot.work
+        return work
+
+    # gets the height the next block added to the blockchain will have
+    def __next_height(self):
+        return self.base + len(self.blocks)
+
+    # gets the height of the latest block
+    # returns:
+    #   -the height, -1 for an empty blockchain
+    def get_height(self):
+        return self.__next_height() - 1
+
+    # gets a block on the blockchain by height
+    # params:
+    #   -height: the height of the block, which may be the snapshot's block
+    # returns:
+    #   -the block
+    # raises:
+    #   -IndexError if the block has been pruned
+    def __block_at(self, height):
+        if self.snapshot != None and height == self.base - 1:
+            return self.snapshot.block
+        if height < self.base:
+            raise IndexError("block at height %d has been pruned" % height)
+        return self.blocks[height - self.base]
+
+    # gets the map of block hash to height, building it if needed. readers
+    # share the chain lock, so an index is only published once it is whole
+    # returns:
+    #   -the map of block hash to height
+    def __hash_index(self):
+        if self.height_by_hash == None:
+            height_by_hash = {}
+            if self.snapshot != None:
+                height_by_hash[self.snapshot.block.hash] = self.snapshot.height
+            for height in range(self.base, self.__next_height()):
+                height_by_hash[self.__hash_at(height)] = height
+            self.height_by_hash = height_by_hash
+        return self.height_by_hash
+
+    # gets the map of miner id to the number of blocks it mined, building it if
+    # needed
+    # returns:
+    #   -the map of miner id to block count
+    def __miner_index(self):
+        if self.blocks_by_miner == None:
+            blocks_by_miner = {}
+            for height in range(self.base, self.__next_height()):
+                miner = self.__miner_at(height)
+                blocks_by_miner[miner] = blocks_by_miner.get(miner, 0) + 1
+            self.blocks_by_miner = blocks_by_miner
+        return self.blocks_by_miner
+
+    # adds to the number of blocks a miner has mined, forgetting miners with
+    # none left
+    # params:
+    #   -miner: the miner id
+    #   -amount: what to add
+    def __count_miner(self, miner, amount):
+        count = self.blocks_by_miner.get(miner, 0) + amount
+        if count > 0:
+            self.blocks_by_miner[miner] = count
+        else:
+            self.blocks_by_miner.pop(miner, None)
+
+    # gets the map of txid to height, building it if needed
+    # returns:
+    #   -the map of txid to the height of the block holding the transaction
+    def __txid_index(self):
+        if self.height_by_txid == None:
+            height_by_txid = {}
+            for i in range(len(self.blocks)):
+                for txid in self.blocks[i].get_txids():
+                    height_by_txid[txid] = self.base + i
+            self.height_by_txid = height_by_txid
+        return self.height_by_txid
+
+    # determines if a transaction has been mined into the blockchain. a pruned
+    # blockchain no longer knows what was mined below its snapshot, so any
+    # transaction created before the snapshot's block is taken to have been
+    # params:
+    #   -txid: the id of the transaction
+    #   -timestamp: when the transaction was created, None if unknown
+    # returns:
+    #   -true if a block in the blockchain holds the transaction
+    def has_transaction(self, txid, timestamp = None):
+        if self.snapshot != None and timestamp != None and \
+            timestamp <= self.snapshot.block.timestamp:
+            return True
+        return self.__txid_index().has_key(txid)
+
+    # builds the proof that a transaction is in the blockchain, which can be
+    # checked against the block's Merkle root with merkle.verify_proof
+    # params:
+    #   -txid: the id of the transaction
+    # returns:
+    #   -a map with the txid, the hash, height and Merkle root of the block
+    #   holding it and the proof, or None if the transaction isn't in the
+    #   blockchain
+    def get_transaction_proof(self, txid):
+        height = self.__txid_index().get(txid)
+        if height == None:
+            return None
+        block = self.__block_at(height)
+        return {
+            "txid" : txid,
+            "block_hash" : block.hash,
+            "height" : height,
+            "merkle_root" : block.merkle_root,
+            "proof" : block.get_merkle_proof(txid)
+        }
+
+    # gets the hash of the block at a height, without creating a Block when the
+    # blocks are kept in a CompactChain or a BlockStore
+    # params:
+    #   -height: the height of the block
+    # returns:
+    #   -the block's hash
+    def __hash_at(self, height):
+        if self.snapshot != None and height == self.base - 1:
+            return self.snapshot.block.hash
+        if height < self.base:
+            raise IndexError("block at height %d has been pruned" % height)
+        if isinstance(self.blocks, (CompactChain, BlockStore)):
+            return self.blocks.hash_at(height - self.base)
+        return self.blocks[height - self.base].hash
+
+    # gets the id of the miner of the block at a height, without creating a
+    # Block when the blocks are kept in a CompactChain
+    # params:
+    #   -height: the height of the block, at or above self.base
+    # returns:
+    #   -the miner id
+    def __miner_at(self, height):
+        if isinstance(self.blocks, CompactChain):
+            return self.blocks.miner_at(height - self.base)
+        return self.blocks[height - self.base].mined_by
+
+    # gets the hash of the block at a height
+    # params:
+    #   -height: the height of the block
+    # returns:
+    #   -the block's hash, None if there is no block at that height or it has
+    #   been pruned
+    def get_hash_at(self, height):
+        if height < self.base - 1 or height < 0 or height >= self.__next_height():
+            return None
+        return self.__hash_at(height)
+
+    # gets the block at a height
+    # params:
+    #   -height: the height of the block
+    # returns:
+    #   -the block, None if there is no block at that height or it has been
+    #   pruned
+    def get_block_at(self, height):
+        if height < self.base - 1 or height < 0 or height >= self.__next_height():
+            return None
+        return self.__block_at(height)
+
+    # gets the height of a block on the blockchain
+    # params:
+    #   -block_hash: the hash of the block
+    # returns:
+    #   -the height, None if the block isn't on the blockchain or has been
+    #   pruned
+    def get_block_height(self, block_hash):
+        return self.__hash_index().get(block_hash)
+
+    # counts the blocks each miner has mined, only the blocks kept are
+    # counted once the blockchain has been pruned
+    # returns:
+    #   -a map of miner id to the number of blocks it mined
+    def get_miner_counts(self):
+        return dict(self.__miner_index())
+
+    # adds a block received from a peer to the block tree. blocks extending the
+    # blockchain are appended, blocks extending another block we know of are
+    # kept on a side branch and if a side branch ends up with more cumulative
+    # work than the blockchain the node reorganizes onto it
+    # params:
+    #   -block: the block received
+    # returns:
+    #   -one of the BLOCK_ outcomes
+    def add_peer_block(self, block):
+        if self.has_block(block.hash):
+            return self.BLOCK_KNOWN
+        if block.index < 0:
+            return self.BLOCK_INVALID
+        if block.index < self.base:
+            return self.BLOCK_PRUNED
+
+        latest_block = self.get_latest_block()
+        if (latest_block == None and block.index == 0) or \
+        (latest_block != None and block.previous_hash == latest_block.hash):
+            if not self.validate_newblock(block):
+                return self.BLOCK_INVALID
+            self.add_block(block)
+            return self.BLOCK_EXTENDED
+
+        if block.index == 0:
+            valid = self.__valid_segment(None, [block])
+            parent_work = 0
+        else:
+            parent = self.__find_block(block.previous_hash)
+            if parent == None:
+                return self.BLOCK_ORPHAN
+            parent_block, parent_work = parent
+            valid = self.__valid_segment(parent_block, [block])
+        if not valid:
+            return self.BLOCK_INVALID
+
+        work = parent_work + self.block_work(block)
+        self.__add_side_block(block, work)
+        if work > self.get_chain_work():
+            self.__reorg(block)
+            return self.BLOCK_REORG
+        return self.BLOCK_SIDE
+
+    # looks up a block on the blockchain or a side branch
+    # params:
+    #   -block_hash: the hash of the block
+    # returns:
+    #   -the block, or None if the block isn't known
+    def get_block(self, block_hash):
+        found = self.__find_block(block_hash)
+        if found == None:
+            return None
+        return found[0]
+
+    # determines if a block is anywhere in the block tree without reading it
+    # params:
+    #   -block_hash: the hash of the block
+    # returns:
+    #   -true if the block is known
+    def has_block(self, block_hash):
+        return self.__hash_index().has_key(block_hash) or \
+            self.side_blocks.has_key(block_hash)
+
+    # looks up a block anywhere in the block tree
+    # params:
+    #   -block_hash: the hash of the block
+    # returns:
+    #   -(block, cumulative work) or None if the block isn't known
+    def __find_block(self, block_hash):
+        height = self.__hash_index().get(block_hash)
+        if height != None:
+            return self.__block_at(height), self.__work_at(height)
+        if self.side_blocks.has_key(block_hash):
+            return self.side_blocks[block_hash], self.side_work[block_hash]
+        return None
+
+    # stores a block on a side branch, dropping the lowest side blocks if
+    # there are too many
+    # params:
+    #   -block: the block to store
+    #   -work: the cumulative work up to and including the block
+    def __add_side_block(self, block, work):
+        self.side_blocks[block.hash] = block
+        self.side_work[block.hash] = work
+        self.side_heights.setdefault(block.index, set()).add(block.hash)
+        while len(self.side_blocks) > self.MAX_SIDE_BLOCKS:
+            lowest = min(self.side_heights)
+            for block_hash in self.side_heights.pop(lowest):
+                del self.side_blocks[block_hash]
+                del self.side_work[block_hash]
+
+    # removes a block from the side branches
+    # params:
+    #   -block: the block to remove
+    def __remove_side_block(self, block):
+        del self.side_blocks[block.hash]
+        del self.side_work[block.hash]
+        hashes = self.side_heights[block.index]
+        hashes.discard(block.hash)
+        if len(hashes) == 0:
+            del self.side_heights[block.index]
+
+    # makes the side branch ending in a block the blockchain
+    # params:
+    #   -tip: the last block of the side branch
+    def __reorg(self, tip):
+        branch = [tip]
+        while self.side_blocks.has_key(branch[-1].previous_hash):
+            branch.append(self.side_blocks[branch[-1].previous_hash])
+        branch.reverse()
+        for block in branch:
+            self.__remove_side_block(block)
+        logging.info("reorganizing onto a branch of %d blocks forking at height %d", \
+            len(branch), branch[0].index)
+        self.__switch_branch(branch)
+
+    # replaces the blocks from where a branch starts with the branch, keeping the
+    # blocks that are rolled back on a side branch
+    # params:
+    #   -branch: the blocks to apply, the first one must follow on from the
+    #   block below it in the blockchain
+    def __switch_branch(self, branch):
+        # skip over blocks the branch has in common with the blockchain
+        shared = 0
+        while shared < len(branch) and branch[shared].index < self.__next_height() and \
+        self.__hash_at(branch[shared].index) == branch[shared].hash:
+            shared += 1
+        branch = branch[shared:]
+        if len(branch) == 0:
+            return
+        height = branch[0].index
+        if height < self.__next_height():
+            work = self.__work_at(height - 1)
+            for block in self.blocks[height - self.base:]:
+                work += self.block_work(block)
+                self.__add_side_block(block, work)
+        self.__truncate(height)
+        self.__extend(branch)
+        # blocks applied from a peer may have been sitting on a side branch
+        for block in branch:
+            if self.side_blocks.has_key(block.hash):
+                self.__remove_side_block(block)
 
     # gets the latest block from the blockchain
     # returns:
     #   -the leatst block from the blockchain or None if the blockchain is empty
     def get_latest_block(self):
         if len(self.blocks) == 0:
+            # a blockchain just started from a snapshot ends with its block
+            if self.snapshot != None:
+                return self.snapshot.block
             return None
         return self.blocks[-1]
 
-    # performs the "mining" operations by generating a random number within 
-    # the specified range
+    # takes a snapshot of the end of the blockchain
+    # returns:
+    #   -a ChainTip
+    def get_tip(self):
+        return ChainTip(self.get_latest_block(), self.get_height(), \
+            self.get_chain_work(), self.magic_num)
+
+    # performs the "mining" operations, either by searching for a proof of work
+    # nonce or by generating a random number within the specified range
     # returns:
     #   -a new block if mining is successful, None otherwise
     def mine_block(self):
-        random_num = self.rand.randint(1,self.MAGIC_NUMBER_MAX)
-        # random_num = self.magic_num
-        newblock = None
-        # determine if we should create a new block
-        if random_num == self.magic_num:
-            if len(self.blocks) == 0:
-                newblock = Block(0, 0, random_num, self.miner)
-            else:
-                latest_block = self.blocks[-1]
-                newblock = Block(latest_block.index + 1, \
-                    latest_block.hash, random_num, self.miner)
-
+        newblock = self.new_block_template()
+        if self.solve_block(newblock):
             self.add_block(newblock)
-        else:
-            logging.info("mining fail - generated number: %d " \
-                "doesn't match magic number: %d" % (random_num, self.magic_num))
+            return newblock
+        return None
 
-        return newblock
+    # creates a block following on from the latest block, which is what the
+    # miner works on, carrying the best paying transactions in the mempool
+    # returns:
+    #   -the new block
+    def new_block_template(self):
+        difficulty = self.difficulty
+        nonce = None
+        if difficulty != None:
+            nonce = 0
+        transactions = None
+        if self.mempool != None:
+            transactions = self.mempool.select(Block.MAX_TRANSACTIONS)
+        latest_block = self.get_latest_block()
+        if latest_block == None:
+            return Block(0, 0, self.magic_num, self.miner, difficulty, nonce, \
+                transactions)
+        return Block(latest_block.index + 1, latest_block.hash, self.magic_num, \
+            self.miner, difficulty, nonce, transactions)
+
+    # makes one mining attempt on a block without touching the blockchain, so
+    # it can run on a snapshot of the latest block outside of any lock
+    # params:
+    #   -block: the block to mine, from new_block_template
+    #   -cancel: a threading.Event that abandons a proof of work search when set
+    # returns:
+    #   -true if the block was mined (its nonce and hash are updated for proof
+    #   of work), false otherwise
+    def solve_block(self, block, cancel = None):
+        if block.difficulty == None:
+            random_num = self.rand.randint(1,self.MAGIC_NUMBER_MAX)
+            if random_num != block.data:
+                logging.info("mining fail - generated number: %d " \
+                    "doesn't match magic number: %d", random_num, block.data)
+            return random_num == block.data
+        if self.pow_miner.mine(block, self.POW_ROUND_SECONDS, cancel):
+            return True
+        stats = self.pow_miner.stats()
+        logging.info("mining fail - no nonce found at difficulty %d, hashrate: " \
+            "%.0f H/s", block.difficulty, stats["hashes_per_sec"])
+        return False
 
     # determines if the current latest block matches the passed in block
     # params:
     #   -block: the block to compare the current latest block against - generally
     #   from the GET_LATEST_BLOCK message from another peer
     def latest_block_matches(self, block):
-        latest_block = self.blocks[-1]
+        latest_block = self.get_latest_block()
         return latest_block == block
 
     # examines the list of blocks which represent a peer's blockchain, first it
@@ -106,33 +677,280 @@ class Blockchain(object):
     # params:
     #   -list of Block objects that repersent the blockchain to check
     def examine_peer_blockchain(self, listofblocks):
-        if len(listofblocks) > len(self.blocks):
-            logging.debug("blockchain received is longer than current blockchain")
-            valid = True
-            prevblock = listofblocks[0]
-            for i in range(1, len(listofblocks)):
-                currblock = listofblocks[i]
-                if currblock.index != prevblock.index + 1:
-                    valid = False
-                    break
-                if currblock.previous_hash != prevblock.hash:
-                    valid = False
-                    break
-                if currblock.data != self.magic_num:
-                    valid = False
-                    break
-                prevblock = currblock
+        peer_work = sum(self.block_work(block) for block in listofblocks)
+        if peer_work > self.get_chain_work():
+            logging.debug("blockchain received has more work than current blockchain")
+            # the common prefix is already in our blockchain, so only the blocks
+            # after it are validated and a stored blockchain isn't rewritten
+            # from the start
+            common = self.__common_prefix_len(listofblocks)
+            if common == None:
+                logging.info("blockchain received forks below my snapshot - ignoring")
+                return
+            prevblock = None
+            if common > 0:
+                prevblock = listofblocks[common - 1]
+            valid = self.__valid_segment(prevblock, listofblocks[common:])
 
             if valid:
                 logging.info("blockchain received is valid - replacing")
-                self.blocks = listofblocks
+                if common < len(listofblocks):
+                    self.__switch_branch(listofblocks[common:])
             else:
                 logging.info("blockchain received is not valid - ignoring")
         else:
             logging.debug("peer blockchain len: %d, my blockchain len %d" \
-                " - ignoring" % (len(listofblocks), len(self.blocks)))
+                " - ignoring", len(listofblocks), self.__next_height())
+
+    # finds how many blocks at the start of a peer's blockchain match ours
+    # params:
+    #   -listofblocks: the peer's blockchain
+    # returns:
+    #   -the number of leading blocks that are the same in both, None if the
+    #   peer's blockchain doesn't have the block of this one's snapshot
+    def __common_prefix_len(self, listofblocks):
+        low = 0
+        if self.snapshot != None:
+            # everything up to the snapshot's block is the same if that is
+            if len(listofblocks) <= self.snapshot.height or \
+                listofblocks[self.snapshot.height].hash != self.snapshot.block.hash:
+                return None
+            low = self.base
+        high = min(len(listofblocks), self.__next_height())
+        # blocks commit to every block before them, so the matching prefix
+        # can be found by binary search on the hashes
+        while low < high:
+            mid = (low + high + 1) // 2
+            if listofblocks[mid - 1].hash == self.__hash_at(mid - 1):
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    # validates that a list of blocks follows on from a previous block and that
+    # every block's hash is right
+    # params:
+    #   -prevblock: the block the list of blocks should follow, or None if the
+    #   list starts with the genesis block
+    #   -blocks: the blocks to check
+    # returns:
+    #   -true if every block is valid and follows on from the block before it
+    def __valid_segment(self, prevblock, blocks):
+        # the links between blocks are checked while the validator hashes them
+        def check_links():
+            prev = prevblock
+            for currblock in blocks:
+                if prev == None:
+                    if currblock.index != 0 or currblock.previous_hash != 0:
+                        return False
+                elif currblock.index != prev.index + 1 or \
+                currblock.previous_hash != prev.hash:
+                    return False
+                if currblock.data != self.magic_num:
+                    return False
+                if not self.__valid_pow(currblock):
+                    return False
+                if not self.validator.matches_checkpoint(currblock):
+                    logging.info("block at height %d doesn't match the checkpoint", \
+                        currblock.index)
+                    return False
+                prev = currblock
+            return True
+        return self.validator.verify_blocks(blocks, check_links)
+
+    # builds a block locator describing this blockchain to a peer: the hashes
+    # of the most recent blocks, then of blocks exponentially further back,
+    # ending with the genesis block, or the snapshot's block once pruned
+    # returns:
+    #   -a list of block hashes, newest first
+    def get_block_locator(self):
+        locator = []
+        height = self.get_height()
+        lowest = max(0, self.base - 1)
+        step = 1
+        while height > lowest:
+            locator.append(self.__hash_at(height))
+            if len(locator) >= self.LOCATOR_DENSE_BLOCKS:
+                step *= 2
+            height -= step
+        if self.get_height() >= 0:
+            locator.append(self.__hash_at(lowest))
+        return locator
+
+    # finds the most recent block a peer's blockchain has in common with this one
+    # params:
+    #   -locator: the block locator received from the peer
+    # returns:
+    #   -the height of the common block, or -1 if there is none
+    def find_fork_point(self, locator):
+        for block_hash in locator:
+            height = self.__hash_index().get(block_hash)
+            if height != None:
+                return height
+        return -1
+
+    # gets a bounded run of blocks following a height
+    # params:
+    #   -height: the height of the block to start after
+    #   -limit: the maximum number of blocks to return
+    #   -max_transactions: the most transactions the blocks may carry between
+    #   them, at least one block is returned regardless. unbounded if None
+    # returns:
+    #   -a list of blocks, empty if the blocks have been pruned
+    def get_blocks_after(self, height, limit, max_transactions = None):
+        if height + 1 < self.base:
+            return []
+        start = height + 1 - self.base
+        blocks = self.blocks[start:start + limit]
+        if max_transactions != None:
+            count = 0
+            for i in range(len(blocks)):
+                count += len(blocks[i].transactions or [])
+                if count > max_transactions and i > 0:
+                    return blocks[:i]
+        return blocks
+
+    # splices a run of blocks received from a peer into the block tree. a run
+    # that follows on from a block in the blockchain and gives it more work is
+    # applied in one go, anything else is added block by block so it can sit
+    # on a side branch until it has more work than the blockchain
+    # params:
+    #   -listofblocks: the run of blocks, in order
+    # returns:
+    #   -true if every block is now part of the block tree, false if the run
+    #   was invalid or didn't connect to any block we know of
+    def splice_blocks(self, listofblocks):
+        if len(listofblocks) == 0:
+            return True
+        if listofblocks[0].index < 0:
+            logging.info("blocks received start at a negative height - ignoring")
+            return False
+        if listofblocks[0].index < self.base:
+            # blocks below the snapshot are only taken as leading to its block
+            anchor = self.snapshot.height - listofblocks[0].index
+            if anchor >= len(listofblocks):
+                return True
+            if listofblocks[anchor].hash != self.snapshot.block.hash:
+                logging.info("blocks received fork below my snapshot - ignoring")
+                return False
+            listofblocks = listofblocks[anchor + 1:]
+            if len(listofblocks) == 0:
+                return True
+        first = listofblocks[0]
+        start = first.index
+        if start <= self.__next_height() and self.__work_at(start - 1) + \
+            sum(self.block_work(block) for block in listofblocks) > self.get_chain_work():
+            prevblock = None
+            if start > 0:
+                prevblock = self.__block_at(start - 1)
+            if self.__valid_segment(prevblock, listofblocks):
+                logging.info("splicing %d blocks in at height %d", \
+                    len(listofblocks), start)
+                self.__switch_branch(listofblocks)
+                return True
+
+        for block in listofblocks:
+            result = self.add_peer_block(block)
+            if result in (self.BLOCK_INVALID, self.BLOCK_ORPHAN):
+                logging.info("blocks received are %s at height %d - ignoring the " \
+                    "rest", result, block.index)
+                return False
+        return True
+
+    # works out the height of the snapshot to take so that at least a number
+    # of blocks follow it
+    # params:
+    #   -retain: the number of blocks that must follow the snapshot
+    # returns:
+    #   -the height, a multiple of SNAPSHOT_INTERVAL, negative if the
+    #   blockchain is too short
+    def __snapshot_height(self, retain):
+        height = self.get_height() - retain
+        if height < 0:
+            return -1
+        return height - height % self.SNAPSHOT_INTERVAL
 
+    # takes a snapshot for a peer to start its blockchain from
+    # params:
+    #   -retain: the number of blocks the peer wants to download after the
+    #   snapshot
+    # returns:
+    #   -a ChainSnapshot, this blockchain's own if it has been pruned past
+    #   that height, None if the blockchain is too short
+    def get_snapshot(self, retain):
+        height = max(self.__snapshot_height(retain), self.base - 1)
+        if height < 0:
+            return None
+        return ChainSnapshot(self.__block_at(height), self.__work_at(height), \
+            self.magic_num)
+
+    # drops the blocks below the last snapshot height that leaves at least
+    # retain_blocks blocks, keeping a snapshot in their place. the snapshot is
+    # saved before any block is dropped
+    # returns:
+    #   -the number of blocks dropped
+    def prune(self):
+        if self.retain_blocks == None:
+            return 0
+        height = self.__snapshot_height(self.retain_blocks)
+        if height < self.base:
+            return 0
+        snapshot = ChainSnapshot(self.__block_at(height), self.__work_at(height), \
+            self.magic_num)
+        self.__save_snapshot(snapshot)
+        count = height + 1 - self.base
+        del self.blocks[:count]
+        self.snapshot = snapshot
+        self.base = height + 1
+        # the indexes are rebuilt from the blocks that are left when needed
+        self.height_by_hash = None
+        self.height_by_txid = None
+        self.blocks_by_miner = None
+        self.__prune_side_blocks()
+        logging.info("pruned %d blocks, keeping blocks from height %d", count, self.base)
+        return count
 
+    # drops side blocks that no longer lead back to the blocks that are kept
+    def __prune_side_blocks(self):
+        index = self.__hash_index()
+        for height in sorted(self.side_heights):
+            for block_hash in list(self.side_heights[height]):
+                block = self.side_blocks[block_hash]
+                if height < self.base or not (index.has_key(block.previous_hash) or \
+                    self.side_blocks.has_key(block.previous_hash)):
+                    self.__remove_side_block(block)
 
+    # checks a snapshot offered by a peer. the history below it can't be
+    # checked, but its block must be a valid block for this blockchain and the
+    # work must be what that many blocks add up to, since every block in a
+    # blockchain needs the same work
+    # params:
+    #   -snapshot: the ChainSnapshot
+    # returns:
+    #   -true if the snapshot is valid
+    def verify_snapshot(self, snapshot):
+        block = snapshot.block
+        return snapshot.magic_num == self.magic_num and block.data == self.magic_num and \
+            self.__valid_pow(block) and self.validator.matches_checkpoint(block) and \
+            chainvalidator.verify_contents(block) and \
+            snapshot.work == (block.index + 1) * self.block_work(block)
 
+    # starts an empty blockchain from a snapshot, the blocks that follow it are
+    # then synced from peers as usual
+    # params:
+    #   -snapshot: the ChainSnapshot, checked with verify_snapshot
+    def bootstrap(self, snapshot):
+        if self.get_latest_block() != None:
+            raise ValueError("only an empty blockchain can start from a snapshot")
+        self.__save_snapshot(snapshot)
+        self.snapshot = snapshot
+        self.base = snapshot.height + 1
+        self.height_by_hash = None
+        self.height_by_txid = None
+        self.blocks_by_miner = None
+        self.__prune_side_blocks()
+        logging.info("starting from %r", snapshot)
 
+    def __save_snapshot(self, snapshot):
+        if self.snapshot_path != None:
+            snapshot.save(self.snapshot_path)
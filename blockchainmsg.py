@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# blockchainmsg
+# class used to represent a message exchanged between blockchainnodes
+
+class BlockchainMessage(object):
+
+    # protocol version advertised in PEER_INIT, peers that predate versioning
+    # send no version and are treated as version 0
+    PROTOCOL_VERSION = 9
+    # lowest protocol version that understands the binary wire format
+    BINARY_WIRE_VERSION = 1
+    # lowest protocol version that understands GET_BLOCKS_FROM
+    INCREMENTAL_SYNC_VERSION = 2
+    # lowest protocol version that understands INV and GET_DATA, older peers
+    # are sent new blocks in full
+    GOSSIP_VERSION = 3
+    # lowest protocol version that understands transactions and SUBMIT_TX
+    TX_VERSION = 4
+    # lowest protocol version that understands GET_CHAIN and CHAIN_CHUNK
+    CHAIN_STREAM_VERSION = 5
+    # lowest protocol version that understands GET_PEERS, PEERS, PING and PONG
+    PEER_EXCHANGE_VERSION = 6
+    # lowest protocol version that understands GET_TIP and TIP
+    TIP_SYNC_VERSION = 7
+    # lowest protocol version that understands GET_SNAPSHOT and SNAPSHOT
+    SNAPSHOT_VERSION = 8
+    # lowest protocol version that understands BUSY
+    BACKPRESSURE_VERSION = 9
+
+    # message types
+    PEER_INIT = 0
+    PEER_REMV = 1
+    GET_BLOCKCHAIN = 2
+    FULL_BLOCKCHAIN = 3
+    NEW_BLOCK = 4
+    GET_LATEST_BLOCK = 5
+    LATEST_BLOCK = 6
+    GET_MAGIC_NUM = 7
+    NEW_MAGIC_NUM = 8
+    PEER_INIT_ACK = 9
+    GET_BLOCKS_FROM = 10
+    BLOCKS = 11
+    INV = 12
+    GET_DATA = 13
+    SUBMIT_TX = 14
+    GET_CHAIN = 15
+    CHAIN_CHUNK = 16
+    GET_PEERS = 17
+    PEERS = 18
+    PING = 19
+    PONG = 20
+    GET_TIP = 21
+    TIP = 22
+    GET_SNAPSHOT = 23
+    SNAPSHOT = 24
+    BUSY = 25
+
+    # human readable names for each of the message types
+    TYPE_NAMES = {
+        PEER_INIT : "PEER_INIT",
+        PEER_REMV : "PEER_REMV",
+        GET_BLOCKCHAIN : "GET_BLOCKCHAIN",
+        FULL_BLOCKCHAIN : "FULL_BLOCKCHAIN",
+        NEW_BLOCK : "NEW_BLOCK",
+        GET_LATEST_BLOCK : "GET_LATEST_BLOCK",
+        LATEST_BLOCK : "LATEST_BLOCK",
+        GET_MAGIC_NUM : "GET_MAGIC_NUM",
+        NEW_MAGIC_NUM : "NEW_MAGIC_NUM",
+        PEER_INIT_ACK : "PEER_INIT_ACK",
+        GET_BLOCKS_FROM : "GET_BLOCKS_FROM",
+        BLOCKS : "BLOCKS",
+        INV : "INV",
+        GET_DATA : "GET_DATA",
+        SUBMIT_TX : "SUBMIT_TX",
+        GET_CHAIN : "GET_CHAIN",
+        CHAIN_CHUNK : "CHAIN_CHUNK",
+        GET_PEERS : "GET_PEERS",
+        PEERS : "PEERS",
+        PING : "PING",
+        PONG : "PONG",
+        GET_TIP : "GET_TIP",
+        TIP : "TIP",
+        GET_SNAPSHOT : "GET_SNAPSHOT",
+        SNAPSHOT : "SNAPSHOT",
+        BUSY : "BUSY"
+    }
+
+    def __init__(self, senderid, msg_type, data = None):
+        self.senderid = senderid
+        self.msg_type = msg_type
+        self.data = data
+
+    def __repr__(self):
+        return "{ sender: %s, type: %s, data: %s }" % (self.senderid, \
+            self.TYPE_NAMES.get(self.msg_type, self.msg_type), self.data)
@@ -5,40 +5,221 @@
 # blockchainnode
 # a peer to peer blockchain node
 
-# usage: blockchainnode [-h] [-d] [-p PORT] [--peers [PEERS [PEERS ...]]]
+# usage: blockchainnode [-h] [-d] [-p PORT] [--peers [PEERS [PEERS ...]]] [--async]
+#                       [--max-msg-size [TYPE=BYTES [TYPE=BYTES ...]]]
+#                       [--datadir DATADIR] [--fsync {always,interval,never}] [--compact]
+#                       [--pow-difficulty BITS] [--pow-workers N]
+#                       [--verify-workers N] [--checkpoint [HEIGHT:HASH [HEIGHT:HASH ...]]]
+#                       [--relay-fanout N] [--mempool-size N] [--metrics-port PORT]
+#                       [--max-peers N] [--outbound-peers N] [--prune N]
+#                       [--snapshot-quorum N] [--handler-workers N] [--listen-backlog N]
+#                       [--query-port PORT]
 
 # optional arguments:
 #   -h, --help            parameter help
 #   -d, --debug           flag that sets log level to DEBUG (INFO by default)
 #   -p PORT, --port PORT  sets the server port to listen for connections on arbitrarily selected otherwise
 #   --peers [PEERS [PEERS ...]] space seperated list of peers in the form host:port
+#   --async               serve all connections from a single threaded event loop
+#   --max-msg-size [TYPE=BYTES [TYPE=BYTES ...]] largest message accepted per message type
+#   --datadir DATADIR     directory to store the blockchain in, kept in memory otherwise
+#   --fsync {always,interval,never} when stored blocks are fsynced (interval by default)
+#   --compact             keep the blockchain in memory in compact columns instead of a list
+#   --pow-difficulty BITS mine with proof of work needing BITS leading zero bits in block hashes
+#   --pow-workers N       number of proof of work mining processes (one per core by default)
+#   --verify-workers N    number of processes hashing received blocks (one per core by default)
+#   --checkpoint [HEIGHT:HASH [HEIGHT:HASH ...]] trusted block hashes, blocks below the last aren't hashed
+#   --relay-fanout N      number of peers a block received from a peer is announced to (all by default)
+#   --mempool-size N      most transactions waiting to be mined (10000 by default)
+#   --metrics-port PORT   serve Prometheus metrics at http://127.0.0.1:PORT/metrics
+#   --max-peers N         most peers kept, inbound and outbound (32 by default)
+#   --outbound-peers N    peers to find and connect to, 0 keeps only --peers (8 by default)
+#   --prune N             keep only the last N blocks and a snapshot in place of the rest
+#   --snapshot-quorum N   peers that must offer the same snapshot before a pruned node starts from it (2 by default)
+#   --handler-workers N   threads handling received messages, 0 handles them as they are read (4 by default)
+#   --listen-backlog N    connections queued before they are accepted (128 by default)
+#   --query-port PORT     serve read only queries about the blockchain at http://127.0.0.1:PORT/
 
 import argparse
+from block import Block
 from blockchainpeer import BlockchainPeer
 from blockchainmsg import BlockchainMessage
 from blockchain import Blockchain
+from blockstore import BlockStore
+from chainsnapshot import ChainSnapshot
+import chainsnapshot
+import chainstream
+from chainvalidator import ChainValidator
+from compactchain import CompactChain
+from handlerpool import HandlerPool
+from powminer import PowMiner
+from queryapi import QueryServer
+import powminer
+from minerthread import MinerThread
+from lrucache import LRUSet
+from mempool import Mempool
+from metrics import Metrics, MetricsServer
+from peertable import PeerTable
+from ratelimit import RateLimiter
+from rwlock import RWLock
+from syncscheduler import SyncScheduler
+from transaction import Transaction
+from transport import TcpTransport
 import logging
-import pickle
+import multiprocessing
+import os
+import Queue
 import socket
 import string
-import struct
-import sys
 import threading
+import time
+import wirecodec
 
 class BlockchainNode(object):
 
-    #socket timeout in seconds
-    CONNECTION_LISTEN_TIMEOUT = 5
-    # the number of timesouts that need to occur before we ask our peers about
-    # the blockchain
-    SYNC_BLOCKCHAIN_TIMEOUTS = 10
-
-    def __init__(self, port, peers):
-        self.serverhostname = None
-        self.serverport = None
-        self.id = None
-        self.serversock = self.__init_server_socket(port)
-        self.blockchain = Blockchain(self.id)
+    # seconds between checks of the blockchain
+    MAINTAIN_INTERVAL = 5
+    # seconds between mining attempts when guessing the magic number
+    MINING_INTERVAL = 5
+    # the most blocks sent in reply to a single GET_BLOCKS_FROM
+    MAX_BLOCKS_PER_BATCH = 500
+    # the most block hashes in a single INV or GET_DATA
+    MAX_INV_HASHES = 500
+    # the most recently seen block hashes remembered
+    SEEN_BLOCKS_SIZE = 16384
+    # seconds to wait for a block asked for with GET_DATA before asking
+    # another peer that announces it
+    GET_DATA_TIMEOUT = 10
+    # seconds to wait on shutdown for PEER_REMV to be sent to peers, and for
+    # each of the miner, submit and handler threads to finish
+    PEER_DRAIN_TIMEOUT = 2
+    THREAD_JOIN_TIMEOUT = 5
+    # the most transactions carried by the blocks in a single BLOCKS message
+    MAX_TXS_PER_BATCH = 20000
+    # seconds between handing the miner a block with the latest transactions
+    # from the mempool
+    TX_REFRESH_INTERVAL = 1
+    # seconds without a chunk before a chain stream from a peer is given up on
+    CHAIN_STREAM_TIMEOUT = 30
+    # seconds between checks of the peer table, between pings of every peer
+    # and between rotations of the worst scoring outbound peer
+    PEER_MANAGE_INTERVAL = 10
+    PING_INTERVAL = 30
+    ROTATE_INTERVAL = 120
+    # seconds an outbound peer has to answer before it is dropped
+    HANDSHAKE_TIMEOUT = 30
+    # the number of best scoring peers a node with an empty blockchain asks
+    # for blocks
+    SYNC_PEERS = 3
+    # connections the listening socket queues before they are accepted
+    LISTEN_BACKLOG = 128
+    # threads handling received messages, and the most received messages
+    # waiting for one before the least urgent are shed
+    HANDLER_WORKERS = 4
+    MAX_QUEUED_MESSAGES = 1024
+    # how urgently each type of message is handled, lower first. new blocks
+    # and announcements of them come before everything else and requests
+    # for many blocks, the replies to them and transactions come last.
+    # types that aren't listed are NORMAL_PRIORITY
+    BLOCK_PRIORITY = 0
+    NORMAL_PRIORITY = 1
+    BULK_PRIORITY = 2
+    MESSAGE_PRIORITIES = {
+        BlockchainMessage.NEW_BLOCK : BLOCK_PRIORITY,
+        BlockchainMessage.INV : BLOCK_PRIORITY,
+        BlockchainMessage.TIP : BLOCK_PRIORITY,
+        BlockchainMessage.GET_DATA : BLOCK_PRIORITY,
+        BlockchainMessage.GET_BLOCKCHAIN : BULK_PRIORITY,
+        BlockchainMessage.GET_BLOCKS_FROM : BULK_PRIORITY,
+        BlockchainMessage.GET_CHAIN : BULK_PRIORITY,
+        BlockchainMessage.GET_SNAPSHOT : BULK_PRIORITY,
+        BlockchainMessage.SUBMIT_TX : BULK_PRIORITY
+    }
+    # (messages a second, burst) handled from each peer by message type, the
+    # rest are shed. senders that aren't peers share a single limit. types
+    # that aren't listed aren't limited
+    RATE_LIMITS = {
+        BlockchainMessage.PEER_INIT : (5, 50),
+        BlockchainMessage.GET_BLOCKCHAIN : (0.1, 2),
+        BlockchainMessage.NEW_BLOCK : (50, 200),
+        BlockchainMessage.GET_LATEST_BLOCK : (5, 20),
+        BlockchainMessage.GET_MAGIC_NUM : (1, 10),
+        BlockchainMessage.GET_BLOCKS_FROM : (10, 50),
+        BlockchainMessage.INV : (50, 200),
+        BlockchainMessage.GET_DATA : (50, 200),
+        BlockchainMessage.SUBMIT_TX : (1000, 5000),
+        BlockchainMessage.GET_CHAIN : (1, 10),
+        BlockchainMessage.GET_PEERS : (0.5, 5),
+        BlockchainMessage.PING : (1, 5),
+        BlockchainMessage.GET_TIP : (5, 20),
+        BlockchainMessage.TIP : (50, 200),
+        BlockchainMessage.GET_SNAPSHOT : (0.5, 5),
+        BlockchainMessage.BUSY : (5, 20)
+    }
+    # requests a peer is told with BUSY were shed, and how long it is told
+    # to wait before asking again when they were shed because the node is
+    # overloaded. a peer isn't told again about a type of request it sends
+    # while it has been told to wait, and waits at most MAX_BUSY_SECONDS
+    BUSY_TYPES = frozenset([BlockchainMessage.GET_BLOCKCHAIN, \
+        BlockchainMessage.GET_LATEST_BLOCK, BlockchainMessage.GET_BLOCKS_FROM, \
+        BlockchainMessage.GET_DATA, BlockchainMessage.GET_CHAIN, \
+        BlockchainMessage.GET_PEERS, BlockchainMessage.GET_TIP, \
+        BlockchainMessage.GET_SNAPSHOT])
+    OVERLOADED_RETRY = 1.0
+    MAX_BUSY_SECONDS = 30
+
+    # transport is how the node reaches its peers, a TcpTransport built from
+    # use_event_loop and max_msg_sizes if None. over a transport that isn't
+    # threaded, such as one from simnet.SimNetwork, the constructor returns
+    # once the node has started and stop() shuts it down. peer_table holds the
+    # addresses the node knows and bounds its peers, a PeerTable with the
+    # default limits if None. retain_blocks prunes the blockchain down to that
+    # many of its latest blocks, and a node starting with an empty blockchain
+    # then starts from a snapshot that snapshot_quorum of its peers offer.
+    # over a threaded transport received messages are handled by
+    # handler_workers threads, HANDLER_WORKERS if None, or by the thread
+    # that received them if 0. listen_backlog is the listening socket's
+    # backlog, LISTEN_BACKLOG if None. query_port serves queries about the
+    # blockchain over HTTP (queryapi.py), not served if None
+    def __init__(self, port, peers, use_event_loop = False, max_msg_sizes = None, \
+        blockstore = None, pow_difficulty = None, pow_miner = None, validator = None, \
+        relay_fanout = None, mempool = None, metrics_port = None, transport = None, \
+        peer_table = None, retain_blocks = None, snapshot_quorum = 2, \
+        handler_workers = None, listen_backlog = None, query_port = None):
+        # per message type limits on the size of received messages
+        self.max_msg_sizes = dict(wirecodec.MAX_MESSAGE_SIZES)
+        if max_msg_sizes != None:
+            self.max_msg_sizes.update(max_msg_sizes)
+        if transport == None:
+            transport = TcpTransport(use_event_loop, self.max_msg_sizes)
+        self.transport = transport
+        self.rand = transport.new_random()
+        if listen_backlog == None:
+            listen_backlog = self.LISTEN_BACKLOG
+        self.serverhostname, self.serverport = transport.listen(port, listen_backlog)
+        self.id = self.serverhostname + ":" + str(self.serverport)
+        self.blockstore = blockstore
+        self.pow_miner = pow_miner
+        self.validator = validator
+        # transactions waiting to be mined, which has its own lock and is
+        # taken after chain_lock when both are needed
+        if mempool == None:
+            mempool = Mempool()
+        self.mempool = mempool
+        snapshot_path = None
+        if isinstance(blockstore, BlockStore):
+            snapshot_path = os.path.join(blockstore.datadir, chainsnapshot.SNAPSHOT_FILE)
+        self.blockchain = Blockchain(self.id, blockstore, pow_difficulty, pow_miner, \
+            validator, mempool, self.rand, retain_blocks, snapshot_path)
+        # a pruned node with peers and nothing stored doesn't mine until it has
+        # started from a snapshot, or found it can't, so it doesn't start a
+        # blockchain of its own
+        self.awaiting_snapshot = retain_blocks != None and len(peers) > 0 and \
+            self.blockchain.get_latest_block() == None
+        self.snapshot_quorum = snapshot_quorum
+        # map of (block hash, work) of each snapshot offered to the ids of the
+        # peers that offered it
+        self.snapshot_offers = {}
         self.peers = {}
         # map of message types to handlder functions
         self.handlers = {
@@ -50,16 +231,186 @@ class BlockchainNode(object):
             BlockchainMessage.GET_LATEST_BLOCK : self.__handle_get_latest_block_msg,
             BlockchainMessage.LATEST_BLOCK : self.__handle_latest_block_msg,
             BlockchainMessage.GET_MAGIC_NUM : self.__handle_get_magic_num_msg,
-            BlockchainMessage.NEW_MAGIC_NUM : self.__handle_new_magic_num_msg
+            BlockchainMessage.NEW_MAGIC_NUM : self.__handle_new_magic_num_msg,
+            BlockchainMessage.PEER_INIT_ACK : self.__handle_peer_init_ack_msg,
+            BlockchainMessage.GET_BLOCKS_FROM : self.__handle_get_blocks_from_msg,
+            BlockchainMessage.BLOCKS : self.__handle_blocks_msg,
+            BlockchainMessage.INV : self.__handle_inv_msg,
+            BlockchainMessage.GET_DATA : self.__handle_get_data_msg,
+            BlockchainMessage.SUBMIT_TX : self.__handle_submit_tx_msg,
+            BlockchainMessage.GET_CHAIN : self.__handle_get_chain_msg,
+            BlockchainMessage.CHAIN_CHUNK : self.__handle_chain_chunk_msg,
+            BlockchainMessage.GET_PEERS : self.__handle_get_peers_msg,
+            BlockchainMessage.PEERS : self.__handle_peers_msg,
+            BlockchainMessage.PING : self.__handle_ping_msg,
+            BlockchainMessage.PONG : self.__handle_pong_msg,
+            BlockchainMessage.GET_TIP : self.__handle_get_tip_msg,
+            BlockchainMessage.TIP : self.__handle_tip_msg,
+            BlockchainMessage.GET_SNAPSHOT : self.__handle_get_snapshot_msg,
+            BlockchainMessage.SNAPSHOT : self.__handle_snapshot_msg,
+            BlockchainMessage.BUSY : self.__handle_busy_msg
         }
+        # limits on the messages handled from each peer
+        self.rate_limiter = RateLimiter(self.RATE_LIMITS)
         self.shutdown = False
-        self.sync_count = 0
+        # when to poll peers for their tips and which peer to sync from
+        self.sync = SyncScheduler(self.rand, transport.time())
+
+        # hashes of blocks this node has received, mined or announced, so
+        # duplicates are dropped before they are validated
+        self.seen_blocks = LRUSet(self.SEEN_BLOCKS_SIZE)
+        # map of block hash to when it was asked for with GET_DATA
+        self.requested_blocks = {}
+        # map of peer id to [sequence of the next chunk, time the last chunk
+        # arrived] for each peer streaming blocks to this node
+        self.chain_streams = {}
+        self.requests_lock = threading.Lock()
+        # the number of peers a block received from a peer is relayed to, None
+        # for every peer
+        self.relay_fanout = relay_fanout
+
+        # the blockchain is read under chain_lock's read side and changed under
+        # its write side. the end of the blockchain is also published in tip
+        # after every change so it can be read without the lock. the peer table
+        # has a lock of its own, taken after chain_lock when both are needed
+        self.chain_lock = RWLock()
+        self.peers_lock = threading.Lock()
+        self.tip = self.blockchain.get_tip()
+
+        # known addresses and the bounds on self.peers, the table has its own
+        # lock which is taken after peers_lock
+        if peer_table == None:
+            peer_table = PeerTable()
+        self.peer_table = peer_table
+        self.last_rotation = transport.time()
+
+        # mining runs in its own thread on a copy of the block that follows
+        # the latest block, mining_tip is the hash of the block it follows
+        self.miner = MinerThread(self.blockchain, self.MINING_INTERVAL)
+        self.mining_tip = None
+        # the mempool version the miner's block was built from and when
+        self.mining_mempool_version = None
+        self.mining_refreshed = 0
+        self.submit_thread = None
+
+        # what the node is doing, served at /metrics when metrics_port is set
+        self.metrics = Metrics()
+        self.__init_metrics()
+        self.metrics_server = None
+        if metrics_port != None:
+            self.metrics_server = MetricsServer(self.metrics, metrics_port)
+        self.query_server = None
+        if query_port != None:
+            self.query_server = QueryServer(self.blockchain, self.chain_lock, \
+                lambda: self.tip, query_port, metrics = self.metrics)
 
-        self.lock = threading.RLock()
+        # received messages wait here for a handler thread, over a transport
+        # that isn't threaded they are handled as they arrive
+        if handler_workers == None:
+            handler_workers = self.HANDLER_WORKERS
+        self.handler_pool = None
+        if transport.threaded and handler_workers > 0:
+            self.handler_pool = HandlerPool(self.__handle_queued_message, \
+                handler_workers, self.MAX_QUEUED_MESSAGES, self.__shed_queued_message)
 
         # fire up the node
         self.start(peers)
 
+    # describes the node's metrics and registers those read from elsewhere
+    def __init_metrics(self):
+        m = self.metrics
+        m.describe("messages_received_total", Metrics.COUNTER, \
+            "messages received by type")
+        m.describe("message_handle_seconds", Metrics.HISTOGRAM, \
+            "time spent handling a received message by type")
+        m.describe("message_queue_seconds", Metrics.HISTOGRAM, \
+            "time received messages waited for a handler thread by type")
+        m.describe("messages_shed_total", Metrics.COUNTER, \
+            "received messages dropped by type and whether the peer was over its " \
+            "rate limit or the node was overloaded")
+        m.describe("busy_signals_total", Metrics.COUNTER, \
+            "BUSY messages sent to and received from peers")
+        m.describe("peer_bytes_received_total", Metrics.COUNTER, \
+            "bytes of messages received by peer")
+        m.describe("peer_bytes_sent_total", Metrics.COUNTER, \
+            "bytes of messages sent by peer")
+        m.describe("peer_messages_sent_total", Metrics.COUNTER, \
+            "messages sent by type")
+        m.describe("peer_send_failures_total", Metrics.COUNTER, \
+            "failed sends by peer")
+        m.describe("peer_messages_dropped_total", Metrics.COUNTER, \
+            "messages dropped because a peer's send queue was full")
+        m.describe("peer_blocks_total", Metrics.COUNTER, \
+            "blocks received from peers by outcome")
+        m.describe("sync_requests_total", Metrics.COUNTER, \
+            "requests for missing blocks sent to peers by kind")
+        m.describe("sync_batches_total", Metrics.COUNTER, \
+            "batches of blocks received from peers by whether they were accepted")
+        m.describe("sync_polls_total", Metrics.COUNTER, \
+            "polls of the peers' tips")
+        m.describe("sync_lag_seconds", Metrics.HISTOGRAM, \
+            "time from learning a peer was ahead to catching up with it")
+        m.describe("chain_pruned_blocks_total", Metrics.COUNTER, \
+            "blocks dropped from the blockchain by pruning")
+        m.describe("snapshots_total", Metrics.COUNTER, \
+            "snapshots offered by peers by whether the node started from them")
+        m.describe("chain_stream_chunks_total", Metrics.COUNTER, \
+            "chunks of streamed blocks by direction and codec")
+        m.describe("chain_stream_bytes_total", Metrics.COUNTER, \
+            "bytes of streamed blocks by direction and whether compressed")
+        m.describe("peer_connections_total", Metrics.COUNTER, \
+            "outbound connections attempted, peers that failed, were rotated out " \
+            "and inbound peers refused because the peer table was full")
+        m.describe("peer_rtt_seconds", Metrics.HISTOGRAM, \
+            "round trip time of pings to peers")
+        m.describe("blocks_mined_total", Metrics.COUNTER, \
+            "blocks mined by whether they were added or went stale")
+        m.describe("transactions_submitted_total", Metrics.COUNTER, \
+            "transactions received by outcome")
+        m.describe("query_requests_total", Metrics.COUNTER, \
+            "queries answered by endpoint and whether they were cached")
+        m.describe("query_seconds", Metrics.HISTOGRAM, \
+            "time spent answering queries by endpoint")
+        m.register("chain_height", Metrics.GAUGE, "height of the latest block", \
+            lambda: self.tip.height)
+        m.register("chain_work", Metrics.GAUGE, "cumulative work of the blockchain", \
+            lambda: self.tip.work)
+        m.register("chain_retained_blocks", Metrics.GAUGE, \
+            "blocks kept, all of them unless the blockchain is pruned", \
+            lambda: len(self.blockchain.blocks))
+        m.register("sync_lag_blocks", Metrics.GAUGE, \
+            "blocks behind the highest tip a peer reported", \
+            lambda: self.sync.lag(self.tip))
+        m.register("peers", Metrics.GAUGE, "established peers", \
+            lambda: len(self.peers))
+        m.register("peer_addresses", Metrics.GAUGE, "addresses of other nodes known", \
+            lambda: len(self.peer_table))
+        m.register("mempool_transactions", Metrics.GAUGE, \
+            "transactions waiting to be mined", lambda: len(self.mempool))
+        m.register("mempool_bytes", Metrics.GAUGE, \
+            "bytes of transactions waiting to be mined", lambda: self.mempool.size_bytes)
+        m.register("chain_lock_read_wait_seconds_total", Metrics.COUNTER, \
+            "time spent waiting to read the blockchain", \
+            lambda: self.chain_lock.read_wait_seconds)
+        m.register("chain_lock_write_wait_seconds_total", Metrics.COUNTER, \
+            "time spent waiting to change the blockchain", \
+            lambda: self.chain_lock.write_wait_seconds)
+        m.register("mining_attempts_total", Metrics.COUNTER, \
+            "mining attempts made by the miner", lambda: self.miner.attempts)
+        m.register("bad_messages_total", Metrics.COUNTER, \
+            "connections dropped for a malformed or oversized message", \
+            lambda: self.transport.bad_messages)
+        m.register("connections_refused_total", Metrics.COUNTER, \
+            "connections closed because too many were open", \
+            lambda: self.transport.refused_connections)
+        m.register("message_queue_length", Metrics.GAUGE, \
+            "received messages waiting for a handler thread", \
+            lambda: len(self.handler_pool) if self.handler_pool != None else 0)
+        if self.pow_miner != None:
+            m.register("pow_hashes_total", Metrics.COUNTER, \
+                "proof of work hashes computed", \
+                lambda: self.pow_miner.stats()["hashes"])
+
     # starts the blockchainnode's main server listening loop, and spawing the
     # mining thread as well
     # params:
@@ -69,128 +420,363 @@ class BlockchainNode(object):
 
         if len(possiblepeers) > 0:
             logging.info("establishing peers from passed in list")
-            self.peers = self.__establish_peers(possiblepeers)
+            self.__establish_peers(possiblepeers)
         else:
-            self.blockchain.set_magic_number()
-
-        logging.info("BLOCKCHAIN NODE STARTED - %s:%d" %\
-            (self.serverhostname, self.serverport))
-        while not self.shutdown:
+            self.chain_lock.acquire_write()
             try:
-                logging.debug("listening for peer connections")
-                clientsock, clientaddr = self.serversock.accept()
-                clientsock.settimeout(None)
-                peerconn_thread = threading.Thread(target = \
-                    self.__handlepeerconnectandrecv, args = [ clientsock ])
-                peerconn_thread.start()
-            except socket.timeout:
-                self.__maintain_bc_and_mine()
-                self.lock.acquire()
-                self.sync_count = (self.sync_count + 1) % 10
-                self.lock.release()
-                continue
-            except KeyboardInterrupt:
-                logging.debug("ctrl+c pressed")
-                self.shutdown = True
-                continue
+                self.blockchain.set_magic_number()
+            finally:
+                self.__end_chain_write()
+
+        logging.info("BLOCKCHAIN NODE STARTED - %s:%d", \
+            self.serverhostname, self.serverport)
+        if self.transport.threaded:
+            self.miner.start()
+            self.submit_thread = threading.Thread(target = self.__submit_mined_blocks, \
+                name = "SubmitThread")
+            self.submit_thread.daemon = True
+            self.submit_thread.start()
+        else:
+            self.transport.call_every(self.MINING_INTERVAL, self.__mine_once)
+        self.chain_lock.acquire_write()
+        self.__end_chain_write()
+        self.transport.call_every(self.MAINTAIN_INTERVAL, self.__maintain_bc)
+        self.transport.call_every(self.PEER_MANAGE_INTERVAL, self.__manage_peers)
+        self.transport.call_every(self.PING_INTERVAL, self.__ping_peers)
+        self.transport.serve(self.__receive_message)
 
-        logging.debug("peer connection listening loop ending")
-        logging.debug("closing server socket")
-        self.serversock.close()
+        # a threaded transport serves until the node is shutting down
+        if self.transport.threaded:
+            logging.debug("peer connection listening loop ending")
+            self.shutdown = True
+            self.__close()
+
+    # shuts the node down
+    def stop(self):
+        self.shutdown = True
+        self.transport.stop()
+        if not self.transport.threaded:
+            self.__close()
+
+    # stops mining, tells peers this node is leaving and releases what the
+    # node holds once it has stopped serving. the threads that change the
+    # blockchain or send to peers are waited for first, so none of them is
+    # still running when the block store is closed or the interpreter exits
+    def __close(self):
+        self.miner.stop()
+        if self.transport.threaded:
+            # wake the submit thread rather than waiting out its timeout
+            self.miner.results.put(None)
+            self.miner.join(self.THREAD_JOIN_TIMEOUT)
+            self.submit_thread.join(self.THREAD_JOIN_TIMEOUT)
+        if self.handler_pool != None:
+            self.handler_pool.stop(self.THREAD_JOIN_TIMEOUT)
+        if self.query_server != None:
+            self.query_server.close()
         logging.info("notifying peers to remove me from their peer list")
         self.__broadcast_to_peers(BlockchainMessage.PEER_REMV)
+        deadline = time.time() + self.PEER_DRAIN_TIMEOUT
+        peers = self.__peer_list()
+        for peer in peers:
+            peer.close(max(0, deadline - time.time()))
+        # a closed peer's sender exits as soon as it wakes, even once the
+        # drain has used up its time
+        deadline = time.time() + self.THREAD_JOIN_TIMEOUT
+        for peer in peers:
+            peer.join(max(0, deadline - time.time()))
+        if self.blockstore != None:
+            self.blockstore.close()
+        if self.pow_miner != None:
+            logging.info("mining stats: %s", self.pow_miner.stats())
+            self.pow_miner.close()
+        if self.validator != None:
+            self.validator.close()
+        if self.metrics_server != None:
+            self.metrics_server.close()
 
-    # initializes the server socket for the blockchainnode
-    # params:
-    #   -port: the port on which the server socket should listen
-    #   -queue_size: the number of connections that will be queued 
-    #   (not socket.accept()'ed) before refusing connections
-    def __init_server_socket(self, port, queue_size = 5):
-        logging.debug("initializing server socket")
-        # IPv4 (AF_INET) TCP (SOCK_STREAM) socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # allow for the socket to be reclaimed before it's TIMEWAIT
-        # period is finished
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(("", port))
-        sock.settimeout(self.CONNECTION_LISTEN_TIMEOUT)
-        addrinfo = socket.getaddrinfo("", port, socket.AF_INET, socket.SOCK_STREAM)
-        sockinfo = addrinfo[0]
-        self.serverhostname = sockinfo[4][0]
-        self.serverport = sockinfo[4][1]
-        self.id = self.serverhostname + ":" + str(self.serverport)
-        sock.listen(queue_size)
-        return sock
-
-    # called when the socket times out in the main loop - this checks the blockchain
-    # sends out any messages when information is needed and attempts to mine a block
-    def __maintain_bc_and_mine(self):
-        self.lock.acquire()
-        logging.debug("number of peers: %d" % len(self.peers))
-        logging.debug("sync count = %d" % self.sync_count)
-        if self.blockchain.magic_num == None:
+    # checks the blockchain and sends out any messages when information is needed
+    def __maintain_bc(self):
+        peers = self.__peer_list()
+        tip = self.tip
+        now = self.transport.time()
+        logging.debug("number of peers: %d", len(peers))
+        if tip.magic_num == None:
             self.__broadcast_to_peers(BlockchainMessage.GET_MAGIC_NUM)
         else:
-            if len(self.blockchain.blocks) == 0 and len(self.peers) > 0:
+            if tip.block == None and len(peers) > 0 and self.awaiting_snapshot:
+                self.__request_snapshots(peers)
+            elif tip.block == None and len(peers) > 0:
                 logging.debug("blockchain is empty but I have peers - request the blockchain")
-                self.__broadcast_to_peers(BlockchainMessage.GET_BLOCKCHAIN)
-            elif self.sync_count == 9:
-                logging.debug("10 timeeouts - request the latest block")
-                self.__broadcast_to_peers(BlockchainMessage.GET_LATEST_BLOCK)
-
-            logging.debug("current blockchain length %d" % len(self.blockchain.blocks))
-            logging.debug("current blockchain: %s" % self.blockchain.blocks)
-            newblock = self.blockchain.mine_block()
-            if newblock != None:
-                logging.info("new block mined:%s" % newblock)
-                self.__broadcast_to_peers(BlockchainMessage.NEW_BLOCK, newblock)
-        self.lock.release()
-            
-    # handles an incoming connection from another blockchainnode
-    # params:
-    #   -clientsock: the client socket extracted from the accepted connection
-    def __handlepeerconnectandrecv(self, clientsock):
-        host, port = clientsock.getpeername()
-        logging.info("handling peer connection from: %s:%d" % (host, port))
-        try:
-            raw_msg = clientsock.recv(1024)
-            length = struct.unpack_from("!I", raw_msg[:4])[0]
-            bytes_recvd = len(raw_msg[4:])
-            logging.debug("length: %s, bytes_recvd: %d" % (length, bytes_recvd))
-            while bytes_recvd < length:
-                chunk = clientsock.recv(1024)
-                raw_msg += chunk
-                bytes_recvd += len(chunk)
-                logging.debug("length: %s, bytes_recvd: %d" % (length, bytes_recvd))
-
-            msg = pickle.loads(raw_msg[4:])
-
-            logging.info("received message: %s", repr(msg))
-
-            if msg.msg_type == BlockchainMessage.PEER_INIT or \
-            msg.msg_type == BlockchainMessage.PEER_REMV:
-                self.handlers[msg.msg_type](msg)
+                for peer in PeerTable.rank(peers)[:self.SYNC_PEERS]:
+                    self.__request_missing_blocks(peer)
+            elif self.sync.poll_due(now):
+                self.__poll_tips(peers, tip, now)
+
+            logging.debug("current blockchain length %d", tip.height + 1)
+            # the miner is normally given new work as the blockchain changes
+            self.chain_lock.acquire_write()
+            try:
+                pruned = self.blockchain.prune()
+            finally:
+                self.__end_chain_write()
+            if pruned > 0:
+                self.metrics.inc("chain_pruned_blocks_total", pruned)
+        # forget GET_DATA requests that were never answered
+        with self.requests_lock:
+            for block_hash, requested in self.requested_blocks.items():
+                if now - requested >= self.GET_DATA_TIMEOUT:
+                    del self.requested_blocks[block_hash]
+            for peerid, stream in self.chain_streams.items():
+                if now - stream[1] >= self.CHAIN_STREAM_TIMEOUT:
+                    logging.info("chain stream from %s stalled - giving up", peerid)
+                    del self.chain_streams[peerid]
+
+    # asks every peer for its tip, the fallback for announcements that were
+    # missed. if a peer is already known to be ahead, blocks are requested
+    # from it again in case the last request went unanswered
+    # params:
+    #   -peers: the established peers
+    #   -tip: the node's ChainTip
+    #   -now: the current time
+    def __poll_tips(self, peers, tip, now):
+        logging.debug("polling %d peers for their tips", len(peers))
+        self.metrics.inc("sync_polls_total")
+        for peer in peers:
+            if peer.protocol_version >= BlockchainMessage.TIP_SYNC_VERSION:
+                peer.send_msg(self.id, BlockchainMessage.GET_TIP)
             else:
-                peerid = msg.senderid
-                self.lock.acquire()
-                peer = None
-                if self.peers.has_key(peerid):
-                    peer = self.peers[peerid]
-                    self.lock.release()
-                    if self.handlers.has_key(msg.msg_type):
-                        self.handlers[msg.msg_type](peer, msg)
-                    else:
-                        logging.info("received unknown message type: " \
-                            "%s - doing nothing" % (str(msg.msg_type)))
-                else:
-                    logging.info("peerid not an established peer - doing nothing")
-                    self.lock.release()
-        except Exception:
-            logging.error("An exception occured handling connection/receving message")
-            raise
+                peer.send_msg(self.id, BlockchainMessage.GET_LATEST_BLOCK)
+        best = self.__best_sync_peer(tip)
+        if best != None:
+            logging.info("%s is ahead of me - requesting missing blocks", best)
+            self.__request_missing_blocks(best)
+        self.sync.polled(best != None, now)
+
+    # finds the established peer furthest ahead of the node
+    # params:
+    #   -tip: the node's ChainTip
+    # returns:
+    #   -the peer, None if no peer is known to be ahead
+    def __best_sync_peer(self, tip):
+        peerid = self.sync.best_peer(tip)
+        if peerid == None:
+            return None
+        self.peers_lock.acquire()
+        peer = self.peers.get(peerid)
+        self.peers_lock.release()
+        if peer == None:
+            self.sync.forget(peerid)
+        return peer
+
+    # finishes changing the blockchain: publishes the new tip, gives the miner
+    # new work if the latest block changed and releases the write lock. every
+    # write section calls this from a finally block, so the lock is released
+    # even when handling a message raises
+    def __end_chain_write(self):
+        try:
+            previous = self.tip.block
+            self.tip = self.blockchain.get_tip()
+            if self.tip.block != None and (previous == None or \
+                self.tip.block.hash != previous.hash):
+                logging.info("tip is now %s at height %d", self.tip.block.hash, \
+                    self.tip.height)
+                lag = self.sync.tip_changed(self.tip, self.transport.time())
+                if lag != None:
+                    logging.debug("caught up with my peers after %.3fs", lag)
+                    self.metrics.observe("sync_lag_seconds", lag)
+            self.__update_mining_work()
+        finally:
+            self.chain_lock.release_write()
+
+    # hands the miner a new block to work on if the latest block has changed
+    # since it was last given work, abandoning what it was mining. when only
+    # the mempool has changed the miner is given a block with the new
+    # transactions at most once every TX_REFRESH_INTERVAL, without abandoning
+    # its current attempt. the chain lock must be held for writing
+    def __update_mining_work(self):
+        if self.blockchain.magic_num == None or self.awaiting_snapshot:
+            return
+        latest_block = self.blockchain.get_latest_block()
+        tip = None
+        if latest_block != None:
+            tip = latest_block.hash
+        now = self.transport.time()
+        new_tip = self.miner.template == None or tip != self.mining_tip
+        new_txs = self.mempool.version != self.mining_mempool_version and \
+            now - self.mining_refreshed >= self.TX_REFRESH_INTERVAL
+        if new_tip or new_txs:
+            self.mining_tip = tip
+            self.mining_mempool_version = self.mempool.version
+            self.mining_refreshed = now
+            self.miner.set_work(self.blockchain.new_block_template(), new_tip)
+
+    # takes blocks from the miner thread as they are mined
+    def __submit_mined_blocks(self):
+        while not self.shutdown:
+            try:
+                newblock = self.miner.results.get(True, self.MAINTAIN_INTERVAL)
+            except Queue.Empty:
+                continue
+            if newblock == None or self.shutdown:
+                continue
+            self.__submit_mined_block(newblock)
+
+    # makes a single mining attempt in place of the miner thread, for
+    # transports that aren't threaded. the block is stamped with the
+    # transport's time
+    def __mine_once(self):
+        if self.miner.template == None:
+            return
+        newblock = self.miner.attempt(self.miner.template, self.transport.time())
+        if newblock != None:
+            self.__submit_mined_block(newblock)
+
+    # adds a mined block to the blockchain and broadcasts it to peers, unless
+    # the latest block changed while it was being mined
+    # params:
+    #   -newblock: the block the miner found
+    def __submit_mined_block(self, newblock):
+        self.chain_lock.acquire_write()
+        try:
+            latest_block = self.blockchain.get_latest_block()
+            added = (latest_block == None and newblock.index == 0) or \
+                (latest_block != None and newblock.previous_hash == latest_block.hash)
+            if added:
+                self.blockchain.add_block(newblock)
         finally:
-            logging.debug("cleaning up client socket")
-            clientsock.close()
+            self.__end_chain_write()
+        self.metrics.inc("blocks_mined_total", result = "added" if added else "stale")
+        if added:
+            logging.info("new block mined:%s", newblock)
+            self.__announce_block(newblock)
+        else:
+            logging.debug("dropping mined block at height %d, the latest block changed", \
+                newblock.index)
+
+    # decodes a message received by the transport and passes it to its handler
+    # params:
+    #   -payload: the encoded message
+    # raises:
+    #   -wirecodec.WireFormatError if the message is malformed
+    def __receive_message(self, payload):
+        msg = wirecodec.decode_message(payload)
+        logging.debug("received message: %s", msg)
+        self.peers_lock.acquire()
+        known = self.peers.has_key(msg.senderid)
+        self.peers_lock.release()
+        # senders that aren't peers share a limit so they can't make up ids
+        # to get around it
+        limit_key = msg.senderid if known else None
+        wait = self.rate_limiter.take(limit_key, msg.msg_type, self.transport.time())
+        if wait > 0:
+            self.__shed_message(msg, "rate limited", wait)
+        elif self.handler_pool == None:
+            self.__dispatch_message(msg, len(payload))
+        else:
+            self.handler_pool.submit(self.MESSAGE_PRIORITIES.get(msg.msg_type, \
+                self.NORMAL_PRIORITY), msg.senderid, (msg, len(payload), time.time()))
+
+    # handles a message taken from the handler pool's queue
+    # params:
+    #   -item: (message, size of the encoded message, time it was queued)
+    def __handle_queued_message(self, item):
+        msg, size, queued = item
+        self.metrics.observe("message_queue_seconds", time.time() - queued, \
+            type = BlockchainMessage.TYPE_NAMES.get(msg.msg_type, "UNKNOWN"))
+        self.__dispatch_message(msg, size)
+
+    # drops a message the handler pool's queue had no room for
+    # params:
+    #   -item: (message, size of the encoded message, time it was queued)
+    def __shed_queued_message(self, item):
+        self.__shed_message(item[0], "overloaded", self.OVERLOADED_RETRY)
+
+    # drops a received message without handling it. a peer whose request is
+    # dropped is told with BUSY when it should ask again
+    # params:
+    #   -msg: the message
+    #   -reason: why it was dropped, "rate limited" or "overloaded"
+    #   -retry_after: seconds before the node will handle the request
+    def __shed_message(self, msg, reason, retry_after):
+        msg_type = BlockchainMessage.TYPE_NAMES.get(msg.msg_type, "UNKNOWN")
+        logging.debug("%s - dropping %s from %s", reason, msg_type, msg.senderid)
+        self.metrics.inc("messages_shed_total", type = msg_type, reason = reason)
+        if msg.msg_type not in self.BUSY_TYPES:
+            return
+        self.peers_lock.acquire()
+        peer = self.peers.get(msg.senderid)
+        self.peers_lock.release()
+        if peer == None or peer.protocol_version < BlockchainMessage.BACKPRESSURE_VERSION:
+            return
+        now = self.transport.time()
+        if now < peer.busy_sent.get(msg.msg_type, 0):
+            return
+        peer.busy_sent[msg.msg_type] = now + retry_after
+        peer.send_msg(self.id, BlockchainMessage.BUSY, (msg.msg_type, float(retry_after)))
+        self.metrics.inc("busy_signals_total", direction = "sent")
+
+    # handles BUSY message type by holding off sending the peer requests for
+    # as long as it asked. a request for blocks it turned away is forgotten
+    # so they can be asked for again, from it or another peer
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is (the type of the
+    #   request that was dropped, seconds before asking again)
+    def __handle_busy_msg(self, peer, message):
+        if not isinstance(message.data, tuple) or len(message.data) != 2 or \
+        not isinstance(message.data[1], (int, long, float)):
+            logging.info("BUSY doesn't hold a message type and a delay - ignoring")
+            return
+        msg_type, retry_after = message.data
+        retry_after = max(0, min(self.MAX_BUSY_SECONDS, retry_after))
+        now = self.transport.time()
+        logging.info("%s is too busy for %s - waiting %.1fs", peer, \
+            BlockchainMessage.TYPE_NAMES.get(msg_type, msg_type), retry_after)
+        self.metrics.inc("busy_signals_total", direction = "received")
+        peer.busy_until = now + retry_after
+        if msg_type in (BlockchainMessage.GET_CHAIN, BlockchainMessage.GET_BLOCKS_FROM, \
+        BlockchainMessage.GET_BLOCKCHAIN):
+            with self.requests_lock:
+                self.chain_streams.pop(peer.id, None)
+            self.sync.hurry(now)
+
+    # passes a received message to its handler, recording how long it took
+    # params:
+    #   -msg: the message received from a peer
+    #   -size: the size of the encoded message in bytes
+    def __dispatch_message(self, msg, size):
+        start = time.time()
+        self.peers_lock.acquire()
+        peer = self.peers.get(msg.senderid)
+        self.peers_lock.release()
+        if peer != None:
+            now = self.transport.time()
+            if peer.last_heard == None:
+                self.peer_table.succeeded(peer.id, now)
+            peer.last_heard = now
+        # transactions can be submitted by clients that aren't peers
+        if msg.msg_type == BlockchainMessage.PEER_INIT or \
+        msg.msg_type == BlockchainMessage.PEER_REMV or \
+        msg.msg_type == BlockchainMessage.SUBMIT_TX:
+            self.handlers[msg.msg_type](msg)
+        elif peer != None:
+            if self.handlers.has_key(msg.msg_type):
+                self.handlers[msg.msg_type](peer, msg)
+            else:
+                logging.info("received unknown message type: " \
+                    "%s - doing nothing", msg.msg_type)
+        else:
+            logging.info("peerid not an established peer - doing nothing")
+        msg_type = BlockchainMessage.TYPE_NAMES.get(msg.msg_type, "UNKNOWN")
+        self.metrics.inc("messages_received_total", type = msg_type)
+        self.metrics.observe("message_handle_seconds", time.time() - start, \
+            type = msg_type)
+        # senders that aren't peers are lumped together so clients can't
+        # create a series each
+        peerid = "unknown"
+        if peer != None:
+            peerid = peer.id
+        self.metrics.inc("peer_bytes_received_total", size, peer = peerid)
 
     # handles the PEER_INIT message type
     # params: 
@@ -198,27 +784,62 @@ class BlockchainNode(object):
     def __handle_peer_init_msg(self, message):
         logging.debug("processing PEER_INIT message")
         peer = self.__peer_from_peerid(message.senderid)
+        version = message.data if isinstance(message.data, int) else 0
+        now = self.transport.time()
+        self.peer_table.add(peer.id, now)
 
+        refused = False
+        self.peers_lock.acquire()
         if not self.peers.has_key(peer.id):
-            logging.info("storing: %s as established peer" % repr(peer))
-            self.lock.acquire()
-            self.peers[peer.id] = peer
-            self.lock.release()
+            if len(self.peers) >= self.peer_table.max_peers:
+                refused = True
+            else:
+                logging.info("storing: %s as established peer", peer)
+                peer.connected_at = now
+                peer.last_heard = now
+                self.peers[peer.id] = peer
         else:
-            logging.debug("already established this peer: %s, ignoring" % repr(peer))
-        
+            logging.debug("already established this peer: %s", peer)
+            peer = self.peers[peer.id]
+        peer.protocol_version = version
+        self.peers_lock.release()
+        if refused:
+            self.__refuse_peer(peer)
+            return
+
+        # peers that predate versioning wouldn't understand the acknowledgement
+        if version > 0:
+            peer.send_msg(self.id, BlockchainMessage.PEER_INIT_ACK, \
+                BlockchainMessage.PROTOCOL_VERSION)
+
+    # handles PEER_INIT_ACK message type
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process
+    def __handle_peer_init_ack_msg(self, peer, message):
+        logging.debug("processing PEER_INIT_ACK message")
+        if isinstance(message.data, int):
+            logging.info("peer %s speaks protocol version %d", peer, message.data)
+            peer.protocol_version = message.data
+
     # handles PEER_REMV message type
     # params:
     #   -message: the message to process
     def __handle_peer_remv_msg(self, message):
         peeridtoremove = message.senderid
-        self.lock.acquire()
-        if self.peers.has_key(peeridtoremove):
-            logging.info("removing peer: %s" % (self.peers[peeridtoremove]))
-            del self.peers[peeridtoremove]
+        self.peers_lock.acquire()
+        peer = self.peers.pop(peeridtoremove, None)
+        self.peers_lock.release()
+        if peer != None:
+            logging.info("removing peer: %s", peer)
+            peer.close()
+            self.sync.forget(peer.id)
+            self.rate_limiter.forget(peer.id)
+            # a node that is leaving or has no room for us isn't tried again
+            # straight away
+            self.peer_table.failed(peer.id, self.transport.time())
         else:
             logging.debug("received PEER_REMV from peer not in my list - ignoring")
-        self.lock.release()
 
     # handles GET_BLOCKCHAIN message type
     # params:
@@ -226,12 +847,20 @@ class BlockchainNode(object):
     #   -message: the message to process
     def __handle_get_blockchain_msg(self, peer, message):
         logging.info("handling GET_BLOCKCHAIN message")
-        self.lock.acquire()
-        if len(self.blockchain.blocks) > 0:
-            peer.send_msg(self.id, BlockchainMessage.FULL_BLOCKCHAIN, self.blockchain.blocks)
+        self.chain_lock.acquire_read()
+        try:
+            pruned = self.blockchain.snapshot != None
+            if not pruned:
+                blocks = list(self.blockchain.blocks)
+        finally:
+            self.chain_lock.release_read()
+        if pruned:
+            logging.debug("my blockchain is pruned - ignoring message")
+            return
+        if len(blocks) > 0:
+            peer.send_msg(self.id, BlockchainMessage.FULL_BLOCKCHAIN, blocks)
         else:
             logging.debug("my blockchain is empty - ignoring message")
-        self.lock.release()
 
     # handles FULL_BLOCKCHAIN message type
     # params:
@@ -240,9 +869,12 @@ class BlockchainNode(object):
     def __handle_full_blockchain_msg(self, peer, message):
         logging.info("handling FULL_BLOCKCHAIN message")
         listofblocks = message.data
-        self.lock.acquire()
-        self.blockchain.examine_peer_blockchain(listofblocks)
-        self.lock.release()
+        self.chain_lock.acquire_write()
+        try:
+            self.blockchain.examine_peer_blockchain(listofblocks)
+        finally:
+            self.__end_chain_write()
+        self.metrics.inc("sync_batches_total", result = "full blockchain")
 
     # handles NEW_BLOCK message type
     # params:
@@ -250,15 +882,106 @@ class BlockchainNode(object):
     #   -message: the message to process
     def __handle_new_block_msg(self, peer, message):
         logging.info("handling NEW_BLOCK message")
+        if not isinstance(message.data, Block):
+            logging.info("NEW_BLOCK doesn't hold a block - ignoring")
+            return
         newblock = message.data
-        self.lock.acquire()
-        if self.blockchain.validate_newblock(newblock):
-            logging.info("new block is valid - adding")
-            self.blockchain.add_block(newblock)
+        peer.known_blocks.add(newblock.hash)
+        with self.requests_lock:
+            self.requested_blocks.pop(newblock.hash, None)
+        if self.awaiting_snapshot:
+            logging.debug("waiting for a snapshot - ignoring block %s", newblock.hash)
+            return
+        self.chain_lock.acquire_write()
+        try:
+            result = None
+            if self.seen_blocks.add(newblock.hash) or \
+            not self.blockchain.has_block(newblock.hash):
+                result = self.blockchain.add_peer_block(newblock)
+        finally:
+            self.__end_chain_write()
+        if result == None:
+            logging.debug("already seen block %s - ignoring", newblock.hash)
+            return
+        self.metrics.inc("peer_blocks_total", result = result)
+        logging.info("new block at height %d: %s", newblock.index, result)
+        if result == Blockchain.BLOCK_ORPHAN:
+            logging.info("new block doesn't connect to my blockchain - request missing blocks from peer")
+            self.__request_missing_blocks(peer)
+        elif result in (Blockchain.BLOCK_EXTENDED, Blockchain.BLOCK_REORG):
+            # only blocks that are now on our blockchain are passed on
+            self.__announce_block(newblock, self.relay_fanout)
+
+    # handles INV message type by asking for the announced blocks this node
+    # doesn't have and hasn't already asked another peer for
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is a list of block hashes
+    def __handle_inv_msg(self, peer, message):
+        logging.info("handling INV message")
+        if not isinstance(message.data, (list, tuple)) or \
+        not all(isinstance(block_hash, str) for block_hash in \
+            message.data[:self.MAX_INV_HASHES]):
+            logging.info("INV doesn't hold a list of block hashes - ignoring")
+            return
+        self.__request_announced_blocks(peer, message.data[:self.MAX_INV_HASHES])
+
+    # asks a peer for the blocks it announced that this node doesn't have
+    # and hasn't already asked another peer for
+    # params:
+    #   -peer: the peer that announced the blocks
+    #   -hashes: the hashes of the blocks
+    def __request_announced_blocks(self, peer, hashes):
+        if self.awaiting_snapshot:
+            for block_hash in hashes:
+                peer.known_blocks.add(block_hash)
+            return
+        wanted = []
+        now = self.transport.time()
+        self.chain_lock.acquire_read()
+        self.requests_lock.acquire()
+        try:
+            for block_hash in hashes:
+                peer.known_blocks.add(block_hash)
+                if block_hash in self.seen_blocks or self.blockchain.has_block(block_hash):
+                    continue
+                requested = self.requested_blocks.get(block_hash)
+                if requested != None and now - requested < self.GET_DATA_TIMEOUT:
+                    continue
+                self.requested_blocks[block_hash] = now
+                wanted.append(block_hash)
+        finally:
+            self.requests_lock.release()
+            self.chain_lock.release_read()
+        if len(wanted) > 0:
+            peer.send_msg(self.id, BlockchainMessage.GET_DATA, wanted)
         else:
-            logging.info("new block received is not valid - request block chain from peers")
-            self.__broadcast_to_peers(BlockchainMessage.GET_BLOCKCHAIN)
-        self.lock.release()
+            logging.debug("already have or asked for every announced block")
+
+    # handles GET_DATA message type by sending each requested block that this
+    # node has, on its blockchain or a side branch
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is a list of block hashes
+    def __handle_get_data_msg(self, peer, message):
+        logging.info("handling GET_DATA message")
+        if not isinstance(message.data, (list, tuple)) or \
+        not all(isinstance(block_hash, str) for block_hash in \
+            message.data[:self.MAX_INV_HASHES]):
+            logging.info("GET_DATA doesn't hold a list of block hashes - ignoring")
+            return
+        blocks = []
+        self.chain_lock.acquire_read()
+        try:
+            for block_hash in message.data[:self.MAX_INV_HASHES]:
+                block = self.blockchain.get_block(block_hash)
+                if block != None:
+                    blocks.append(block)
+        finally:
+            self.chain_lock.release_read()
+        for block in blocks:
+            peer.known_blocks.add(block.hash)
+            peer.send_msg(self.id, BlockchainMessage.NEW_BLOCK, block)
 
     #handles GET_LATEST_BLOCK message type
     #params:
@@ -266,13 +989,11 @@ class BlockchainNode(object):
     #   -message: the message to process
     def __handle_get_latest_block_msg(self, peer, message):
         logging.info("handling GET_LATEST_BLOCK message")
-        self.lock.acquire()
-        latest_block = self.blockchain.get_latest_block()
+        latest_block = self.tip.block
         if latest_block == None:
             logging.debug("no latest block to send - ignoring")
         else:
             peer.send_msg(self.id, BlockchainMessage.LATEST_BLOCK, latest_block)
-        self.lock.release()
 
     #handles LATEST_BLOCK message type
     #params:
@@ -280,26 +1001,423 @@ class BlockchainNode(object):
     #   -message: the message to process
     def __handle_latest_block_msg(self, peer, message):
         logging.info("handling LATEST_BLOCK message")
+        if not isinstance(message.data, Block):
+            logging.info("LATEST_BLOCK doesn't hold a block - ignoring")
+            return
         peer_latest_block = message.data
-        self.lock.acquire()
-        if self.blockchain.latest_block_matches(peer_latest_block):
+        tip = self.tip
+        if tip.block == peer_latest_block:
             logging.info("latest block matches - I'm up to date")
+            return
+        # the peer doesn't say how much work its blockchain has, so it is
+        # only synced from if its blockchain is at least as long
+        ahead = self.sync.peer_tip(peer.id, peer_latest_block.hash, \
+            peer_latest_block.index, None, tip, self.transport.time())
+        if ahead or (peer_latest_block.index == tip.height and \
+            not self.__has_block(peer_latest_block.hash)):
+            logging.info("my latest block didn't match peers latest - requesting missing blocks")
+            self.__request_missing_blocks(peer)
+        else:
+            logging.debug("%s is behind me", peer)
+
+    # handles GET_TIP message type by telling the peer about our latest block
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process
+    def __handle_get_tip_msg(self, peer, message):
+        tip = self.tip
+        if tip.block != None:
+            peer.send_msg(self.id, BlockchainMessage.TIP, \
+                (tip.block.hash, tip.height, tip.work))
+
+    # handles TIP message type, sent when a peer's latest block changes or in
+    # answer to GET_TIP. a peer with more work than us is asked for the block
+    # if it is the only one we're missing and synced from if we're missing
+    # more, anything else needs nothing from us
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is (block hash, height,
+    #   cumulative work)
+    def __handle_tip_msg(self, peer, message):
+        if not isinstance(message.data, tuple) or len(message.data) != 3 or \
+        not isinstance(message.data[0], str) or \
+        not isinstance(message.data[1], (int, long)) or \
+        not isinstance(message.data[2], (int, long)):
+            logging.info("TIP doesn't hold a hash, a height and work - ignoring")
+            return
+        block_hash, height, work = message.data
+        logging.debug("%s has tip %s at height %d", peer, block_hash, height)
+        peer.known_blocks.add(block_hash)
+        tip = self.tip
+        now = self.transport.time()
+        if not self.sync.peer_tip(peer.id, block_hash, height, work, tip, now):
+            return
+        if height == tip.height + 1:
+            self.__request_announced_blocks(peer, [block_hash])
+        elif not self.__has_block(block_hash):
+            logging.info("%s is %d blocks ahead of me - requesting missing blocks", \
+                peer, height - tip.height)
+            self.__request_missing_blocks(peer)
+            self.sync.hurry(now)
+
+    # determines if a block is on the blockchain or a side branch
+    def __has_block(self, block_hash):
+        self.chain_lock.acquire_read()
+        known = self.blockchain.has_block(block_hash)
+        self.chain_lock.release_read()
+        return known
+
+    # asks the best peers that can send one for a snapshot to start from,
+    # giving up on snapshots once every peer has said which protocol version
+    # it speaks and none of them can
+    # params:
+    #   -peers: the established peers
+    def __request_snapshots(self, peers):
+        able = [peer for peer in PeerTable.rank(peers) \
+            if peer.protocol_version >= BlockchainMessage.SNAPSHOT_VERSION]
+        if len(able) == 0:
+            if all(peer.protocol_version > 0 for peer in peers):
+                logging.info("no peer can send a snapshot - syncing the whole blockchain")
+                self.__stop_awaiting_snapshot(peers)
+            return
+        logging.debug("asking %d peers for a snapshot", len(able))
+        for peer in able[:max(self.SYNC_PEERS, self.snapshot_quorum)]:
+            peer.send_msg(self.id, BlockchainMessage.GET_SNAPSHOT, \
+                self.blockchain.retain_blocks)
+
+    # lets the node mine and sync as usual when it won't start from a snapshot
+    # params:
+    #   -peers: the peers to request the blockchain from
+    def __stop_awaiting_snapshot(self, peers):
+        self.chain_lock.acquire_write()
+        try:
+            self.awaiting_snapshot = False
+        finally:
+            self.__end_chain_write()
+        for peer in peers:
+            self.__request_missing_blocks(peer)
+
+    # handles GET_SNAPSHOT message type by offering the peer a snapshot to
+    # start its blockchain from
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is the number of blocks
+    #   the peer wants to download after the snapshot
+    def __handle_get_snapshot_msg(self, peer, message):
+        logging.info("handling GET_SNAPSHOT message")
+        retain = message.data
+        if not isinstance(retain, int) or retain < 0:
+            logging.info("GET_SNAPSHOT doesn't hold a block count - ignoring")
+            return
+        self.chain_lock.acquire_read()
+        snapshot = self.blockchain.get_snapshot(retain)
+        self.chain_lock.release_read()
+        if snapshot == None or snapshot.magic_num == None:
+            peer.send_msg(self.id, BlockchainMessage.SNAPSHOT, None)
         else:
-            logging.info("my latest block didn't match peers latest - requesting the blockchain")
-            self.__broadcast_to_peers(BlockchainMessage.GET_BLOCKCHAIN)
-        self.lock.release()
+            peer.send_msg(self.id, BlockchainMessage.SNAPSHOT, snapshot.to_wire())
+
+    # handles SNAPSHOT message type. a valid snapshot is started from once
+    # snapshot_quorum peers have offered it, or a checkpoint vouches for it,
+    # and the blocks after it are then requested from those peers. a peer
+    # whose blockchain is too short for a snapshot is synced from in full
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is (block, work, magic
+    #   number) or None
+    # raises:
+    #   -wirecodec.WireFormatError if the data isn't a snapshot
+    def __handle_snapshot_msg(self, peer, message):
+        logging.info("handling SNAPSHOT message")
+        if not self.awaiting_snapshot:
+            logging.debug("not waiting for a snapshot - ignoring")
+            return
+        if message.data == None:
+            logging.info("%s has no snapshot to offer - syncing its blockchain", peer)
+            self.__stop_awaiting_snapshot([peer])
+            return
+        snapshot = ChainSnapshot.from_wire(message.data)
+        self.chain_lock.acquire_write()
+        try:
+            if not self.awaiting_snapshot:
+                return
+            if not self.blockchain.verify_snapshot(snapshot):
+                logging.info("snapshot from %s at height %d is invalid - ignoring", \
+                    peer, snapshot.height)
+                self.metrics.inc("snapshots_total", result = "invalid")
+                return
+            offers = self.snapshot_offers.setdefault((snapshot.block.hash, \
+                snapshot.work), set())
+            offers.add(peer.id)
+            checkpointed = self.blockchain.validator.checkpoints.get(snapshot.height) \
+                == snapshot.block.hash
+            if len(offers) < self.snapshot_quorum and not checkpointed:
+                logging.info("snapshot at height %d offered by %d of %d peers needed", \
+                    snapshot.height, len(offers), self.snapshot_quorum)
+                self.metrics.inc("snapshots_total", result = "waiting")
+                return
+            self.blockchain.bootstrap(snapshot)
+            self.awaiting_snapshot = False
+            self.snapshot_offers = {}
+        finally:
+            self.__end_chain_write()
+        self.metrics.inc("snapshots_total", result = "started")
+        self.peers_lock.acquire()
+        sources = [self.peers[peerid] for peerid in offers if self.peers.has_key(peerid)]
+        self.peers_lock.release()
+        for source in sources:
+            self.__request_missing_blocks(source)
+
+    # handles GET_BLOCKS_FROM message type by replying with the blocks that
+    # follow the most recent block the peer's locator has in common with us
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is a block locator
+    def __handle_get_blocks_from_msg(self, peer, message):
+        logging.info("handling GET_BLOCKS_FROM message")
+        self.chain_lock.acquire_read()
+        try:
+            fork_height = self.blockchain.find_fork_point(message.data)
+            blocks = self.blockchain.get_blocks_after(fork_height, \
+                self.MAX_BLOCKS_PER_BATCH, self.MAX_TXS_PER_BATCH)
+            tip_height = self.blockchain.get_height()
+        finally:
+            self.chain_lock.release_read()
+        logging.debug("sending %d blocks after height %d", len(blocks), fork_height)
+        peer.send_msg(self.id, BlockchainMessage.BLOCKS, (blocks, tip_height))
+
+    # handles BLOCKS message type, splicing the blocks into the blockchain and
+    # asking for the next batch if the peer has more
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is (blocks, peer tip height)
+    def __handle_blocks_msg(self, peer, message):
+        logging.info("handling BLOCKS message")
+        if not isinstance(message.data, tuple) or len(message.data) != 2 or \
+        not isinstance(message.data[0], list) or \
+        not isinstance(message.data[1], (int, long)) or \
+        not all(isinstance(block, Block) for block in message.data[0]):
+            logging.info("BLOCKS doesn't hold a list of blocks and a height - ignoring")
+            return
+        blocks, peer_height = message.data
+        if len(blocks) == 0:
+            logging.debug("peer has no blocks past my blockchain")
+            return
+        self.chain_lock.acquire_write()
+        try:
+            accepted = self.blockchain.splice_blocks(blocks)
+        finally:
+            self.__end_chain_write()
+        self.metrics.inc("sync_batches_total", result = \
+            "accepted" if accepted else "rejected")
+        # blocks that didn't make the blockchain longer yet are kept on a side
+        # branch, so carry on from the last one received
+        if accepted and blocks[-1].index < peer_height:
+            logging.debug("peer has blocks up to %d - requesting the next batch", peer_height)
+            peer.send_msg(self.id, BlockchainMessage.GET_BLOCKS_FROM, [blocks[-1].hash])
+
+    # handles GET_CHAIN message type by streaming the blocks that follow the
+    # most recent block the peer's locator has in common with us, in chunks
+    # compressed with the first codec the peer offers that we understand
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is (block locator, codecs)
+    def __handle_get_chain_msg(self, peer, message):
+        logging.info("handling GET_CHAIN message")
+        if not isinstance(message.data, tuple) or len(message.data) != 2 or \
+        not isinstance(message.data[0], list) or \
+        not isinstance(message.data[1], list) or \
+        not all(isinstance(block_hash, str) for block_hash in message.data[0]):
+            logging.info("GET_CHAIN doesn't hold a block locator and codecs - ignoring")
+            return
+        locator, codecs = message.data
+        self.chain_lock.acquire_read()
+        try:
+            fork_height = self.blockchain.find_fork_point(locator)
+        finally:
+            self.chain_lock.release_read()
+        codec = chainstream.choose_codec(codecs)
+        logging.debug("streaming blocks after height %d with %s", fork_height, codec)
+        peer.send_stream(self.id, BlockchainMessage.CHAIN_CHUNK, \
+            self.__chain_chunks(fork_height, codec))
+
+    # produces the chunks of a chain stream one at a time, as the peer's
+    # sender thread asks for them. each chunk is held back until the next is
+    # ready so the last can be marked final
+    # params:
+    #   -height: the height of the block the stream starts after
+    #   -codec: the codec to compress the chunks with
+    # returns:
+    #   -a generator of CHAIN_CHUNK data, (sequence, codec, compressed chunk,
+    #   tip height, final)
+    def __chain_chunks(self, height, codec):
+        sequence = 0
+        previous = None
+        for chunk, count in chainstream.encode_chunks(self.__stream_blocks(height)):
+            if previous != None:
+                yield self.__chain_chunk(sequence, codec, previous, False)
+                sequence += 1
+            previous = chunk
+        yield self.__chain_chunk(sequence, codec, previous or "", True)
+
+    # compresses a chunk of a chain stream and counts it
+    # returns:
+    #   -the CHAIN_CHUNK data
+    def __chain_chunk(self, sequence, codec, chunk, final):
+        data = chainstream.compress(chunk, codec)
+        self.metrics.inc("chain_stream_chunks_total", direction = "sent", codec = codec)
+        self.metrics.inc("chain_stream_bytes_total", len(chunk), direction = "sent", \
+            form = "raw")
+        self.metrics.inc("chain_stream_bytes_total", len(data), direction = "sent", \
+            form = "compressed")
+        return sequence, codec, data, self.tip.height, final
+
+    # reads the blockchain after a height a batch at a time, holding the read
+    # lock only while a batch is read. the stream ends early if the blocks
+    # already read are no longer on the blockchain
+    # params:
+    #   -height: the height of the block to start after
+    # returns:
+    #   -a generator of blocks
+    def __stream_blocks(self, height):
+        last_hash = None
+        while not self.shutdown:
+            self.chain_lock.acquire_read()
+            if last_hash != None and self.blockchain.get_hash_at(height) != last_hash:
+                self.chain_lock.release_read()
+                logging.info("blockchain changed under a chain stream - ending it " \
+                    "at height %d", height)
+                return
+            blocks = self.blockchain.get_blocks_after(height, \
+                self.MAX_BLOCKS_PER_BATCH, self.MAX_TXS_PER_BATCH)
+            self.chain_lock.release_read()
+            if len(blocks) == 0:
+                return
+            for block in blocks:
+                yield block
+            height = blocks[-1].index
+            last_hash = blocks[-1].hash
+
+    # handles CHAIN_CHUNK message type, decompressing the chunk and splicing
+    # its blocks into the blockchain as it arrives. the stream is dropped if
+    # a chunk is out of order or rejected, and asked for again from where it
+    # left off if the peer had more blocks than it sent
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is (sequence, codec,
+    #   compressed chunk, peer tip height, final)
+    # raises:
+    #   -wirecodec.WireFormatError if the data or the chunk is malformed
+    def __handle_chain_chunk_msg(self, peer, message):
+        logging.debug("handling CHAIN_CHUNK message")
+        if not isinstance(message.data, tuple) or len(message.data) != 5 or \
+        not isinstance(message.data[0], (int, long)) or \
+        not isinstance(message.data[1], str) or \
+        not isinstance(message.data[2], str) or \
+        not isinstance(message.data[3], (int, long)) or \
+        not isinstance(message.data[4], bool):
+            with self.requests_lock:
+                self.chain_streams.pop(peer.id, None)
+            raise wirecodec.WireFormatError("CHAIN_CHUNK doesn't hold a sequence, " \
+                "codec, chunk, height and final flag")
+        sequence, codec, data, peer_height, final = message.data
+        with self.requests_lock:
+            stream = self.chain_streams.get(peer.id)
+            if stream == None or stream[0] != sequence:
+                logging.info("unexpected chunk %s from %s - ignoring", sequence, peer)
+                return
+            stream[0] += 1
+            stream[1] = self.transport.time()
+            if final:
+                del self.chain_streams[peer.id]
+        try:
+            chunk = chainstream.decompress(data, codec)
+            blocks = list(chainstream.decode_blocks(chunk))
+        except wirecodec.WireFormatError:
+            with self.requests_lock:
+                self.chain_streams.pop(peer.id, None)
+            raise
+        self.metrics.inc("chain_stream_chunks_total", direction = "received", \
+            codec = codec)
+        self.metrics.inc("chain_stream_bytes_total", len(chunk), \
+            direction = "received", form = "raw")
+        self.metrics.inc("chain_stream_bytes_total", len(data), \
+            direction = "received", form = "compressed")
+        if len(blocks) == 0:
+            logging.debug("peer has no blocks past my blockchain")
+            return
+        for block in blocks:
+            peer.known_blocks.add(block.hash)
+        self.chain_lock.acquire_write()
+        try:
+            accepted = self.blockchain.splice_blocks(blocks)
+        finally:
+            self.__end_chain_write()
+        self.metrics.inc("sync_batches_total", result = \
+            "accepted" if accepted else "rejected")
+        logging.info("chunk %d from %s: %d blocks up to height %d %s", sequence, peer, \
+            len(blocks), blocks[-1].index, "accepted" if accepted else "rejected")
+        if not accepted:
+            with self.requests_lock:
+                self.chain_streams.pop(peer.id, None)
+        elif final and blocks[-1].index < peer_height:
+            logging.debug("peer has blocks up to %d - requesting the rest", peer_height)
+            self.__request_missing_blocks(peer)
+
+    # handles GET_PEERS message type by sending the peer addresses of other
+    # nodes to try
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process
+    def __handle_get_peers_msg(self, peer, message):
+        logging.debug("handling GET_PEERS message")
+        peer.send_msg(self.id, BlockchainMessage.PEERS, self.__shareable_addresses(peer.id))
+
+    # handles PEERS message type by remembering the addresses it carries
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is a list of host:port
+    def __handle_peers_msg(self, peer, message):
+        logging.debug("handling PEERS message")
+        if not isinstance(message.data, list):
+            logging.info("PEERS doesn't hold a list of addresses - ignoring")
+            return
+        now = self.transport.time()
+        learned = 0
+        for peerid in message.data[:PeerTable.MAX_SHARED]:
+            if isinstance(peerid, str) and string.count(peerid, ":") == 1 and \
+            peerid.partition(":")[2].isdigit() and peerid != self.id:
+                self.peer_table.add(peerid, now)
+                learned += 1
+        logging.info("%s sent %d addresses, %d known", peer, learned, len(self.peer_table))
+
+    # handles PING message type by echoing its nonce back
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is a nonce
+    def __handle_ping_msg(self, peer, message):
+        peer.send_msg(self.id, BlockchainMessage.PONG, message.data)
+
+    # handles PONG message type by updating the peer's round trip time
+    # params:
+    #   -peer: the peer who sent the message
+    #   -message: the message to process, its data is the nonce of our PING
+    def __handle_pong_msg(self, peer, message):
+        rtt = peer.pong_received(message.data, self.transport.time())
+        if rtt != None:
+            self.metrics.observe("peer_rtt_seconds", rtt)
+
     # handles GET_MAGIC_NUM message type
     # params:
     #   -peer: the peer who sent the message
     #   -message: the message to process
     def __handle_get_magic_num_msg(self, peer, message):
         logging.info("handling GET_MAGIC_NUM message")
-        self.lock.acquire()
-        if self.blockchain.magic_num != None:
-            peer.send_msg(self.id, BlockchainMessage.NEW_MAGIC_NUM, self.blockchain.magic_num)
+        magic_num = self.tip.magic_num
+        if magic_num != None:
+            peer.send_msg(self.id, BlockchainMessage.NEW_MAGIC_NUM, magic_num)
         else:
             logging.debug("my magic num isn't set - ignoring message")
-        self.lock.release()
 
     # handles NEW_MAGIC_NUM message type
     # params:
@@ -308,32 +1426,196 @@ class BlockchainNode(object):
     def __handle_new_magic_num_msg(self, peer, message):
         logging.info("handling NEW_MAGIC_NUM message")
         magic_num = message.data
-        self.lock.acquire()
-        self.blockchain.set_magic_number(magic_num)
-        self.lock.release()
+        self.chain_lock.acquire_write()
+        try:
+            self.blockchain.set_magic_number(magic_num)
+        finally:
+            self.__end_chain_write()
+
+    # handles SUBMIT_TX message type by adding the transaction to the mempool
+    # and relaying it to peers if it is new
+    # params:
+    #   -message: the message to process, its data is a Transaction
+    def __handle_submit_tx_msg(self, message):
+        logging.debug("handling SUBMIT_TX message")
+        tx = message.data
+        if not isinstance(tx, Transaction):
+            logging.info("SUBMIT_TX doesn't hold a transaction - ignoring")
+            return
+        self.chain_lock.acquire_read()
+        try:
+            mined = self.blockchain.has_transaction(tx.txid, tx.timestamp)
+        finally:
+            self.chain_lock.release_read()
+        if mined:
+            logging.debug("transaction %s is already mined - ignoring", tx.txid)
+            self.metrics.inc("transactions_submitted_total", result = "mined")
+            return
+        result = self.mempool.add(tx)
+        self.metrics.inc("transactions_submitted_total", result = result)
+        logging.debug("transaction %s: %s", tx.txid, result)
+        if result != Mempool.TX_ADDED:
+            return
+        if self.transport.time() - self.mining_refreshed >= self.TX_REFRESH_INTERVAL:
+            self.chain_lock.acquire_write()
+            self.__end_chain_write()
+        self.__relay_transaction(tx, message.senderid)
+
+    # passes a new transaction on to peers that understand transactions, the
+    # mempool drops transactions it already has so relaying stops there
+    # params:
+    #   -tx: the transaction to relay
+    #   -senderid: the id of whoever sent it, which it isn't relayed back to
+    def __relay_transaction(self, tx, senderid):
+        peers = [peer for peer in self.__peer_list() if peer.id != senderid and \
+            peer.protocol_version >= BlockchainMessage.TX_VERSION]
+        if self.relay_fanout != None and len(peers) > self.relay_fanout:
+            peers = self.rand.sample(peers, self.relay_fanout)
+        for peer in peers:
+            peer.send_msg(self.id, BlockchainMessage.SUBMIT_TX, tx)
 
-    # attemps to establish a connection and store references to peers
+    # attemps to establish a connection and store references to peers. each
+    # connection is opened by its peer's sender thread, so they are all
+    # attempted at once and retried with a backoff. a peer that can't be
+    # reached is dropped and tried again later from the peer table
     # params:
     #   -peerlist: command line supplied list of peers, each peer is in the 
     #   form <host>:<port>
-    # returns:
-    #   -a dictionary of id's to BlockchainPeer objects
     def __establish_peers(self, peerlist):
-        established_peers = {}
-        for peer in peerlist:
-            peer = self.__peer_from_peerid(peer)
-            if peer != None:
-                try:
-                    peer.send_msg(self.id, BlockchainMessage.PEER_INIT)
-                    established_peers[peer.id] = peer
-                except socket.error as e:
-                    logging.error("socket error sending message to potential peer: %s" % e)
-                    logging.info("check the validity of peers passed in from the command line")
-                    sys.exit(1)
-            else:
+        for peerid in peerlist:
+            if string.count(peerid, ":") != 1:
                 raise AttributeError("invalid peer format, expecting host:port")
+        for peerid in peerlist:
+            self.__connect_peer(peerid)
+
+    # opens an outbound connection to a node by sending it PEER_INIT, unless
+    # it is already a peer or there is no room for it
+    # params:
+    #   -peerid: the node's address, host:port
+    # returns:
+    #   -the new peer, None if no connection was opened
+    def __connect_peer(self, peerid):
+        now = self.transport.time()
+        try:
+            peer = self.__peer_from_peerid(peerid)
+        except (socket.error, ValueError) as e:
+            logging.info("invalid peer address %s: %s", peerid, e)
+            self.peer_table.failed(peerid, now)
+            return None
+        if peer == None:
+            return None
+        self.peer_table.add(peer.id, now)
+        peer.outgoing = True
+        peer.connected_at = now
+        self.peers_lock.acquire()
+        if self.peers.has_key(peer.id) or len(self.peers) >= self.peer_table.max_peers:
+            self.peers_lock.release()
+            return None
+        # stored before PEER_INIT is sent so the peer's acknowledgement is
+        # accepted
+        self.peers[peer.id] = peer
+        self.peers_lock.release()
+        logging.info("connecting to peer: %s", peer)
+        self.metrics.inc("peer_connections_total", result = "attempted")
+        peer.send_msg(self.id, BlockchainMessage.PEER_INIT, \
+            BlockchainMessage.PROTOCOL_VERSION)
+        return peer
+
+    # turns away a node that connected when the peer table is full, sending
+    # it addresses of other nodes to try before telling it to remove us
+    # params:
+    #   -peer: the node that connected
+    def __refuse_peer(self, peer):
+        logging.info("peer table is full - referring %s to other nodes", peer)
+        self.metrics.inc("peer_connections_total", result = "refused")
+        try:
+            if peer.protocol_version >= BlockchainMessage.PEER_EXCHANGE_VERSION:
+                peer.send_msg_now(self.id, BlockchainMessage.PEERS, \
+                    self.__shareable_addresses(peer.id))
+            peer.send_msg_now(self.id, BlockchainMessage.PEER_REMV)
+        except socket.error as e:
+            logging.debug("couldn't refuse %s: %s", peer, e)
+        peer.close()
+
+    # removes a peer this node no longer wants, telling it so
+    # params:
+    #   -peer: the peer to remove
+    def __drop_peer(self, peer):
+        self.peers_lock.acquire()
+        if self.peers.get(peer.id) is peer:
+            del self.peers[peer.id]
+        self.peers_lock.release()
+        self.sync.forget(peer.id)
+        self.rate_limiter.forget(peer.id)
+        peer.send_msg(self.id, BlockchainMessage.PEER_REMV)
+        peer.close_when_sent()
+
+    # picks addresses to send to a node that asks for them: the node's peers
+    # and other addresses it knows that haven't failed
+    # params:
+    #   -exclude: the address of the node asking
+    # returns:
+    #   -a list of addresses
+    def __shareable_addresses(self, exclude):
+        addresses = [peer.id for peer in self.__peer_list() if peer.id != exclude]
+        for peerid in self.peer_table.sample(PeerTable.MAX_SHARED, self.rand):
+            if peerid != exclude and peerid not in addresses:
+                addresses.append(peerid)
+        return addresses[:PeerTable.MAX_SHARED]
 
-        return established_peers
+    # looks after the peers: drops outbound peers that never answered, asks
+    # for more addresses when too few are known, now and then swaps the worst
+    # scoring outbound peer for a known address, and connects to known
+    # addresses until the node has its target of outbound peers
+    def __manage_peers(self):
+        table = self.peer_table
+        now = self.transport.time()
+        for peer in self.__peer_list():
+            if peer.last_heard == None and now - peer.connected_at >= self.HANDSHAKE_TIMEOUT:
+                logging.info("%s never answered - dropping it", peer)
+                self.__drop_peer(peer)
+                table.failed(peer.id, now)
+                self.metrics.inc("peer_connections_total", result = "failed")
+        if table.target_outbound == 0:
+            return
+        peers = self.__peer_list()
+        connected = set(peer.id for peer in peers)
+        connected.add(self.id)
+        outbound = [peer for peer in peers if peer.outgoing]
+        exchange = [peer for peer in peers \
+            if peer.protocol_version >= BlockchainMessage.PEER_EXCHANGE_VERSION]
+        if len(exchange) > 0 and (len(table) - len(connected) < table.target_outbound or \
+            now - self.last_rotation >= self.ROTATE_INTERVAL):
+            self.rand.choice(exchange).send_msg(self.id, BlockchainMessage.GET_PEERS)
+
+        if len(outbound) >= table.target_outbound and \
+        now - self.last_rotation >= self.ROTATE_INTERVAL:
+            self.last_rotation = now
+            measured = [peer for peer in outbound if PeerTable.score(peer) != None]
+            if len(measured) > 1 and len(table.candidates(1, connected, now, self.rand)) > 0:
+                worst = PeerTable.rank(measured)[-1]
+                logging.info("rotating out %s, rtt %.3fs with %.0f%% of pings answered", \
+                    worst, worst.rtt, worst.reliability() * 100)
+                self.__drop_peer(worst)
+                # it isn't tried again until its backoff has passed
+                table.failed(worst.id, now)
+                self.metrics.inc("peer_connections_total", result = "rotated")
+                outbound.remove(worst)
+
+        missing = table.target_outbound - len(outbound)
+        if missing > 0:
+            for peerid in table.candidates(missing, connected, now, self.rand):
+                self.__connect_peer(peerid)
+
+    # sends a PING to every peer that understands one, measuring how long it
+    # takes to answer
+    def __ping_peers(self):
+        now = self.transport.time()
+        for peer in self.__peer_list():
+            if peer.protocol_version >= BlockchainMessage.PEER_EXCHANGE_VERSION:
+                nonce = self.rand.getrandbits(31)
+                peer.ping_sent(nonce, now)
+                peer.send_msg(self.id, BlockchainMessage.PING, nonce)
 
     # creates a BlockchainPeer object from an id (ip:port)
     # params:
@@ -345,18 +1627,109 @@ class BlockchainNode(object):
             peer_split = string.split(peerid, ":", 1)
             peer_host = peer_split[0]
             peer_port = int(peer_split[1])
-            return BlockchainPeer(peer_host, peer_port)
+            return BlockchainPeer(peer_host, peer_port, on_failure = self.__evict_peer, \
+                metrics = self.metrics, transport = self.transport)
         return None
 
-    # sends a message to all known peers
+    # removes a peer that messages can no longer be sent to, called from the
+    # peer's sender thread
+    # params:
+    #   -peer: the peer to remove
+    def __evict_peer(self, peer):
+        self.peers_lock.acquire()
+        if self.peers.get(peer.id) is peer:
+            logging.info("evicting unreachable peer: %s", peer)
+            del self.peers[peer.id]
+        self.peers_lock.release()
+        self.sync.forget(peer.id)
+        self.rate_limiter.forget(peer.id)
+        self.peer_table.failed(peer.id, self.transport.time())
+        self.metrics.inc("peer_connections_total", result = "failed")
+
+    # takes a copy of the peer table
+    # returns:
+    #   -a list of the established peers
+    def __peer_list(self):
+        self.peers_lock.acquire()
+        peers = self.peers.values()
+        self.peers_lock.release()
+        return peers
+
+    # asks a peer for the blocks we're missing, as a compressed stream or in
+    # batches if the peer supports them or by asking for its whole blockchain
+    # if it doesn't. a peer already streaming blocks to us or that said it is
+    # busy isn't asked, and no peer is asked while the node is waiting for a
+    # snapshot or doesn't know the magic number the blocks must carry
+    # params:
+    #   -peer: the peer to sync from
+    def __request_missing_blocks(self, peer):
+        if self.awaiting_snapshot:
+            logging.debug("not syncing from %s until a snapshot arrives", peer)
+            return
+        if self.tip.magic_num == None:
+            logging.debug("not syncing from %s until the magic number is known", peer)
+            return
+        if peer.busy_until != None and self.transport.time() < peer.busy_until:
+            logging.debug("%s is busy - not syncing from it", peer)
+            return
+        if peer.protocol_version >= BlockchainMessage.CHAIN_STREAM_VERSION:
+            now = self.transport.time()
+            with self.requests_lock:
+                stream = self.chain_streams.get(peer.id)
+                if stream != None and now - stream[1] < self.CHAIN_STREAM_TIMEOUT:
+                    logging.debug("%s is already streaming blocks to me", peer)
+                    return
+                self.chain_streams[peer.id] = [0, now]
+            self.chain_lock.acquire_read()
+            locator = self.blockchain.get_block_locator()
+            self.chain_lock.release_read()
+            self.metrics.inc("sync_requests_total", kind = "stream")
+            peer.send_msg(self.id, BlockchainMessage.GET_CHAIN, \
+                (locator, list(chainstream.CODECS)))
+        elif peer.protocol_version >= BlockchainMessage.INCREMENTAL_SYNC_VERSION:
+            self.chain_lock.acquire_read()
+            locator = self.blockchain.get_block_locator()
+            self.chain_lock.release_read()
+            self.metrics.inc("sync_requests_total", kind = "locator")
+            peer.send_msg(self.id, BlockchainMessage.GET_BLOCKS_FROM, locator)
+        else:
+            self.metrics.inc("sync_requests_total", kind = "full blockchain")
+            peer.send_msg(self.id, BlockchainMessage.GET_BLOCKCHAIN)
+
+    # announces a block to peers that aren't known to have it, with a TIP or
+    # an INV to peers that understand one and the whole block to those that
+    # don't
+    # params:
+    #   -block: the block to announce
+    #   -fanout: the most peers to announce it to, chosen at random, or None
+    #   for every peer
+    def __announce_block(self, block, fanout = None):
+        self.seen_blocks.add(block.hash)
+        peers = [peer for peer in self.__peer_list() \
+            if block.hash not in peer.known_blocks]
+        if fanout != None and len(peers) > fanout:
+            peers = self.rand.sample(peers, fanout)
+        # peers that understand TIP are told the block's height and the work
+        # it brings the blockchain to while it is still the latest block
+        tip = self.tip
+        for peer in peers:
+            peer.known_blocks.add(block.hash)
+            if peer.protocol_version >= BlockchainMessage.TIP_SYNC_VERSION and \
+            tip.block != None and tip.block.hash == block.hash:
+                peer.send_msg(self.id, BlockchainMessage.TIP, \
+                    (block.hash, tip.height, tip.work))
+            elif peer.protocol_version >= BlockchainMessage.GOSSIP_VERSION:
+                peer.send_msg(self.id, BlockchainMessage.INV, [block.hash])
+            else:
+                peer.send_msg(self.id, BlockchainMessage.NEW_BLOCK, block)
+
+    # queues a message for all known peers
     # params:
     #   -msg_type: the type of message to send
     #   -data: the data to include in the message
     def __broadcast_to_peers(self, msg_type, data = None):
-        self.lock.acquire()
-        for peer in self.peers.values():
+        for peer in self.__peer_list():
             peer.send_msg(self.id, msg_type, data)
-        self.lock.release()
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(prog="blockchainnode")
@@ -373,6 +1746,86 @@ if __name__ == "__main__":
     # for this node
     argparser.add_argument("--peers", nargs="*", default=[])
 
+    # pass in --async to serve connections from a single threaded event loop
+    # instead of a thread per connection
+    argparser.add_argument("--async", dest="use_event_loop", action="store_true")
+
+    # pass in --max-msg-size TYPE=BYTES ... to override the largest message
+    # accepted for a message type, e.g. FULL_BLOCKCHAIN=1048576
+    argparser.add_argument("--max-msg-size", nargs="*", default=[], dest="max_msg_sizes")
+
+    # pass in --datadir DIR to keep the blockchain in an append-only log in DIR
+    # so it survives restarts
+    argparser.add_argument("--datadir", default=None)
+
+    # pass in --fsync always|interval|never to choose when the stored blockchain
+    # is flushed to disk
+    argparser.add_argument("--fsync", choices=BlockStore.FSYNC_POLICIES, \
+        default=BlockStore.FSYNC_INTERVAL)
+
+    # pass in --compact to keep the blockchain in memory in columns of packed
+    # fields instead of a list of Block objects, ignored with --datadir
+    argparser.add_argument("--compact", action="store_true")
+
+    # pass in --pow-difficulty BITS to mine with proof of work instead of guessing
+    # the magic number, every node in the network must use the same difficulty
+    argparser.add_argument("--pow-difficulty", dest="pow_difficulty", type=int, default=None)
+
+    # pass in --pow-workers N to set the number of mining processes
+    argparser.add_argument("--pow-workers", dest="pow_workers", type=int, default=None)
+
+    # pass in --verify-workers N to set the number of processes that hash the
+    # blocks received from peers, 0 hashes them in the node's own process
+    argparser.add_argument("--verify-workers", dest="verify_workers", type=int, default=None)
+
+    # pass in --checkpoint HEIGHT:HASH ... to trust the blockchain up to those
+    # blocks, blocks below the last checkpoint aren't hashed when syncing
+    argparser.add_argument("--checkpoint", nargs="*", default=[], dest="checkpoints")
+
+    # pass in --relay-fanout N to announce blocks received from peers to at most
+    # N peers chosen at random rather than to every peer
+    argparser.add_argument("--relay-fanout", dest="relay_fanout", type=int, default=None)
+
+    # pass in --mempool-size N to keep at most N transactions waiting to be
+    # mined, the lowest paying are evicted first
+    argparser.add_argument("--mempool-size", dest="mempool_size", type=int, default=10000)
+
+    # pass in --metrics-port PORT to serve the node's metrics in the Prometheus
+    # text format at http://127.0.0.1:PORT/metrics
+    argparser.add_argument("--metrics-port", dest="metrics_port", type=int, default=None)
+
+    # pass in --max-peers N to keep at most N peers, nodes that connect once
+    # there are N are sent other addresses to try
+    argparser.add_argument("--max-peers", dest="max_peers", type=int, default=32)
+
+    # pass in --outbound-peers N to have the node connect to N peers of its
+    # own, found through its peers and rotated now and then, 0 connects only
+    # to the peers passed in with --peers
+    argparser.add_argument("--outbound-peers", dest="outbound_peers", type=int, default=8)
+
+    # pass in --prune N to keep only the latest N blocks, or a little more, and
+    # a snapshot in place of the rest. a pruned node that starts with an empty
+    # blockchain starts from a snapshot offered by its peers
+    argparser.add_argument("--prune", dest="retain_blocks", type=int, default=None)
+
+    # pass in --snapshot-quorum N to have a pruned node start from a snapshot
+    # only once N peers have offered the same one, or a checkpoint matches it
+    argparser.add_argument("--snapshot-quorum", dest="snapshot_quorum", type=int, default=2)
+
+    # pass in --handler-workers N to handle received messages with N threads,
+    # 0 handles each message on the thread that received it
+    argparser.add_argument("--handler-workers", dest="handler_workers", type=int, \
+        default=BlockchainNode.HANDLER_WORKERS)
+
+    # pass in --listen-backlog N to queue up to N connections waiting to be
+    # accepted
+    argparser.add_argument("--listen-backlog", dest="listen_backlog", type=int, \
+        default=BlockchainNode.LISTEN_BACKLOG)
+
+    # pass in --query-port PORT to answer read only queries about the
+    # blockchain in JSON at http://127.0.0.1:PORT/
+    argparser.add_argument("--query-port", dest="query_port", type=int, default=None)
+
     # get the args passed in from command line
     args = argparser.parse_args()
 
@@ -380,5 +1833,64 @@ if __name__ == "__main__":
     logging.basicConfig(level=args.log_level, format="%(asctime)s - " \
         "%(levelname)s:(%(threadName)s) - %(message)s")
 
+    # convert TYPE=BYTES pairs into a map of message type to limit
+    type_codes = dict((name, code) for code, name in BlockchainMessage.TYPE_NAMES.items())
+    max_msg_sizes = {}
+    for limit in args.max_msg_sizes:
+        name, _, size = limit.partition("=")
+        if not type_codes.has_key(name) or not size.isdigit():
+            argparser.error("invalid --max-msg-size %s, expecting TYPE=BYTES" % limit)
+        max_msg_sizes[type_codes[name]] = int(size)
+
+    blockstore = None
+    if args.datadir != None:
+        blockstore = BlockStore(args.datadir, args.fsync)
+    elif args.compact:
+        blockstore = CompactChain()
+
+    pow_miner = None
+    if args.pow_difficulty != None:
+        if not 0 < args.pow_difficulty <= powminer.MAX_DIFFICULTY:
+            argparser.error("--pow-difficulty must be between 1 and %d" % \
+                powminer.MAX_DIFFICULTY)
+        # the worker processes are forked before the node starts any threads
+        pow_miner = PowMiner(args.pow_workers)
+
+    checkpoints = {}
+    for checkpoint in args.checkpoints:
+        height, _, block_hash = checkpoint.partition(":")
+        if not height.isdigit() or len(block_hash) != 64:
+            argparser.error("invalid --checkpoint %s, expecting HEIGHT:HASH" % checkpoint)
+        checkpoints[int(height)] = block_hash.lower()
+
+    verify_workers = args.verify_workers
+    if verify_workers == None:
+        # with a single core a worker process only adds the cost of sending it
+        # the blocks
+        verify_workers = multiprocessing.cpu_count()
+        if verify_workers == 1:
+            verify_workers = 0
+    # the worker processes are forked before the node starts any threads
+    validator = ChainValidator(verify_workers, checkpoints)
+
+    if args.max_peers < 1 or not 0 <= args.outbound_peers <= args.max_peers:
+        argparser.error("--outbound-peers must be between 0 and --max-peers, " \
+            "which must be at least 1")
+
+    if args.retain_blocks != None and args.retain_blocks < Blockchain.MIN_RETAINED_BLOCKS:
+        argparser.error("--prune must keep at least %d blocks" % \
+            Blockchain.MIN_RETAINED_BLOCKS)
+    if args.snapshot_quorum < 1:
+        argparser.error("--snapshot-quorum must be at least 1")
+    if args.handler_workers < 0 or args.listen_backlog < 1:
+        argparser.error("--handler-workers can't be negative and --listen-backlog " \
+            "must be at least 1")
+    if args.mempool_size < 1:
+        argparser.error("--mempool-size must be at least 1")
+
     # create the node (which also starts it)
-    node = BlockchainNode(args.port, args.peers)
\ No newline at end of file
+    node = BlockchainNode(args.port, args.peers, args.use_event_loop, max_msg_sizes, \
+        blockstore, args.pow_difficulty, pow_miner, validator, args.relay_fanout, \
+        Mempool(args.mempool_size), args.metrics_port, None, \
+        PeerTable(args.max_peers, args.outbound_peers), args.retain_blocks, \
+        args.snapshot_quorum, args.handler_workers, args.listen_backlog, args.query_port)
\ No newline at end of file
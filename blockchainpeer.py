@@ -3,54 +3,394 @@
 # Project 3
 
 # blockchainpeer
-# represents a peer (remote or local) blockchainnode
+# represents a peer (remote or local) blockchainnode. messages to a peer are
+# queued and sent by a thread of its own so a slow or dead peer never holds up
+# the node, or sent straight away over transports that aren't threaded
 
 import socket
 from blockchainmsg import BlockchainMessage
+from collections import deque
+from lrucache import LRUSet
 import logging
-import pickle
 import struct
+import threading
+import time
+from transport import TcpTransport
+import wirecodec
 
 class BlockchainPeer(object):
 
-    def __init__(self, host, port, clientsock = None):
+    LENGTH_STRUCT = struct.Struct("!I")
+    # the most block hashes remembered as known to the peer
+    KNOWN_BLOCKS_SIZE = 4096
+    # the most messages waiting to be sent, more are dropped
+    MAX_QUEUED_MSGS = 256
+    # seconds to wait before retrying after the first failed send, doubling
+    # with each failure in a row up to the maximum
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30
+    # failed sends in a row before the peer is given up on
+    MAX_SEND_FAILURES = 6
+    # weight of the latest round trip time in the moving average
+    RTT_WEIGHT = 0.3
+
+    # params:
+    #   -host: the host name or ip of the peer
+    #   -port: the port of the peer
+    #   -clientsock: an already open connection to the peer, if any
+    #   -on_failure: called with the peer when it is given up on
+    #   -metrics: the Metrics to count bytes sent, failures and drops in, if any
+    #   -transport: the transport connections are opened with, TCP if None
+    def __init__(self, host, port, clientsock = None, on_failure = None, metrics = None, \
+        transport = None):
         self.host = host
         self.port = port
         self.id = None
+        # protocol version the peer advertised, 0 until it tells us otherwise
+        self.protocol_version = 0
+        # serializes writers so frames from different threads don't interleave
+        self.send_lock = threading.Lock()
+        # hashes of blocks the peer has announced, sent us or been sent, so
+        # they aren't announced to it again
+        self.known_blocks = LRUSet(self.KNOWN_BLOCKS_SIZE)
+        # messages waiting for the sender thread, which is started on the
+        # first message, as [senderid, msg_type, data, stream]. a stream is an
+        # iterator of the data of a series of messages, data then holds the
+        # next one to send or None until it is taken from the stream
+        self.outbound = deque()
+        self.outbound_cond = threading.Condition()
+        self.sender = None
+        self.closed = False
+        # set to close the peer once its queue is empty
+        self.closing = False
+        self.failures = 0
+        self.on_failure = on_failure
+        self.metrics = metrics
+        # how the peer came to be connected and how it has performed, see
+        # peertable.PeerTable.score. rtt is a moving average of the seconds a
+        # PING takes to be answered and ping the (nonce, time sent) of the
+        # PING waiting for an answer
+        self.outgoing = False
+        self.connected_at = None
+        self.last_heard = None
+        self.rtt = None
+        self.ping = None
+        self.pongs = 0
+        self.missed_pings = 0
+        # when the peer said it is too busy for our requests until, and map
+        # of the type of each request we said we are too busy for to when we
+        # told it to ask again
+        self.busy_until = None
+        self.busy_sent = {}
+        if transport == None:
+            transport = TcpTransport()
+        self.transport = transport
         if clientsock == None:
-            self.sock = self.init_sock()
+            self.conn = self.init_sock()
         else:
-            self.sock = clientsock
+            self.conn = clientsock
 
-    # initializes the socket object and sets the host, port and id
-    # for this object
+    # resolves the host, port and id for this object. the connection itself
+    # is opened lazily on the first send and then reused
+    # returns:
+    #   -None, the connection is opened by send_msg
     def init_sock(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        addrinfo = socket.getaddrinfo(self.host, self.port, socket.AF_INET, socket.SOCK_STREAM)
-        socktype = addrinfo[0]
-        self.host = socktype[4][0]
-        self.port = socktype[4][1]
+        self.host, self.port = self.transport.resolve(self.host, self.port)
         self.id = self.host + ":" + str(self.port)
-        return sock
+        return None
+
+    # opens a new connection to the peer
+    # returns:
+    #   -the connection
+    def __connect(self):
+        logging.debug("opening connection to peer: %s", self)
+        return self.transport.connect(self.host, self.port)
+
+    # notes a PING sent to the peer, a PING it hasn't answered by the time the
+    # next is sent counts as missed
+    # params:
+    #   -nonce: the number the peer is to echo back
+    #   -now: the time it was sent
+    def ping_sent(self, nonce, now):
+        if self.ping != None:
+            self.missed_pings += 1
+        self.ping = (nonce, now)
+
+    # notes the peer's answer to a PING, updating its round trip time
+    # params:
+    #   -nonce: the number the peer echoed back
+    #   -now: the time the answer arrived
+    # returns:
+    #   -the round trip time in seconds, None if the answer isn't to the
+    #   PING waiting for one
+    def pong_received(self, nonce, now):
+        ping = self.ping
+        if ping == None or ping[0] != nonce:
+            return None
+        self.ping = None
+        self.pongs += 1
+        rtt = now - ping[1]
+        if self.rtt == None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.RTT_WEIGHT * (rtt - self.rtt)
+        return rtt
+
+    # the share of pings the peer has answered, smoothed so a new peer
+    # starts out reliable
+    def reliability(self):
+        return (self.pongs + 1.0) / (self.pongs + self.missed_pings + 1.0)
+
+    # determines how a message should be encoded for this peer. PEER_INIT is
+    # always pickled since the peer's version isn't known when it is sent
+    # params:
+    #   -msg_type: the type of message to be sent
+    # returns:
+    #   -the encoding to pass to wirecodec.encode_message
+    def wire_encoding(self, msg_type):
+        if msg_type == BlockchainMessage.PEER_INIT or \
+        self.protocol_version < BlockchainMessage.BINARY_WIRE_VERSION:
+            return wirecodec.PICKLE_ENCODING
+        return wirecodec.WIRE_VERSION
+
+    # determines if the pooled connection is still usable
+    # returns:
+    #   -true if the connection can be used to send, false otherwise
+    def __connection_alive(self):
+        return self.conn != None and self.conn.alive()
+
+    # stops the sender thread and closes the pooled connection to the peer
+    # params:
+    #   -drain_timeout: seconds to wait for queued messages to be sent first
+    def close(self, drain_timeout = 0):
+        deadline = time.time() + drain_timeout
+        with self.outbound_cond:
+            while len(self.outbound) > 0 and self.sender != None and \
+            self.sender.is_alive() and time.time() < deadline:
+                self.outbound_cond.wait(deadline - time.time())
+            self.closed = True
+            self.outbound.clear()
+            self.outbound_cond.notify_all()
+        with self.send_lock:
+            self.__close_conn()
+
+    # closes the peer once the messages already queued for it have been sent,
+    # without waiting for them
+    def close_when_sent(self):
+        with self.outbound_cond:
+            if self.sender != None and self.sender.is_alive():
+                self.closing = True
+                self.outbound_cond.notify_all()
+                return
+        self.close()
 
-    # sends a message to the peer defined by this object
+    # waits for the sender thread to exit after the peer has been closed
+    # params:
+    #   -timeout: the most seconds to wait
+    def join(self, timeout):
+        sender = self.sender
+        if sender != None and sender is not threading.current_thread():
+            sender.join(timeout)
+
+    def __close_conn(self):
+        if self.conn != None:
+            self.conn.close()
+            self.conn = None
+
+    # queues a message for the peer's sender thread and returns straight away
     # params:
     #   -senderid: the id of the node sending a message to this peer
     #   -msg_type: the type of message to be sent
     #   -data: the data portion of the message to be sent
+    # returns:
+    #   -true if the message was queued, false if the queue is full or the
+    #   peer has been closed
     def send_msg(self, senderid, msg_type, data = None):
+        if not self.transport.threaded:
+            return self.__send_unthreaded(senderid, msg_type, data)
+        with self.outbound_cond:
+            if self.closed or self.closing:
+                return False
+            if len(self.outbound) >= self.MAX_QUEUED_MSGS:
+                logging.info("send queue for %s is full - dropping %s", \
+                    self, BlockchainMessage.TYPE_NAMES.get(msg_type, msg_type))
+                if self.metrics != None:
+                    self.metrics.inc("peer_messages_dropped_total", peer = self.id)
+                return False
+            self.outbound.append([senderid, msg_type, data, None])
+            self.__start_sender()
+        return True
+
+    # queues a series of messages of one type whose data is produced by an
+    # iterator as the sender thread gets to them, so a long series is never
+    # held in memory. the sender thread sends one message of the series at a
+    # time and then moves the series to the back of the queue so other
+    # messages aren't held up behind it
+    # params:
+    #   -senderid: the id of the node sending the messages
+    #   -msg_type: the type of every message in the series
+    #   -stream: an iterator of the data of each message
+    # returns:
+    #   -true if the series was queued, false if the queue is full or the
+    #   peer has been closed
+    def send_stream(self, senderid, msg_type, stream):
+        if not self.transport.threaded:
+            for data in stream:
+                if not self.__send_unthreaded(senderid, msg_type, data):
+                    return False
+            return True
+        with self.outbound_cond:
+            if self.closed or self.closing:
+                return False
+            if len(self.outbound) >= self.MAX_QUEUED_MSGS:
+                logging.info("send queue for %s is full - dropping %s stream", \
+                    self, BlockchainMessage.TYPE_NAMES.get(msg_type, msg_type))
+                if self.metrics != None:
+                    self.metrics.inc("peer_messages_dropped_total", peer = self.id)
+                return False
+            self.outbound.append([senderid, msg_type, None, iter(stream)])
+            self.__start_sender()
+        return True
+
+    # starts the sender thread if it isn't running and wakes it, outbound_cond
+    # must be held
+    def __start_sender(self):
+        if self.sender == None:
+            self.sender = threading.Thread(target = self.__send_queued, \
+                name = "PeerSender-%s" % self.id)
+            self.sender.daemon = True
+            self.sender.start()
+        self.outbound_cond.notify_all()
+
+    # sends a message straight away over a transport that isn't threaded,
+    # where sends never block. a message that fails is dropped rather than
+    # retried, and the peer is given up on after MAX_SEND_FAILURES in a row
+    # returns:
+    #   -true if the message was sent
+    def __send_unthreaded(self, senderid, msg_type, data):
+        if self.closed:
+            return False
+        try:
+            self.send_msg_now(senderid, msg_type, data)
+        except socket.error as e:
+            self.failures += 1
+            if self.metrics != None:
+                self.metrics.inc("peer_send_failures_total", peer = self.id)
+            if self.failures >= self.MAX_SEND_FAILURES:
+                logging.info("giving up on %s after %d failed sends: %s", \
+                    self, self.failures, e)
+                self.close()
+                if self.on_failure != None:
+                    self.on_failure(self)
+            return False
+        self.failures = 0
+        return True
+
+    # sends queued messages in order until the peer is closed. a failed send
+    # is retried after an exponentially growing backoff, and the peer is
+    # given up on after MAX_SEND_FAILURES failures in a row
+    def __send_queued(self):
+        while True:
+            with self.outbound_cond:
+                while len(self.outbound) == 0 and not self.closed and not self.closing:
+                    self.outbound_cond.wait()
+                if self.closed:
+                    return
+                entry = None
+                if len(self.outbound) > 0:
+                    entry = self.outbound[0]
+            if entry == None:
+                # closing and everything queued has been sent
+                self.close()
+                return
+            senderid, msg_type, data, stream = entry
+            if stream != None and data == None:
+                # the next message of a stream is produced outside the lock
+                try:
+                    data = entry[2] = next(stream)
+                except StopIteration:
+                    self.__finish_entry(entry)
+                    continue
+                except Exception:
+                    logging.exception("abandoning stream to %s", self)
+                    self.__finish_entry(entry)
+                    continue
+            try:
+                self.send_msg_now(senderid, msg_type, data)
+            except socket.error as e:
+                self.failures += 1
+                if self.metrics != None:
+                    self.metrics.inc("peer_send_failures_total", peer = self.id)
+                if self.failures >= self.MAX_SEND_FAILURES:
+                    logging.info("giving up on %s after %d failed sends: %s", \
+                        self, self.failures, e)
+                    self.close()
+                    if self.on_failure != None:
+                        self.on_failure(self)
+                    return
+                backoff = min(self.BACKOFF_MAX, \
+                    self.BACKOFF_BASE * (2 ** (self.failures - 1)))
+                logging.info("sending to %s failed: %s - retrying in %.1fs", \
+                    self, e, backoff)
+                with self.outbound_cond:
+                    deadline = time.time() + backoff
+                    while not self.closed and time.time() < deadline:
+                        self.outbound_cond.wait(deadline - time.time())
+                continue
+            except Exception:
+                logging.exception("dropping message to %s that couldn't be sent", self)
+            self.failures = 0
+            if stream != None:
+                # the rest of the stream waits behind the other queued messages
+                entry[2] = None
+                with self.outbound_cond:
+                    if len(self.outbound) > 0 and self.outbound[0] is entry:
+                        self.outbound.rotate(-1)
+                    self.outbound_cond.notify_all()
+            else:
+                self.__finish_entry(entry)
+
+    # takes a message or a finished stream off of the front of the queue
+    # params:
+    #   -entry: the queue entry that was sent
+    def __finish_entry(self, entry):
+        with self.outbound_cond:
+            if len(self.outbound) > 0 and self.outbound[0] is entry:
+                self.outbound.popleft()
+            self.outbound_cond.notify_all()
+
+    # sends a message to the peer defined by this object over the pooled
+    # connection, reconnecting once if the connection has gone away. this
+    # blocks for up to the connect and send timeouts
+    # params:
+    #   -senderid: the id of the node sending a message to this peer
+    #   -msg_type: the type of message to be sent
+    #   -data: the data portion of the message to be sent
+    def send_msg_now(self, senderid, msg_type, data = None):
         msg_obj = BlockchainMessage(senderid, msg_type, data)
-        serialized_msg =  pickle.dumps(msg_obj)
-        logging.debug("sending length is %d" % len(serialized_msg))
-        length_struct = struct.Struct("!I")
-        length = length_struct.pack(len(serialized_msg))
-        logging.debug("connecting and sending %s to peer: %s" % (repr(msg_obj), self))
+        serialized_msg = wirecodec.encode_message(msg_obj, self.wire_encoding(msg_type))
+        logging.debug("sending length is %d", len(serialized_msg))
+        length = self.LENGTH_STRUCT.pack(len(serialized_msg))
+        logging.debug("sending %s to peer: %s", msg_obj, self)
         msg = length + serialized_msg
-        self.sock.connect((self.host, self.port))
-        self.sock.sendall(msg)
-        self.sock.close()
-        self.sock = self.init_sock()
+        with self.send_lock:
+            if not self.__connection_alive():
+                self.__close_conn()
+                self.conn = self.__connect()
+                self.conn.send(msg)
+            else:
+                try:
+                    self.conn.send(msg)
+                except socket.error as e:
+                    logging.debug("pooled connection to %s failed: %s - reconnecting", \
+                        self, e)
+                    self.__close_conn()
+                    self.conn = self.__connect()
+                    self.conn.send(msg)
+        if self.metrics != None:
+            self.metrics.inc("peer_bytes_sent_total", len(msg), peer = self.id)
+            self.metrics.inc("peer_messages_sent_total", \
+                type = BlockchainMessage.TYPE_NAMES.get(msg_type, "UNKNOWN"))
 
     def __repr__(self):
         return "[ %s ]" % (self.id)
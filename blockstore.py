@@ -0,0 +1,340 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# blockstore
+# an append-only on disk log of blocks that can stand in for the list of blocks
+# in a Blockchain. blocks are appended to blocks.dat as length and crc prefixed
+# records and the offset of every record is kept in blocks.idx so any block can
+# be read directly through mmap without loading the chain into memory. blocks
+# can also be dropped from the start of the log for a pruned blockchain, which
+# rewrites the files with only the blocks that are kept
+
+import binascii
+from collections import OrderedDict
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import wirecodec
+import zlib
+
+class BlockStore(object):
+
+    DATA_FILE = "blocks.dat"
+    INDEX_FILE = "blocks.idx"
+    # the rewritten files while blocks are dropped from the start of the log,
+    # and the file marking that they are complete and replace the originals
+    TEMP_SUFFIX = ".tmp"
+    PRUNE_FILE = "blocks.prune"
+
+    # fsync after every append, at most once per interval, or leave it to the OS
+    FSYNC_ALWAYS = "always"
+    FSYNC_INTERVAL = "interval"
+    FSYNC_NEVER = "never"
+    FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+    # length, crc32 of the encoded block
+    RECORD_STRUCT = struct.Struct("!II")
+    OFFSET_STRUCT = struct.Struct("!Q")
+    HASH_SIZE = 32
+    # number of decoded blocks kept around
+    CACHE_SIZE = 1024
+
+    # params:
+    #   -datadir: the directory to keep the block log in, created if needed
+    #   -fsync_policy: one of FSYNC_POLICIES
+    #   -fsync_interval: seconds between fsyncs for FSYNC_INTERVAL
+    def __init__(self, datadir, fsync_policy = FSYNC_INTERVAL, fsync_interval = 1.0):
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError("unknown fsync policy: %s" % fsync_policy)
+        if not os.path.isdir(datadir):
+            os.makedirs(datadir)
+        self.datadir = datadir
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.last_fsync = time.time()
+        self.cache = OrderedDict()
+        # readers share the cache and the mappings, which a read can remap
+        self.lock = threading.RLock()
+        self.__finish_prune()
+        self.datafile = self.__open(self.DATA_FILE)
+        self.indexfile = self.__open(self.INDEX_FILE)
+        self.datamap = None
+        self.indexmap = None
+        self.count = 0
+        self.__recover()
+
+    def __open(self, name):
+        path = os.path.join(self.datadir, name)
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        return open(path, "r+b")
+
+    # completes dropping blocks from the start of the log if the node stopped
+    # part way through. the rewritten files replace the originals if they were
+    # all written, and are thrown away otherwise
+    def __finish_prune(self):
+        marker = os.path.join(self.datadir, self.PRUNE_FILE)
+        for name in (self.INDEX_FILE, self.DATA_FILE):
+            path = os.path.join(self.datadir, name)
+            if not os.path.exists(path + self.TEMP_SUFFIX):
+                continue
+            if os.path.exists(marker):
+                logging.info("finishing pruning %s", path)
+                os.rename(path + self.TEMP_SUFFIX, path)
+            else:
+                os.remove(path + self.TEMP_SUFFIX)
+        if os.path.exists(marker):
+            os.remove(marker)
+
+    # works out how many blocks the log holds, dropping any records at the
+    # tail that were only partly written when the node last stopped. only the
+    # tail is checked so opening the store doesn't read the whole log
+    def __recover(self):
+        index_size = os.fstat(self.indexfile.fileno()).st_size
+        data_size = os.fstat(self.datafile.fileno()).st_size
+        self.count = index_size // self.OFFSET_STRUCT.size
+        self.__remap()
+        while self.count > 0:
+            offset = self.__offset(self.count - 1)
+            end = self.__record_end(offset, data_size)
+            if end != None:
+                break
+            logging.info("dropping torn block record %d from the block store", \
+                (self.count - 1))
+            self.count -= 1
+        if self.count > 0:
+            data_size = self.__record_end(self.__offset(self.count - 1), data_size)
+        else:
+            data_size = 0
+        self.__truncate_files(self.count, data_size)
+        logging.info("block store %s holds %d blocks", self.datadir, self.count)
+
+    # params:
+    #   -offset: where the record starts in the data file
+    #   -data_size: the size of the data file
+    # returns:
+    #   -the offset just past the record if it is whole, None otherwise
+    def __record_end(self, offset, data_size):
+        header_end = offset + self.RECORD_STRUCT.size
+        if header_end > data_size:
+            return None
+        length, crc = self.RECORD_STRUCT.unpack_from(self.datamap, offset)
+        end = header_end + length
+        if end > data_size:
+            return None
+        if zlib.crc32(self.datamap[header_end:end]) & 0xffffffff != crc:
+            return None
+        return end
+
+    # remaps the files after they have grown or shrunk. appends don't remap,
+    # reads past the end of the current mapping do
+    def __remap(self):
+        for filemap in (self.datamap, self.indexmap):
+            if isinstance(filemap, mmap.mmap):
+                filemap.close()
+        self.datamap = self.__map(self.datafile)
+        self.indexmap = self.__map(self.indexfile)
+
+    # returns:
+    #   -a read only mapping of the file, or an empty string for an empty file
+    #   since empty files can't be mapped
+    def __map(self, f):
+        f.flush()
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def __truncate_files(self, count, data_size):
+        self.indexfile.truncate(count * self.OFFSET_STRUCT.size)
+        self.datafile.truncate(data_size)
+        self.__fsync(True)
+        self.__remap()
+
+    def __offset(self, height):
+        position = height * self.OFFSET_STRUCT.size
+        if position + self.OFFSET_STRUCT.size > len(self.indexmap):
+            self.__remap()
+        return self.OFFSET_STRUCT.unpack_from(self.indexmap, position)[0]
+
+    def __read(self, height):
+        with self.lock:
+            block = self.cache.get(height)
+            if block != None:
+                return block
+            offset = self.__offset(height) + self.RECORD_STRUCT.size
+            if offset >= len(self.datamap):
+                self.__remap()
+            block = wirecodec.decode_block(self.datamap, offset)
+            self.__cache(height, block)
+            return block
+
+    # gets the hash of a block without decoding the block, read straight from
+    # its record
+    # params:
+    #   -height: the block's position in the log
+    # returns:
+    #   -the hash as a hex string
+    def hash_at(self, height):
+        with self.lock:
+            offset = self.__offset(height) + self.RECORD_STRUCT.size + \
+                wirecodec.BLOCK_HASH_OFFSET
+            if offset + self.HASH_SIZE > len(self.datamap):
+                self.__remap()
+            return binascii.hexlify(self.datamap[offset:offset + self.HASH_SIZE])
+
+    def __cache(self, height, block):
+        self.cache[height] = block
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last = False)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.__read(i) for i in xrange(*key.indices(self.count))]
+        if key < 0:
+            key += self.count
+        if key < 0 or key >= self.count:
+            raise IndexError("block store index out of range")
+        return self.__read(key)
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self.__read(i)
+
+    # removes blocks from the end of the log, del store[height:], or from the
+    # start of it, del store[:count]
+    # params:
+    #   -key: a slice from the first height to remove to the end, or from the
+    #   start to the first height to keep
+    def __delitem__(self, key):
+        if not isinstance(key, slice) or key.step != None or \
+            (key.start not in (None, 0) and key.stop != None):
+            raise TypeError("only blocks at the start or end of the store can be removed")
+        if key.stop != None:
+            self.__drop_front(key.stop)
+            return
+        start = key.start or 0
+        if start < 0:
+            start = max(0, start + self.count)
+        if start >= self.count:
+            return
+        with self.lock:
+            data_size = self.__offset(start)
+            for height in self.cache.keys():
+                if height >= start:
+                    del self.cache[height]
+            self.count = start
+            self.__truncate_files(start, data_size)
+
+    # drops blocks from the start of the log by writing the blocks that are
+    # kept to new files and swapping them in. the files are renamed only once
+    # both are on disk and marked complete, so a node that stops part way
+    # through finishes the swap when it starts again
+    # params:
+    #   -count: the number of blocks to drop
+    def __drop_front(self, count):
+        if count < 0:
+            count = max(0, count + self.count)
+        count = min(count, self.count)
+        if count == 0:
+            return
+        with self.lock:
+            self.__fsync(True)
+            self.__remap()
+            data_size = os.fstat(self.datafile.fileno()).st_size
+            kept = self.count - count
+            start = data_size
+            offsets = ()
+            if kept > 0:
+                start = self.__offset(count)
+                offsets = struct.unpack_from("!%dQ" % kept, self.indexmap, \
+                    count * self.OFFSET_STRUCT.size)
+            index = struct.pack("!%dQ" % kept, *[offset - start for offset in offsets])
+            paths = []
+            for name, contents in ((self.INDEX_FILE, index), \
+                (self.DATA_FILE, self.datamap[start:data_size])):
+                path = os.path.join(self.datadir, name)
+                with open(path + self.TEMP_SUFFIX, "wb") as f:
+                    f.write(contents)
+                    f.flush()
+                    os.fsync(f.fileno())
+                paths.append(path)
+            open(os.path.join(self.datadir, self.PRUNE_FILE), "wb").close()
+            for filemap in (self.datamap, self.indexmap):
+                if isinstance(filemap, mmap.mmap):
+                    filemap.close()
+            self.datafile.close()
+            self.indexfile.close()
+            for path in paths:
+                os.rename(path + self.TEMP_SUFFIX, path)
+            os.remove(os.path.join(self.datadir, self.PRUNE_FILE))
+            self.datafile = self.__open(self.DATA_FILE)
+            self.indexfile = self.__open(self.INDEX_FILE)
+            self.count = kept
+            # cached blocks are keyed by position, which has moved
+            self.cache.clear()
+            self.__remap()
+        logging.info("dropped %d blocks from the start of block store %s", count, \
+            self.datadir)
+
+    # appends a block to the end of the log
+    # params:
+    #   -block: the block to append
+    def append(self, block):
+        self.extend([block])
+
+    # appends blocks to the end of the log with a single fsync
+    # params:
+    #   -blocks: the blocks to append, in order
+    def extend(self, blocks):
+        self.datafile.seek(0, os.SEEK_END)
+        self.indexfile.seek(self.count * self.OFFSET_STRUCT.size)
+        offset = self.datafile.tell()
+        offsets = []
+        records = []
+        for block in blocks:
+            encoded = wirecodec.encode_block(block)
+            records.append(self.RECORD_STRUCT.pack(len(encoded), \
+                zlib.crc32(encoded) & 0xffffffff))
+            records.append(encoded)
+            offsets.append(self.OFFSET_STRUCT.pack(offset))
+            offset += self.RECORD_STRUCT.size + len(encoded)
+        # records are written before the index entries pointing at them
+        self.datafile.write("".join(records))
+        if self.fsync_policy == self.FSYNC_ALWAYS:
+            self.datafile.flush()
+            os.fsync(self.datafile.fileno())
+        self.indexfile.write("".join(offsets))
+        with self.lock:
+            for block in blocks:
+                self.__cache(self.count, block)
+                self.count += 1
+        self.__fsync(self.fsync_policy == self.FSYNC_ALWAYS)
+
+    def __fsync(self, force):
+        self.datafile.flush()
+        self.indexfile.flush()
+        now = time.time()
+        if force or (self.fsync_policy == self.FSYNC_INTERVAL and \
+            now - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.datafile.fileno())
+            os.fsync(self.indexfile.fileno())
+            self.last_fsync = now
+
+    # flushes and closes the log
+    def close(self):
+        self.__fsync(True)
+        for filemap in (self.datamap, self.indexmap):
+            if isinstance(filemap, mmap.mmap):
+                filemap.close()
+        self.datafile.close()
+        self.indexfile.close()
+
+    def __repr__(self):
+        return "<BlockStore %s: %d blocks>" % (self.datadir, self.count)
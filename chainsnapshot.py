@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# chainsnapshot
+# what a pruned blockchain keeps in place of the blocks it has dropped: the
+# last dropped block, the cumulative work of the blockchain up to and
+# including it and the blockchain's magic number. the block's hash commits to
+# every block before it, so the snapshot stands in for the history below the
+# blocks that are kept. a node with a datadir keeps its snapshot next to the
+# block store as a single crc checked record that is replaced atomically
+
+from block import Block
+import os
+import struct
+import wirecodec
+import zlib
+
+# the name of the snapshot file in a node's datadir
+SNAPSHOT_FILE = "snapshot.dat"
+
+class ChainSnapshot(object):
+
+    __slots__ = ("block", "height", "work", "magic_num")
+
+    # length, crc32 of the record
+    RECORD_STRUCT = struct.Struct("!II")
+    # magic number, length of the work written out in hex
+    HEADER_STRUCT = struct.Struct("!qH")
+
+    # params:
+    #   -block: the last block dropped from the blockchain
+    #   -work: the cumulative work of the blockchain up to and including it
+    #   -magic_num: the blockchain's magic number
+    def __init__(self, block, work, magic_num):
+        self.block = block
+        self.height = block.index
+        self.work = work
+        self.magic_num = magic_num
+
+    # the snapshot as the data of a SNAPSHOT message
+    # returns:
+    #   -(block, work, magic number)
+    def to_wire(self):
+        return self.block, self.work, self.magic_num
+
+    # builds a snapshot from the data of a SNAPSHOT message
+    # params:
+    #   -data: (block, work, magic number)
+    # returns:
+    #   -the ChainSnapshot
+    # raises:
+    #   -wirecodec.WireFormatError if the data isn't a snapshot
+    @classmethod
+    def from_wire(cls, data):
+        if not isinstance(data, tuple) or len(data) != 3:
+            raise wirecodec.WireFormatError("SNAPSHOT doesn't hold a snapshot")
+        block, work, magic_num = data
+        if not isinstance(block, Block) or not isinstance(work, (int, long)) or \
+            work < 0 or not isinstance(magic_num, (int, long)):
+            raise wirecodec.WireFormatError("SNAPSHOT doesn't hold a snapshot")
+        return cls(block, work, magic_num)
+
+    # writes the snapshot to a file, replacing what was there only once the
+    # new snapshot is safely on disk
+    # params:
+    #   -path: the file to write
+    def save(self, path):
+        work = "%x" % self.work
+        payload = self.HEADER_STRUCT.pack(self.magic_num, len(work)) + work + \
+            wirecodec.encode_block(self.block)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(self.RECORD_STRUCT.pack(len(payload), \
+                zlib.crc32(payload) & 0xffffffff))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+
+    # reads a snapshot written by save
+    # params:
+    #   -path: the file to read
+    # returns:
+    #   -the ChainSnapshot, None if there is no file
+    # raises:
+    #   -ValueError if the file is corrupt
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            record = f.read()
+        if len(record) < cls.RECORD_STRUCT.size:
+            raise ValueError("snapshot %s is truncated" % path)
+        length, crc = cls.RECORD_STRUCT.unpack_from(record)
+        payload = record[cls.RECORD_STRUCT.size:]
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+            raise ValueError("snapshot %s is corrupt" % path)
+        magic_num, work_length = cls.HEADER_STRUCT.unpack_from(payload)
+        offset = cls.HEADER_STRUCT.size
+        work = int(payload[offset:offset + work_length], 16)
+        block = wirecodec.decode_block(payload, offset + work_length)
+        return cls(block, work, magic_num)
+
+    def __repr__(self):
+        return "<ChainSnapshot at height %d: %s>" % (self.height, self.block.hash)
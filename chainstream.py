@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# chainstream
+# streams a run of blocks, up to a whole blockchain, to a peer as a series of
+# compressed chunks. the sender encodes and compresses one chunk at a time as
+# its peer's sender thread gets to it, and the receiver decompresses, decodes
+# and applies each chunk as it arrives, so neither side ever holds more than
+# a chunk or two whatever the length of the blockchain. a chunk is a run of
+# length prefixed blocks in the binary layout, compressed with the codec the
+# two nodes agreed on
+
+import struct
+import wirecodec
+import zlib
+
+# compression codecs in order of preference, the receiver offers the codecs it
+# understands and the sender picks the first of them it understands too
+CODEC_ZLIB = "zlib"
+CODEC_NONE = "none"
+CODECS = (CODEC_ZLIB, CODEC_NONE)
+ZLIB_LEVEL = 6
+
+# encoded bytes of blocks gathered into a chunk before it is compressed, a
+# chunk can go over by at most one block
+CHUNK_BYTES = 1024 * 1024
+# the most blocks in a chunk
+CHUNK_BLOCKS = 2000
+# the most bytes a chunk may decompress to, a little over CHUNK_BYTES plus
+# the largest block
+MAX_CHUNK_BYTES = 4 * 1024 * 1024
+
+BLOCK_LENGTH_STRUCT = struct.Struct("!I")
+
+# picks the codec to send a stream with
+# params:
+#   -offered: the codecs the receiver understands, in its order of preference
+# returns:
+#   -the first offered codec this node understands, CODEC_NONE if there is none
+def choose_codec(offered):
+    for codec in offered or []:
+        if codec in CODECS:
+            return codec
+    return CODEC_NONE
+
+# gathers blocks into encoded chunks
+# params:
+#   -blocks: an iterator of blocks in order
+#   -chunk_bytes: the encoded bytes of blocks gathered before a chunk is cut
+#   -chunk_blocks: the most blocks in a chunk
+# returns:
+#   -a generator of (encoded chunk, number of blocks in it)
+def encode_chunks(blocks, chunk_bytes = CHUNK_BYTES, chunk_blocks = CHUNK_BLOCKS):
+    out = []
+    size = 0
+    for block in blocks:
+        encoded = wirecodec.encode_block(block)
+        out.append(BLOCK_LENGTH_STRUCT.pack(len(encoded)))
+        out.append(encoded)
+        size += BLOCK_LENGTH_STRUCT.size + len(encoded)
+        if size >= chunk_bytes or len(out) // 2 >= chunk_blocks:
+            yield "".join(out), len(out) // 2
+            out = []
+            size = 0
+    if len(out) > 0:
+        yield "".join(out), len(out) // 2
+
+# compresses an encoded chunk
+# params:
+#   -chunk: the encoded chunk
+#   -codec: one of CODECS
+# returns:
+#   -the compressed chunk
+def compress(chunk, codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(chunk, ZLIB_LEVEL)
+    return chunk
+
+# decompresses a chunk received from a peer, refusing to decompress more than
+# max_size bytes so a small chunk can't expand to fill memory
+# params:
+#   -data: the compressed chunk
+#   -codec: the codec it was compressed with
+#   -max_size: the most bytes it may decompress to
+# returns:
+#   -the encoded chunk
+# raises:
+#   -wirecodec.WireFormatError if the chunk is corrupt, too large or
+#   compressed with a codec this node doesn't understand
+def decompress(data, codec, max_size = MAX_CHUNK_BYTES):
+    if codec == CODEC_NONE:
+        chunk = data
+    elif codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            chunk = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise wirecodec.WireFormatError("corrupt chunk: %s" % e)
+        if decompressor.unconsumed_tail:
+            raise wirecodec.MessageTooLargeError("chunk decompresses to more " \
+                "than %d bytes" % max_size)
+        if decompressor.unused_data:
+            raise wirecodec.WireFormatError("trailing bytes after chunk")
+    else:
+        raise wirecodec.WireFormatError("unknown chunk codec: %r" % (codec,))
+    if len(chunk) > max_size:
+        raise wirecodec.MessageTooLargeError("chunk of %d bytes is larger than " \
+            "%d" % (len(chunk), max_size))
+    return chunk
+
+# decodes the blocks in an encoded chunk one at a time
+# params:
+#   -chunk: the encoded chunk
+# returns:
+#   -a generator of blocks
+# raises:
+#   -wirecodec.WireFormatError if the chunk is malformed
+def decode_blocks(chunk):
+    view = buffer(chunk)
+    offset = 0
+    while offset < len(view):
+        if offset + BLOCK_LENGTH_STRUCT.size > len(view):
+            raise wirecodec.WireFormatError("chunk truncated")
+        length = BLOCK_LENGTH_STRUCT.unpack_from(view, offset)[0]
+        offset += BLOCK_LENGTH_STRUCT.size
+        if offset + length > len(view):
+            raise wirecodec.WireFormatError("chunk truncated")
+        try:
+            yield wirecodec.decode_block(buffer(chunk, offset, length))
+        except struct.error as e:
+            raise wirecodec.WireFormatError("malformed block in chunk: %s" % e)
+        offset += length
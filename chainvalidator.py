@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# chainvalidator
+# verifies blocks received from peers by recomputing the SHA-256 hash and the
+# Merkle root of every block, spreading long runs of blocks across a pool of
+# worker processes, and keeps the trusted checkpoints that spare blocks below
+# them from being hashed
+
+from block import Block
+from collections import deque
+import logging
+import multiprocessing
+
+# gets the fields of a block needed to recompute its hash, in the order
+# Block.restore takes them, which are cheaper to send to a worker than a block
+# params:
+#   -block: the block
+# returns:
+#   -a tuple of the block's fields
+def hash_fields(block):
+    return (block.index, block.previous_hash, block.timestamp, block.data, \
+        block.mined_by, block.hash, block.difficulty, block.nonce, \
+        block.merkle_root, block.transactions)
+
+# determines if a block's hash and transactions match what it claims
+# params:
+#   -block: the block to check
+# returns:
+#   -true if the hash is right and the transactions match the Merkle root
+def verify_contents(block):
+    return block.compute_hash() == block.hash and block.valid_transactions()
+
+# recomputes the hashes of a run of blocks, run in the worker processes
+# params:
+#   -task: a list of hash_fields tuples
+# returns:
+#   -the position in the list of the first block whose hash is wrong, or None
+#   if every hash is right
+def verify_hashes(task):
+    for position, fields in enumerate(task):
+        if not verify_contents(Block.restore(*fields)):
+            return position
+    return None
+
+class ChainValidator(object):
+
+    # blocks handed to a worker at a time
+    BLOCKS_PER_TASK = 2000
+    # runs with fewer blocks to hash than this are hashed in this process since
+    # sending them to the workers costs more than it saves
+    PARALLEL_MIN_BLOCKS = 4000
+    # tasks queued per worker ahead of the one being waited on, so a bad block
+    # stops the check without hashing the whole run
+    TASKS_AHEAD_PER_WORKER = 2
+
+    # params:
+    #   -workers: the number of worker processes, 0 to hash every block in
+    #   this process
+    #   -checkpoints: a map of block height to the hash the block at that height
+    #   must have
+    def __init__(self, workers = 0, checkpoints = None):
+        self.workers = workers
+        # the pool is created up front, before the node starts any threads
+        self.pool = None
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers)
+        self.checkpoints = {}
+        if checkpoints != None:
+            self.checkpoints.update(checkpoints)
+        # blocks below this height are trusted through the checkpoint rather
+        # than hashed, the checkpointed block itself is hashed so its contents
+        # are held to the pinned hash
+        self.last_checkpoint = -1
+        if len(self.checkpoints) > 0:
+            self.last_checkpoint = max(self.checkpoints)
+
+    # determines if a block agrees with the checkpoint at its height
+    # params:
+    #   -block: the block to check
+    # returns:
+    #   -true if there is no checkpoint at the block's height or the block has
+    #   the checkpointed hash, false otherwise
+    def matches_checkpoint(self, block):
+        expected = self.checkpoints.get(block.index)
+        return expected == None or expected == block.hash
+
+    # verifies a single block's hash and transactions
+    # params:
+    #   -block: the block to check
+    # returns:
+    #   -true if the block agrees with the checkpoints and its hash is right
+    def verify_block(self, block):
+        if not self.matches_checkpoint(block):
+            return False
+        return block.index < self.last_checkpoint or verify_contents(block)
+
+    # verifies the hashes of a run of blocks, hashing long runs in the worker
+    # processes while the caller checks how the blocks link together
+    # params:
+    #   -blocks: the run of blocks, in order
+    #   -check_links: called with no arguments while the blocks are being
+    #   hashed, returns false if the run is invalid for any other reason
+    # returns:
+    #   -true if every block's hash is right and check_links passed
+    def verify_blocks(self, blocks, check_links = None):
+        # blocks are in height order, so those covered by a checkpoint come first
+        start = 0
+        while start < len(blocks) and blocks[start].index < self.last_checkpoint:
+            start += 1
+        if self.pool == None or len(blocks) - start < self.PARALLEL_MIN_BLOCKS:
+            if check_links != None and not check_links():
+                return False
+            for block in blocks[start:]:
+                if not verify_contents(block):
+                    logging.info("block at height %d has the wrong hash", block.index)
+                    return False
+            return True
+
+        task_starts = iter(xrange(start, len(blocks), self.BLOCKS_PER_TASK))
+        pending = deque()
+        for i in range(self.workers * self.TASKS_AHEAD_PER_WORKER):
+            self.__submit_task(blocks, task_starts, pending)
+        if check_links != None and not check_links():
+            return False
+        while len(pending) > 0:
+            task_start, result = pending.popleft()
+            position = result.get()
+            if position != None:
+                # tasks already handed out are left to finish on their own
+                logging.info("block at height %d has the wrong hash", \
+                    blocks[task_start + position].index)
+                return False
+            self.__submit_task(blocks, task_starts, pending)
+        return True
+
+    # hands the next task of a run of blocks to the workers
+    # params:
+    #   -blocks: the run of blocks
+    #   -task_starts: an iterator over where in the run each task starts
+    #   -pending: the queue of (start, AsyncResult) of tasks handed out
+    def __submit_task(self, blocks, task_starts, pending):
+        task_start = next(task_starts, None)
+        if task_start == None:
+            return
+        task = [hash_fields(block) for block in \
+            blocks[task_start:task_start + self.BLOCKS_PER_TASK]]
+        pending.append((task_start, self.pool.apply_async(verify_hashes, [task])))
+
+    # stops the worker processes
+    def close(self):
+        if self.pool != None:
+            self.pool.terminate()
+            self.pool.join()
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# compactchain
+# a columnar in memory chain of blocks that can stand in for the list of blocks
+# in a Blockchain. each field is kept in its own array: hashes as raw 32 byte
+# digests in one contiguous buffer, miner ids as indexes into a table of the
+# distinct ids and previous hashes not at all since they are the hash of the
+# block before. the few blocks carrying transactions keep them in a map by
+# position. Block objects are only created when a block is read
+
+from array import array
+from block import Block
+import binascii
+
+class CompactChain(object):
+
+    HASH_SIZE = 32
+    # stored in place of the difficulty of blocks without proof of work
+    NO_DIFFICULTY = -1
+
+    # params:
+    #   -blocks: blocks to start with, in order
+    def __init__(self, blocks = None):
+        self.hashes = bytearray()
+        self.timestamps = array("d")
+        self.data = array("l")
+        self.miners = array("I")
+        self.difficulties = array("h")
+        self.nonces = array("L")
+        # the distinct miner ids and their positions in the table
+        self.miner_ids = []
+        self.miner_positions = {}
+        # map of position to (merkle root, transactions) of blocks that have them
+        self.transactions = {}
+        # the index and previous hash of the first block, the rest follow on
+        self.first_index = 0
+        self.first_previous_hash = 0
+        if blocks != None:
+            self.extend(blocks)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.__read(i) for i in xrange(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("compact chain index out of range")
+        return self.__read(key)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.__read(i)
+
+    # gets the hash of a block without creating the block
+    # params:
+    #   -position: the block's position in the chain
+    # returns:
+    #   -the hash as a hex string
+    def hash_at(self, position):
+        start = position * self.HASH_SIZE
+        return binascii.hexlify(self.hashes[start:start + self.HASH_SIZE])
+
+    # gets the id of the miner of a block without creating the block
+    # params:
+    #   -position: the block's position in the chain
+    # returns:
+    #   -the miner id
+    def miner_at(self, position):
+        return self.miner_ids[self.miners[position]]
+
+    def __read(self, position):
+        previous_hash = self.first_previous_hash
+        if position > 0:
+            previous_hash = self.hash_at(position - 1)
+        difficulty = self.difficulties[position]
+        nonce = None
+        if difficulty == self.NO_DIFFICULTY:
+            difficulty = None
+        else:
+            nonce = self.nonces[position]
+        merkle_root, transactions = self.transactions.get(position, (None, None))
+        return Block.restore(self.first_index + position, previous_hash, \
+            self.timestamps[position], self.data[position], \
+            self.miner_ids[self.miners[position]], self.hash_at(position), \
+            difficulty, nonce, merkle_root, transactions)
+
+    # removes blocks from the end of the chain, del chain[height:], or from
+    # the start of it, del chain[:count]
+    # params:
+    #   -key: a slice from the first position to remove to the end, or from
+    #   the start to the first position to keep
+    def __delitem__(self, key):
+        if not isinstance(key, slice) or key.step != None or \
+            (key.start not in (None, 0) and key.stop != None):
+            raise TypeError("only blocks at the start or end of the chain can be removed")
+        if key.stop != None:
+            self.__drop_front(key.stop)
+            return
+        start = key.start or 0
+        if start < 0:
+            start = max(0, start + len(self))
+        if start >= len(self):
+            return
+        del self.hashes[start * self.HASH_SIZE:]
+        for column in (self.timestamps, self.data, self.miners, \
+            self.difficulties, self.nonces):
+            del column[start:]
+        for position in self.transactions.keys():
+            if position >= start:
+                del self.transactions[position]
+
+    # drops blocks from the start of the chain
+    # params:
+    #   -count: the number of blocks to drop
+    def __drop_front(self, count):
+        if count < 0:
+            count = max(0, count + len(self))
+        count = min(count, len(self))
+        if count == 0:
+            return
+        self.first_previous_hash = self.hash_at(count - 1)
+        self.first_index += count
+        del self.hashes[:count * self.HASH_SIZE]
+        for column in (self.timestamps, self.data, self.miners, \
+            self.difficulties, self.nonces):
+            del column[:count]
+        self.transactions = dict((position - count, txs) for position, txs in \
+            self.transactions.items() if position >= count)
+
+    # appends a block to the end of the chain
+    # params:
+    #   -block: the block to append
+    def append(self, block):
+        self.extend([block])
+
+    # appends blocks to the end of the chain. the blocks must follow on from
+    # the last block since previous hashes aren't stored
+    # params:
+    #   -blocks: the blocks to append, in order
+    def extend(self, blocks):
+        for block in blocks:
+            if len(self) == 0:
+                self.first_index = block.index
+                self.first_previous_hash = block.previous_hash
+            elif block.index != self.first_index + len(self) or \
+            block.previous_hash != self.hash_at(len(self) - 1):
+                raise ValueError("block at height %d doesn't follow on from the " \
+                    "last block" % block.index)
+            if not isinstance(block.data, (int, long)):
+                raise TypeError("compact chains only hold integer block data")
+            if block.transactions != None:
+                self.transactions[len(self)] = (block.merkle_root, block.transactions)
+            self.hashes.extend(binascii.unhexlify(block.hash))
+            self.timestamps.append(block.timestamp)
+            self.data.append(block.data)
+            self.miners.append(self.__miner_position(block.mined_by))
+            if block.difficulty == None:
+                self.difficulties.append(self.NO_DIFFICULTY)
+                self.nonces.append(0)
+            else:
+                self.difficulties.append(block.difficulty)
+                self.nonces.append(block.nonce)
+
+    # gets the position of a miner id in the table, adding it if it's new
+    # params:
+    #   -miner: the miner id
+    # returns:
+    #   -the position in the table
+    def __miner_position(self, miner):
+        position = self.miner_positions.get(miner)
+        if position == None:
+            position = len(self.miner_ids)
+            self.miner_ids.append(miner)
+            self.miner_positions[miner] = position
+        return position
+
+    # the number of bytes the columns take up
+    # returns:
+    #   -the size in bytes, not counting the miner id table or transactions
+    def size_in_bytes(self):
+        size = len(self.hashes)
+        for column in (self.timestamps, self.data, self.miners, \
+            self.difficulties, self.nonces):
+            size += column.itemsize * len(column)
+        return size
+
+    # nothing to flush, the chain only lives in memory
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return "<CompactChain: %d blocks, %d bytes>" % (len(self), self.size_in_bytes())
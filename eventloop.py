@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# eventloop
+# a small single threaded event loop that multiplexes socket readiness and
+# timers so a node can serve many peers without a thread per connection
+
+import heapq
+import itertools
+import logging
+import select
+import time
+
+class EventLoop(object):
+
+    def __init__(self):
+        self.readers = {}
+        self.timers = []
+        self.timer_seq = itertools.count()
+        self.running = False
+        # poll() has no FD_SETSIZE limit, fall back to select() where it
+        # isn't available
+        if hasattr(select, "poll"):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+
+    # registers a callback to run whenever a socket is readable
+    # params:
+    #   -sock: the socket to watch
+    #   -callback: called with the socket when it is readable
+    def add_reader(self, sock, callback):
+        fd = sock.fileno()
+        self.readers[fd] = (sock, callback)
+        if self.poller != None:
+            self.poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    # stops watching a socket
+    # params:
+    #   -sock: the socket to stop watching
+    def remove_reader(self, sock):
+        fd = sock.fileno()
+        if self.readers.has_key(fd):
+            del self.readers[fd]
+            if self.poller != None:
+                self.poller.unregister(fd)
+
+    # schedules a callback to run once after a delay
+    # params:
+    #   -delay: seconds to wait before running the callback
+    #   -callback: the function to call
+    def call_later(self, delay, callback):
+        heapq.heappush(self.timers, (time.time() + delay, \
+            next(self.timer_seq), callback))
+
+    # schedules a callback to run repeatedly
+    # params:
+    #   -interval: seconds between runs of the callback
+    #   -callback: the function to call
+    def call_every(self, interval, callback):
+        def periodic():
+            try:
+                callback()
+            finally:
+                self.call_later(interval, periodic)
+        self.call_later(interval, periodic)
+
+    # stops the loop after the current iteration
+    def stop(self):
+        self.running = False
+
+    # runs the loop until stop() is called
+    def run(self):
+        self.running = True
+        while self.running:
+            self.__run_once()
+
+    def __run_once(self):
+        timeout = None
+        if len(self.timers) > 0:
+            timeout = max(0, self.timers[0][0] - time.time())
+
+        for fd in self.__poll(timeout):
+            if self.readers.has_key(fd):
+                sock, callback = self.readers[fd]
+                callback(sock)
+
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self.timers)
+            try:
+                callback()
+            except Exception:
+                logging.exception("exception running scheduled task")
+
+    # waits for sockets to become readable
+    # params:
+    #   -timeout: the maximum number of seconds to wait, None to wait forever
+    # returns:
+    #   -a list of readable file descriptors
+    def __poll(self, timeout):
+        if self.poller != None:
+            if timeout != None:
+                timeout = timeout * 1000
+            return [fd for fd, _ in self.poller.poll(timeout)]
+        readable, _, _ = select.select(self.readers.keys(), [], [], timeout)
+        return readable
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# handlerpool
+# a fixed number of worker threads handling received messages from a bounded
+# queue, so a burst of messages waits in the queue or is shed instead of
+# starting a thread for each one. queued messages are handled most urgent
+# priority first and in the order they arrived within a priority. messages
+# from the same sender are never handled at the same time or out of order
+# within a priority, so a single sender can't tie up every worker. when the
+# queue is full a message more urgent than the least urgent one queued takes
+# its place, otherwise the new message is shed
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+class HandlerPool(object):
+
+    # params:
+    #   -handler: called with each item by a worker
+    #   -workers: the number of worker threads
+    #   -max_queued: the most items waiting to be handled
+    #   -on_shed: called with each item that is shed, from the thread that
+    #   submitted the item that pushed it out
+    def __init__(self, handler, workers, max_queued, on_shed = None):
+        self.handler = handler
+        self.max_queued = max_queued
+        self.on_shed = on_shed
+        # entries are [priority, sequence, key, item]
+        self.queue = []
+        self.sequence = itertools.count()
+        # map of priority to the number of entries in queue with it
+        self.counts = {}
+        # map of key to the entries set aside while its sender is being
+        # handled by another worker
+        self.deferred = {}
+        self.deferred_count = 0
+        # keys being handled right now
+        self.active = set()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target = self.__run, name = "Handler-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # the number of items waiting to be handled
+    def __len__(self):
+        return len(self.queue) + self.deferred_count
+
+    # queues an item to be handled
+    # params:
+    #   -priority: how urgent the item is, lower is more urgent
+    #   -key: items with the same key, such as a sender, are handled one at
+    #   a time
+    #   -item: passed to the handler
+    # returns:
+    #   -true if the item was queued, false if it was shed
+    def submit(self, priority, key, item):
+        shed = None
+        with self.cond:
+            if self.stopped:
+                return False
+            if len(self) >= self.max_queued:
+                if len(self.counts) == 0 or max(self.counts) <= priority:
+                    shed = item
+                else:
+                    shed = self.__remove_least_urgent()[3]
+            if shed is not item:
+                self.__push([priority, next(self.sequence), key, item])
+                self.cond.notify()
+        if shed != None and self.on_shed != None:
+            self.on_shed(shed)
+        return shed is not item
+
+    # adds an entry to the queue, the cond must be held
+    def __push(self, entry):
+        heapq.heappush(self.queue, entry)
+        self.counts[entry[0]] = self.counts.get(entry[0], 0) + 1
+
+    # takes the most urgent entry off of the queue, the cond must be held
+    def __pop(self):
+        entry = heapq.heappop(self.queue)
+        self.__uncount(entry[0])
+        return entry
+
+    def __uncount(self, priority):
+        count = self.counts[priority] - 1
+        if count == 0:
+            del self.counts[priority]
+        else:
+            self.counts[priority] = count
+
+    # takes the least urgent and latest entry off of the queue, the cond must
+    # be held and the queue not empty
+    # returns:
+    #   -the entry
+    def __remove_least_urgent(self):
+        worst = 0
+        for i in xrange(1, len(self.queue)):
+            if self.queue[i][:2] > self.queue[worst][:2]:
+                worst = i
+        entry = self.queue[worst]
+        self.queue[worst] = self.queue[-1]
+        self.queue.pop()
+        heapq.heapify(self.queue)
+        self.__uncount(entry[0])
+        return entry
+
+    # takes the most urgent entry whose key isn't being handled, setting aside
+    # the entries ahead of it until their keys are free. the cond must be held
+    # returns:
+    #   -the entry, None if every queued entry's key is being handled
+    def __next_entry(self):
+        while len(self.queue) > 0:
+            entry = self.__pop()
+            if entry[2] not in self.active:
+                return entry
+            self.deferred.setdefault(entry[2], []).append(entry)
+            self.deferred_count += 1
+        return None
+
+    # marks a key as no longer being handled and puts back the entries set
+    # aside for it. the cond must be held
+    def __release(self, key):
+        self.active.discard(key)
+        entries = self.deferred.pop(key, None)
+        if entries != None:
+            self.deferred_count -= len(entries)
+            for entry in entries:
+                self.__push(entry)
+            self.cond.notify_all()
+
+    def __run(self):
+        while True:
+            with self.cond:
+                entry = None
+                while not self.stopped:
+                    entry = self.__next_entry()
+                    if entry != None:
+                        break
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                priority, sequence, key, item = entry
+                self.active.add(key)
+            try:
+                self.handler(item)
+            except Exception:
+                logging.exception("exception handling message")
+            with self.cond:
+                self.__release(key)
+
+    # stops the workers, waiting for those handling an item to finish it.
+    # items still queued are dropped
+    # params:
+    #   -timeout: the most seconds to wait for the workers
+    def stop(self, timeout = None):
+        with self.cond:
+            self.stopped = True
+            del self.queue[:]
+            self.counts = {}
+            self.deferred = {}
+            self.deferred_count = 0
+            self.cond.notify_all()
+        deadline = None
+        if timeout != None:
+            deadline = time.time() + timeout
+        for worker in self.workers:
+            if worker is threading.current_thread():
+                continue
+            if deadline == None:
+                worker.join()
+            else:
+                worker.join(max(0, deadline - time.time()))
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# lrucache
+# bounded collections that forget the least recently used entries first
+
+from collections import OrderedDict
+import threading
+
+class LRUSet(object):
+
+    # params:
+    #   -capacity: the most entries kept
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        # shared between connection threads
+        self.lock = threading.Lock()
+
+    # adds an entry, making it the most recently used
+    # params:
+    #   -key: the entry to add
+    # returns:
+    #   -true if the entry wasn't in the set already
+    def add(self, key):
+        with self.lock:
+            new = key not in self.entries
+            if not new:
+                del self.entries[key]
+            self.entries[key] = True
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last = False)
+            return new
+
+    # removes an entry if it is in the set
+    # params:
+    #   -key: the entry to remove
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+class LRUCache(object):
+
+    # params:
+    #   -capacity: the most entries kept, nothing is kept if 0
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # looks up an entry, making it the most recently used
+    # params:
+    #   -key: the entry's key
+    # returns:
+    #   -the entry's value, None if it isn't cached
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value != None:
+                self.entries[key] = value
+            return value
+
+    # adds or replaces an entry, making it the most recently used
+    # params:
+    #   -key: the entry's key
+    #   -value: the entry's value, which can't be None
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            if self.capacity <= 0:
+                return
+            self.entries[key] = value
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last = False)
+
+    # removes every entry
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
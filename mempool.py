@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# mempool
+# the pool of transactions waiting to be mined, bounded by count and by bytes.
+# transactions are ranked by fee per byte (then by arrival) so miners take the
+# best paying ones first, and when the pool is full the worst paying ones are
+# evicted to make room for better ones
+
+import bisect
+import logging
+import threading
+
+class Mempool(object):
+
+    # outcomes of add
+    TX_ADDED = "added"
+    TX_DUPLICATE = "duplicate"
+    TX_INVALID = "invalid"
+    TX_FEE_TOO_LOW = "fee too low"
+
+    # params:
+    #   -max_txs: the most transactions kept
+    #   -max_bytes: the most bytes of transactions kept
+    def __init__(self, max_txs = 10000, max_bytes = 4 * 1024 * 1024):
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        # map of txid to (rank key, transaction)
+        self.txs = {}
+        # rank keys in order, best paying first
+        self.ranking = []
+        self.size_bytes = 0
+        self.arrivals = 0
+        # bumped whenever the contents change so miners know to refresh
+        self.version = 0
+        self.lock = threading.Lock()
+
+    # the key a transaction is ranked by, smallest first
+    def __rank_key(self, tx):
+        self.arrivals += 1
+        return (-float(tx.fee) / tx.size(), self.arrivals, tx.txid)
+
+    # adds a transaction, evicting the worst paying transactions if the pool
+    # is full and the new one pays better than them
+    # params:
+    #   -tx: the transaction
+    # returns:
+    #   -one of the TX_ outcomes
+    def add(self, tx):
+        if not tx.is_valid():
+            return self.TX_INVALID
+        with self.lock:
+            if self.txs.has_key(tx.txid):
+                return self.TX_DUPLICATE
+            key = self.__rank_key(tx)
+            size = tx.size()
+            if size > self.max_bytes:
+                return self.TX_FEE_TOO_LOW
+            # work out which transactions have to go to make room, nothing is
+            # evicted unless every one of them pays less
+            count = len(self.txs)
+            size_bytes = self.size_bytes
+            evict = 0
+            while count >= self.max_txs or size_bytes + size > self.max_bytes:
+                worst = self.ranking[-1 - evict]
+                if worst[0] <= key[0]:
+                    return self.TX_FEE_TOO_LOW
+                count -= 1
+                size_bytes -= self.txs[worst[2]][1].size()
+                evict += 1
+            for worst in self.ranking[len(self.ranking) - evict:]:
+                logging.debug("mempool full - evicting %s", worst[2])
+                self.__remove(worst[2])
+            self.txs[tx.txid] = (key, tx)
+            bisect.insort(self.ranking, key)
+            self.size_bytes += size
+            self.version += 1
+            return self.TX_ADDED
+
+    def __remove(self, txid):
+        key, tx = self.txs.pop(txid)
+        del self.ranking[bisect.bisect_left(self.ranking, key)]
+        self.size_bytes -= tx.size()
+
+    # removes transactions, such as those that were just mined
+    # params:
+    #   -txids: the ids of the transactions
+    def remove(self, txids):
+        with self.lock:
+            removed = False
+            for txid in txids:
+                if self.txs.has_key(txid):
+                    self.__remove(txid)
+                    removed = True
+            if removed:
+                self.version += 1
+
+    # picks the best paying transactions for a block
+    # params:
+    #   -max_txs: the most transactions to pick
+    # returns:
+    #   -a list of transactions, best paying first
+    def select(self, max_txs):
+        with self.lock:
+            return [self.txs[key[2]][1] for key in self.ranking[:max_txs]]
+
+    def __contains__(self, txid):
+        return self.txs.has_key(txid)
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __repr__(self):
+        return "<Mempool: %d transactions, %d bytes>" % (len(self.txs), self.size_bytes)
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# merkle
+# Merkle trees over transaction ids. a block commits to its transactions with
+# the root of the tree, and an inclusion proof (the sibling hashes on the path
+# from a transaction up to the root) shows a transaction is in a block without
+# needing the block's other transactions. levels with an odd number of nodes
+# pair the last node with itself
+
+import binascii
+import hashlib
+
+# the root of a tree with no leaves
+EMPTY_ROOT = "0" * 64
+
+# positions of a sibling in a proof
+LEFT = "L"
+RIGHT = "R"
+
+def _hash_pair(left, right):
+    return hashlib.sha256(left + right).digest()
+
+def _next_level(level):
+    if len(level) % 2 == 1:
+        level = level + [level[-1]]
+    return [_hash_pair(level[i], level[i + 1]) for i in xrange(0, len(level), 2)]
+
+# computes the Merkle root of a list of transaction ids
+# params:
+#   -txids: the ids as hex strings, in block order
+# returns:
+#   -the root as a hex string
+def merkle_root(txids):
+    if len(txids) == 0:
+        return EMPTY_ROOT
+    level = [binascii.unhexlify(txid) for txid in txids]
+    while len(level) > 1:
+        level = _next_level(level)
+    return binascii.hexlify(level[0])
+
+# builds the inclusion proof for one transaction
+# params:
+#   -txids: the ids of every transaction in the block, in block order
+#   -index: the position of the transaction to prove
+# returns:
+#   -a list of (sibling hash hex, LEFT or RIGHT) from the leaf up
+def merkle_proof(txids, index):
+    if index < 0 or index >= len(txids):
+        raise IndexError("transaction index out of range")
+    level = [binascii.unhexlify(txid) for txid in txids]
+    proof = []
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        if index % 2 == 0:
+            proof.append((binascii.hexlify(level[index + 1]), RIGHT))
+        else:
+            proof.append((binascii.hexlify(level[index - 1]), LEFT))
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+# checks an inclusion proof
+# params:
+#   -txid: the id of the transaction
+#   -proof: the proof from merkle_proof
+#   -root: the Merkle root the block commits to
+# returns:
+#   -true if the proof shows the transaction is under the root
+def verify_proof(txid, proof, root):
+    node = binascii.unhexlify(txid)
+    for sibling, side in proof:
+        sibling = binascii.unhexlify(sibling)
+        if side == LEFT:
+            node = _hash_pair(sibling, node)
+        else:
+            node = _hash_pair(node, sibling)
+    return binascii.hexlify(node) == root
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# metrics
+# counters, gauges and latency histograms describing what a node is doing,
+# available as a snapshot from code or in the Prometheus text format from a
+# local HTTP endpoint. values that live elsewhere, like the chain height or
+# lock wait times, are registered as callbacks and read when asked for
+
+import BaseHTTPServer
+import bisect
+import logging
+import threading
+
+class Metrics(object):
+
+    # prefixed to every metric name when rendered
+    PREFIX = "blockchain_"
+    # upper bounds in seconds of the latency histogram buckets
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+
+    # params:
+    #   -buckets: the upper bounds of the histogram buckets, DEFAULT_BUCKETS if None
+    def __init__(self, buckets = None):
+        if buckets == None:
+            buckets = self.DEFAULT_BUCKETS
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # map of metric name to its type and help text
+        self.descriptions = {}
+        # map of metric name to a map of labels to value. labels are a sorted
+        # tuple of (name, value) pairs. histogram values are a list of the
+        # count in each bucket followed by the sum and the count
+        self.values = {}
+        # map of metric name to the function returning its value
+        self.callbacks = {}
+
+    # describes a metric, which is otherwise created the first time it's used
+    # params:
+    #   -name: the metric's name
+    #   -kind: COUNTER, GAUGE or HISTOGRAM
+    #   -help: what the metric measures
+    def describe(self, name, kind, help):
+        with self.lock:
+            self.descriptions[name] = (kind, help)
+
+    # adds to a counter
+    # params:
+    #   -name: the counter's name
+    #   -amount: what to add
+    #   -labels: the counter's labels
+    def inc(self, name, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.get(name)
+            if series == None:
+                series = self.values[name] = {}
+                self.descriptions.setdefault(name, (self.COUNTER, ""))
+            series[key] = series.get(key, 0) + amount
+
+    # sets a gauge
+    # params:
+    #   -name: the gauge's name
+    #   -value: the gauge's value
+    #   -labels: the gauge's labels
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.get(name)
+            if series == None:
+                series = self.values[name] = {}
+                self.descriptions.setdefault(name, (self.GAUGE, ""))
+            series[key] = value
+
+    # records a value, such as a latency, in a histogram
+    # params:
+    #   -name: the histogram's name
+    #   -value: the value to record
+    #   -labels: the histogram's labels
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(name)
+            if series == None:
+                series = self.values[name] = {}
+                self.descriptions.setdefault(name, (self.HISTOGRAM, ""))
+            counts = series.get(key)
+            if counts == None:
+                counts = series[key] = [0] * (len(self.buckets) + 3)
+            counts[bucket] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    # registers a metric whose value is read from a function when the metrics
+    # are rendered or snapshotted
+    # params:
+    #   -name: the metric's name
+    #   -kind: COUNTER or GAUGE
+    #   -help: what the metric measures
+    #   -function: called with no arguments, returns the value
+    def register(self, name, kind, help, function):
+        with self.lock:
+            self.descriptions[name] = (kind, help)
+            self.callbacks[name] = function
+
+    # takes a copy of every metric
+    # returns:
+    #   -a map of metric name to a map of labels to value, where labels are a
+    #   sorted tuple of (name, value) pairs and histogram values are a map
+    #   with the count, the sum and the cumulative count in each bucket
+    def snapshot(self):
+        with self.lock:
+            values = dict((name, dict(series)) for name, series in self.values.items())
+            callbacks = self.callbacks.items()
+            kinds = dict((name, kind) for name, (kind, _) in self.descriptions.items())
+        snapshot = {}
+        for name, series in values.items():
+            if kinds.get(name) == self.HISTOGRAM:
+                series = dict((key, self.__histogram(counts)) \
+                    for key, counts in series.items())
+            snapshot[name] = series
+        for name, function in callbacks:
+            try:
+                snapshot[name] = { () : function() }
+            except Exception:
+                logging.exception("failed to read metric %s", name)
+        return snapshot
+
+    def __histogram(self, counts):
+        buckets = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            buckets.append((bound, total))
+        return { "count" : counts[-1], "sum" : counts[-2], "buckets" : buckets }
+
+    # renders every metric in the Prometheus text exposition format
+    # returns:
+    #   -the metrics as a string
+    def render(self):
+        snapshot = self.snapshot()
+        with self.lock:
+            descriptions = dict(self.descriptions)
+        lines = []
+        for name in sorted(snapshot):
+            kind, help = descriptions.get(name, (self.GAUGE, ""))
+            full_name = self.PREFIX + name
+            if help:
+                lines.append("# HELP %s %s" % (full_name, help))
+            lines.append("# TYPE %s %s" % (full_name, kind))
+            for key, value in sorted(snapshot[name].items()):
+                if kind != self.HISTOGRAM:
+                    lines.append("%s%s %s" % (full_name, _labels(key), _number(value)))
+                    continue
+                for bound, count in value["buckets"]:
+                    lines.append("%s_bucket%s %d" % (full_name, \
+                        _labels(key + (("le", _number(bound)),)), count))
+                lines.append("%s_sum%s %s" % (full_name, _labels(key), \
+                    _number(value["sum"])))
+                lines.append("%s_count%s %d" % (full_name, _labels(key), value["count"]))
+        return "\n".join(lines) + "\n"
+
+def _labels(key):
+    if len(key) == 0:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (name, str(value).replace("\\", "\\\\") \
+        .replace("\"", "\\\"").replace("\n", "\\n")) for name, value in key)
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+# serves the metrics in the Prometheus text format at /metrics from a thread
+# of its own
+class MetricsServer(object):
+
+    # params:
+    #   -metrics: the Metrics to serve
+    #   -port: the port to listen on
+    #   -host: the address to listen on, only the local machine by default
+    def __init__(self, metrics, port, host = "127.0.0.1"):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = metrics.render()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logging.debug("metrics request: " + format, *args)
+
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target = self.httpd.serve_forever, \
+            name = "MetricsServer")
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("serving metrics at http://%s:%d/metrics", host, self.port)
+
+    # stops serving
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
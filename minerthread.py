@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# minerthread
+# a thread that mines on a snapshot of the latest block, independent of the
+# node's message handling. the node hands it a new block to work on whenever
+# its latest block changes, which abandons the stale work right away, and
+# mined blocks are handed back through a queue
+
+from block import Block
+import logging
+import Queue
+import threading
+
+class MinerThread(threading.Thread):
+
+    # params:
+    #   -blockchain: the Blockchain whose solve_block makes each attempt
+    #   -interval: seconds between attempts when mining by guessing the magic
+    #   number, proof of work attempts run back to back
+    def __init__(self, blockchain, interval):
+        threading.Thread.__init__(self, name = "MinerThread")
+        self.daemon = True
+        self.blockchain = blockchain
+        self.interval = interval
+        # mined blocks for the node to add to its blockchain and broadcast
+        self.results = Queue.Queue()
+        # set to abandon the block currently being mined
+        self.cancel = threading.Event()
+        self.condition = threading.Condition()
+        self.template = None
+        # bumped every time the work changes so stale results are dropped
+        self.generation = 0
+        self.stopped = False
+        # mining attempts made, for the node's metrics
+        self.attempts = 0
+
+    # gives the miner a new block to work on
+    # params:
+    #   -template: the block to mine, from Blockchain.new_block_template
+    #   -abandon: true to abandon the current attempt, false to let it finish
+    #   and start the next one on the new block, for when only the block's
+    #   transactions have changed
+    def set_work(self, template, abandon = True):
+        with self.condition:
+            self.template = template
+            if abandon:
+                self.generation += 1
+                self.cancel.set()
+            self.condition.notify()
+
+    # stops mining
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.cancel.set()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.template == None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                template = self.template
+                generation = self.generation
+                self.cancel.clear()
+
+            if template.difficulty == None:
+                if self.cancel.wait(self.interval):
+                    continue
+                # pick up transactions that arrived while waiting
+                with self.condition:
+                    if generation == self.generation:
+                        template = self.template
+
+            block = self.attempt(template)
+            if block != None and generation == self.generation:
+                logging.debug("mined block at height %d", block.index)
+                self.results.put(block)
+
+    # makes one mining attempt on a copy of a block, which is also how a node
+    # mines without the thread running
+    # params:
+    #   -template: the block to mine
+    #   -timestamp: the mined block's timestamp, the current time if None
+    # returns:
+    #   -the mined block, or None if the attempt failed
+    def attempt(self, template, timestamp = None):
+        # each attempt gets a fresh timestamp
+        block = Block(template.index, template.previous_hash, template.data, \
+            template.mined_by, template.difficulty, template.nonce, \
+            template.transactions, timestamp)
+        self.attempts += 1
+        try:
+            if self.blockchain.solve_block(block, self.cancel):
+                return block
+        except Exception:
+            logging.exception("exception while mining")
+        return None
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# peertable
+# the addresses of nodes a node knows about, learned from --peers, from the
+# nodes that connect to it and from its peers' PEERS messages, along with how
+# many peers it keeps and how it ranks them. addresses that fail are retried
+# after an exponentially growing backoff and forgotten after too many
+# failures in a row. peers are scored by their round trip time, measured with
+# PING and PONG, divided by the share of pings they answered, so the worst
+# scoring peer is the one dropped when the node rotates its peers
+
+import threading
+
+class PeerTable(object):
+
+    # the most addresses remembered, the least recently heard of are
+    # forgotten first
+    MAX_ADDRESSES = 1024
+    # the most addresses sent in a single PEERS
+    MAX_SHARED = 100
+    # seconds before an address that failed is tried again, doubling with
+    # each failure in a row up to the maximum
+    RETRY_BASE = 10
+    RETRY_MAX = 600
+    # failures in a row before an address is forgotten
+    MAX_FAILURES = 8
+
+    # params:
+    #   -max_peers: the most peers kept, inbound and outbound, a node that
+    #   connects when the table is full is sent other addresses to try
+    #   -target_outbound: the number of peers the node connects to itself,
+    #   filled from the known addresses and rotated. 0 connects only to the
+    #   peers it is given and never rotates them
+    def __init__(self, max_peers = 32, target_outbound = 8):
+        self.max_peers = max_peers
+        self.target_outbound = target_outbound
+        # map of peer id to [time last heard of, failures in a row, time it
+        # may next be tried]
+        self.addresses = {}
+        self.lock = threading.Lock()
+
+    # remembers an address
+    # params:
+    #   -peerid: the address, host:port
+    #   -now: the current time
+    def add(self, peerid, now):
+        with self.lock:
+            entry = self.addresses.get(peerid)
+            if entry != None:
+                entry[0] = now
+                return
+            if len(self.addresses) >= self.MAX_ADDRESSES:
+                oldest = min(self.addresses, key = lambda key: self.addresses[key][0])
+                del self.addresses[oldest]
+            self.addresses[peerid] = [now, 0, now]
+
+    # notes that a peer at an address answered
+    # params:
+    #   -peerid: the address
+    #   -now: the current time
+    def succeeded(self, peerid, now):
+        with self.lock:
+            entry = self.addresses.get(peerid)
+            if entry != None:
+                entry[0] = now
+                entry[1] = 0
+
+    # notes that an address couldn't be reached or refused us, it isn't tried
+    # again until its backoff has passed
+    # params:
+    #   -peerid: the address
+    #   -now: the current time
+    def failed(self, peerid, now):
+        with self.lock:
+            entry = self.addresses.get(peerid)
+            if entry == None:
+                return
+            entry[1] += 1
+            if entry[1] >= self.MAX_FAILURES:
+                del self.addresses[peerid]
+                return
+            entry[2] = now + min(self.RETRY_MAX, self.RETRY_BASE * (2 ** (entry[1] - 1)))
+
+    # picks addresses to connect to, those that haven't failed first
+    # params:
+    #   -count: the most addresses to pick
+    #   -exclude: addresses not to pick, such as those already connected
+    #   -now: the current time
+    #   -rand: the random number generator to pick with
+    # returns:
+    #   -a list of addresses
+    def candidates(self, count, exclude, now, rand):
+        with self.lock:
+            ready = [(entry[1], peerid) for peerid, entry in self.addresses.items() \
+                if entry[2] <= now and peerid not in exclude]
+        rand.shuffle(ready)
+        ready.sort(key = lambda candidate: candidate[0])
+        return [peerid for failures, peerid in ready[:count]]
+
+    # picks addresses to share with a peer, those that haven't failed
+    # params:
+    #   -count: the most addresses to pick
+    #   -rand: the random number generator to pick with
+    # returns:
+    #   -a list of addresses
+    def sample(self, count, rand):
+        with self.lock:
+            good = [peerid for peerid, entry in self.addresses.items() if entry[1] == 0]
+        if len(good) > count:
+            good = rand.sample(good, count)
+        return good
+
+    # scores a peer, lower is better
+    # params:
+    #   -peer: the BlockchainPeer
+    # returns:
+    #   -its round trip time divided by the share of pings it answered, or
+    #   None if it hasn't answered a ping yet
+    @staticmethod
+    def score(peer):
+        if peer.rtt == None:
+            return None
+        return peer.rtt / peer.reliability()
+
+    # orders peers from best to worst score, peers that haven't been measured
+    # go after those that have
+    # params:
+    #   -peers: the peers to order
+    # returns:
+    #   -a new list of the peers
+    @staticmethod
+    def rank(peers):
+        def key(peer):
+            score = PeerTable.score(peer)
+            return (score == None, score)
+        return sorted(peers, key = key)
+
+    def __len__(self):
+        return len(self.addresses)
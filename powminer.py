@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# powminer
+# proof of work mining - searches for a nonce that makes a block's SHA-256 hash
+# fall below a difficulty target, splitting the nonce space across a pool of
+# worker processes and keeping hashrate and time to block statistics
+
+import hashlib
+import multiprocessing
+import time
+
+# the largest difficulty (leading zero bits) a block can ask for
+MAX_DIFFICULTY = 255
+
+# the target a block's hash must be below for a difficulty
+# params:
+#   -difficulty: the number of leading zero bits required
+# returns:
+#   -the target as an integer
+def difficulty_target(difficulty):
+    return 1 << (256 - difficulty)
+
+# determines if a block's hash satisfies its difficulty
+# params:
+#   -block_hash: the block's hash as a hex string
+#   -difficulty: the number of leading zero bits required
+# returns:
+#   -true if the hash is below the target
+def meets_difficulty(block_hash, difficulty):
+    return int(block_hash, 16) < difficulty_target(difficulty)
+
+# searches a range of nonces, run in the worker processes
+# params:
+#   -task: (hash prefix, first nonce, number of nonces, difficulty)
+# returns:
+#   -(nonce found or None, number of hashes computed)
+def search_nonces(task):
+    prefix, start, count, difficulty = task
+    # digests compare like big endian integers since they're the same length
+    target = ("%064x" % (difficulty_target(difficulty) - 1)).decode("hex")
+    base = hashlib.sha256(prefix)
+    for nonce in xrange(start, start + count):
+        attempt = base.copy()
+        attempt.update(str(nonce))
+        if attempt.digest() <= target:
+            return nonce, nonce - start + 1
+    return None, count
+
+class PowMiner(object):
+
+    # nonces handed to a worker at a time, small enough that a round finishes
+    # soon after a worker finds a nonce
+    NONCES_PER_TASK = 20000
+
+    # params:
+    #   -workers: the number of worker processes, one per core if None
+    def __init__(self, workers = None):
+        if workers == None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        # the pool is created up front, before the node starts any threads
+        self.pool = multiprocessing.Pool(workers)
+        self.total_hashes = 0
+        self.total_seconds = 0.0
+        self.blocks_found = 0
+        self.times_to_block = []
+        # the block height being worked on and when work on it started
+        self.work_height = None
+        self.work_started = None
+
+    # searches for a nonce that satisfies the block's difficulty, giving up
+    # after a time limit so the caller can refresh the block
+    # params:
+    #   -block: the block to mine, its difficulty must be set
+    #   -max_seconds: how long to search before giving up
+    #   -cancel: a threading.Event that stops the search as soon as the
+    #   current round of tasks finishes when it is set
+    # returns:
+    #   -true if a nonce was found, in which case the block's nonce and hash
+    #   are updated, false otherwise
+    def mine(self, block, max_seconds, cancel = None):
+        if self.work_height != block.index:
+            self.work_height = block.index
+            self.work_started = time.time()
+
+        prefix = block.hash_prefix()
+        start = time.time()
+        next_nonce = 0
+        found = None
+        while found == None and time.time() - start < max_seconds and \
+            (cancel == None or not cancel.is_set()):
+            tasks = []
+            for i in range(self.workers):
+                tasks.append((prefix, next_nonce, self.NONCES_PER_TASK, block.difficulty))
+                next_nonce += self.NONCES_PER_TASK
+            for nonce, hashes in self.pool.imap_unordered(search_nonces, tasks):
+                self.total_hashes += hashes
+                if nonce != None and (found == None or nonce < found):
+                    found = nonce
+        self.total_seconds += time.time() - start
+
+        if found == None:
+            return False
+        block.set_nonce(found)
+        self.blocks_found += 1
+        self.times_to_block.append(time.time() - self.work_started)
+        self.work_height = None
+        return True
+
+    # gets the mining statistics
+    # returns:
+    #   -a dictionary of statistics
+    def stats(self):
+        hashrate = 0.0
+        if self.total_seconds > 0:
+            hashrate = self.total_hashes / self.total_seconds
+        avg_time_to_block = None
+        if len(self.times_to_block) > 0:
+            avg_time_to_block = sum(self.times_to_block) / len(self.times_to_block)
+        return {
+            "workers" : self.workers,
+            "hashes" : self.total_hashes,
+            "seconds" : self.total_seconds,
+            "hashes_per_sec" : hashrate,
+            "blocks_found" : self.blocks_found,
+            "avg_time_to_block" : avg_time_to_block
+        }
+
+    # stops the worker processes
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
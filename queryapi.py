@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# queryapi
+# a read only HTTP interface to a node's blockchain answering in JSON, for
+# tools and services on the same machine that don't speak the peer protocol.
+# responses are kept in an LRU cache by path, which is emptied whenever the
+# tip changes so an answer is never from before the latest block
+#
+#   GET /tip                      the latest block's height, hash and work
+#   GET /blocks/HEIGHT            the block at a height
+#   GET /blocks/hash/HASH         a block by hash, on the blockchain or a side branch
+#   GET /blocks?start=H&limit=N   up to N blocks from height H and where the next page starts
+#   GET /miners                   how many of the blocks each miner mined
+
+import BaseHTTPServer
+import binascii
+import json
+import logging
+from lrucache import LRUCache
+import socket
+import SocketServer
+import string
+import threading
+import time
+import urlparse
+
+# answers one request, raised to send an error
+class QueryError(Exception):
+
+    # params:
+    #   -status: the HTTP status
+    #   -message: what was wrong
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+# a block as JSON, transaction payloads are hex since they can hold any bytes
+# params:
+#   -block: the Block
+# returns:
+#   -a map of field name to value
+def block_json(block):
+    transactions = None
+    if block.transactions != None:
+        transactions = [{
+            "txid" : tx.txid,
+            "sender" : tx.sender,
+            "fee" : tx.fee,
+            "timestamp" : tx.timestamp,
+            "payload" : binascii.hexlify(tx.payload)
+        } for tx in block.transactions]
+    return {
+        "height" : block.index,
+        "hash" : block.hash,
+        "previous_hash" : block.previous_hash,
+        "timestamp" : block.timestamp,
+        "magic_num" : block.data,
+        "mined_by" : block.mined_by,
+        "difficulty" : block.difficulty,
+        "nonce" : block.nonce,
+        "merkle_root" : block.merkle_root,
+        "transactions" : transactions
+    }
+
+# an HTTP server with a thread per connection that can close the connections
+# still open when it stops
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        # map of each open connection's socket to the thread serving it
+        self.connthreads = {}
+        self.connthreads_lock = threading.Lock()
+
+    def process_request_thread(self, request, client_address):
+        with self.connthreads_lock:
+            self.connthreads[request] = threading.current_thread()
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, \
+                client_address)
+        finally:
+            with self.connthreads_lock:
+                self.connthreads.pop(request, None)
+
+    # shuts down the open connections and waits for their threads to finish
+    # params:
+    #   -timeout: the most seconds to wait for the threads
+    def close_connections(self, timeout):
+        with self.connthreads_lock:
+            connthreads = self.connthreads.items()
+        for clientsock, thread in connthreads:
+            try:
+                clientsock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        deadline = time.time() + timeout
+        for clientsock, thread in connthreads:
+            thread.join(max(0, deadline - time.time()))
+
+# serves queries about a blockchain from threads of its own, a thread per
+# connection so clients can keep their connections open
+class QueryServer(object):
+
+    # responses kept in the cache
+    CACHE_SIZE = 4096
+    # seconds to wait on close for the connections still open to finish
+    CLOSE_TIMEOUT = 2
+    # blocks in a page of /blocks when the request doesn't say, and the most
+    DEFAULT_PAGE_BLOCKS = 20
+    MAX_PAGE_BLOCKS = 100
+
+    # params:
+    #   -blockchain: the Blockchain to answer from
+    #   -chain_lock: the RWLock the blockchain is read under
+    #   -get_tip: returns the blockchain's current ChainTip without the lock
+    #   -port: the port to listen on
+    #   -host: the address to listen on, only the local machine by default
+    #   -cache_size: the responses cached, CACHE_SIZE if None and none if 0
+    #   -metrics: the Metrics counting requests, not counted if None
+    def __init__(self, blockchain, chain_lock, get_tip, port, host = "127.0.0.1", \
+        cache_size = None, metrics = None):
+        self.blockchain = blockchain
+        self.chain_lock = chain_lock
+        self.get_tip = get_tip
+        self.metrics = metrics
+        if cache_size == None:
+            cache_size = self.CACHE_SIZE
+        # map of path to (endpoint name, (HTTP status, JSON body)), for the
+        # tip whose hash is cache_tip
+        self.cache = LRUCache(cache_size)
+        self.cache_tip = None
+        self.cache_lock = threading.Lock()
+        # set under the write lock once the server has stopped, so connections
+        # still open never read the blockchain after the node has closed it
+        self.closed = False
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            # keeps connections open between requests, and sends each response
+            # in one write so it isn't held back waiting on the client's ack
+            protocol_version = "HTTP/1.1"
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def do_GET(handler):
+                status, body = server.respond(handler.path)
+                handler.send_response(status)
+                handler.send_header("Content-Type", "application/json")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logging.debug("query request: " + format, *args)
+
+        self.httpd = _ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target = self.httpd.serve_forever, \
+            name = "QueryServer")
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("serving queries at http://%s:%d/", host, self.port)
+
+    # answers a request from the cache, or from the blockchain when it isn't
+    # cached for the current tip
+    # params:
+    #   -path: the request's path and query string
+    # returns:
+    #   -(HTTP status, JSON body)
+    def respond(self, path):
+        start = time.time()
+        tip = self.get_tip()
+        tip_hash = None
+        if tip.block != None:
+            tip_hash = tip.block.hash
+        with self.cache_lock:
+            if tip_hash != self.cache_tip:
+                self.cache.clear()
+                self.cache_tip = tip_hash
+        endpoint, response = self.cache.get(path) or (None, None)
+        cache = "hit"
+        if response == None:
+            cache = "miss"
+            endpoint, response, answered_tip = self.__answer(path)
+            with self.cache_lock:
+                # an answer from before or after the tip the cache is for
+                # isn't kept
+                if answered_tip == self.cache_tip:
+                    self.cache.put(path, (endpoint, response))
+        if self.metrics != None:
+            self.metrics.inc("query_requests_total", endpoint = endpoint, cache = cache)
+            self.metrics.observe("query_seconds", time.time() - start, endpoint = endpoint)
+        return response
+
+    # answers a request from the blockchain under the read lock
+    # params:
+    #   -path: the request's path and query string
+    # returns:
+    #   -(endpoint name, (HTTP status, JSON body), hash of the latest block
+    #   the answer is for)
+    def __answer(self, path):
+        parts = urlparse.urlsplit(path)
+        query = urlparse.parse_qs(parts.query)
+        segments = [segment for segment in parts.path.split("/") if segment != ""]
+        self.chain_lock.acquire_read()
+        try:
+            if self.closed:
+                body = json.dumps({ "error" : "the node is shutting down" })
+                return "unknown", (503, body), None
+            latest = self.blockchain.get_latest_block()
+            answered_tip = None
+            if latest != None:
+                answered_tip = latest.hash
+            endpoint = "unknown"
+            try:
+                if segments == ["tip"]:
+                    endpoint = "tip"
+                    result = self.__tip()
+                elif segments == ["blocks"]:
+                    endpoint = "blocks"
+                    result = self.__blocks(query)
+                elif len(segments) == 2 and segments[0] == "blocks":
+                    endpoint = "block"
+                    result = self.__block_at(segments[1])
+                elif len(segments) == 3 and segments[:2] == ["blocks", "hash"]:
+                    endpoint = "block_by_hash"
+                    result = self.__block_by_hash(segments[2])
+                elif segments == ["miners"]:
+                    endpoint = "miners"
+                    result = self.__miners()
+                else:
+                    raise QueryError(404, "unknown path %s" % parts.path)
+                status = 200
+            except QueryError as e:
+                status = e.status
+                result = { "error" : str(e) }
+        finally:
+            self.chain_lock.release_read()
+        # senders and miner ids are strings of any bytes
+        body = json.dumps(result, separators = (",", ":"), encoding = "latin-1")
+        return endpoint, (status, body), answered_tip
+
+    # gets the lowest height that can be asked for, the snapshot's block once
+    # the blockchain has been pruned
+    def __lowest_height(self):
+        return max(0, self.blockchain.base - 1)
+
+    def __tip(self):
+        tip = self.blockchain.get_tip()
+        if tip.block == None:
+            raise QueryError(404, "the blockchain is empty")
+        return {
+            "height" : tip.height,
+            "hash" : tip.block.hash,
+            "timestamp" : tip.block.timestamp,
+            "mined_by" : tip.block.mined_by,
+            "work" : tip.work,
+            "magic_num" : tip.magic_num,
+            "lowest_height" : self.__lowest_height()
+        }
+
+    def __block_at(self, height):
+        height = _parse_height(height, "height")
+        block = self.blockchain.get_block_at(height)
+        if block == None:
+            if height < self.__lowest_height():
+                raise QueryError(404, "block %d has been pruned" % height)
+            raise QueryError(404, "no block at height %d" % height)
+        result = block_json(block)
+        result["in_chain"] = True
+        result["confirmations"] = self.blockchain.get_height() - height + 1
+        return result
+
+    def __block_by_hash(self, block_hash):
+        block_hash = block_hash.lower()
+        if len(block_hash) != 64 or not all(c in string.hexdigits for c in block_hash):
+            raise QueryError(400, "invalid block hash %s" % block_hash)
+        height = self.blockchain.get_block_height(block_hash)
+        if height != None:
+            block = self.blockchain.get_block_at(height)
+        else:
+            block = self.blockchain.get_block(block_hash)
+        if block == None:
+            raise QueryError(404, "no block %s" % block_hash)
+        result = block_json(block)
+        result["in_chain"] = height != None
+        result["confirmations"] = 0
+        if height != None:
+            result["confirmations"] = self.blockchain.get_height() - height + 1
+        return result
+
+    def __blocks(self, query):
+        lowest = self.__lowest_height()
+        start = lowest
+        if query.has_key("start"):
+            start = _parse_height(query["start"][-1], "start")
+        limit = self.DEFAULT_PAGE_BLOCKS
+        if query.has_key("limit"):
+            limit = _parse_height(query["limit"][-1], "limit")
+            if not 0 < limit <= self.MAX_PAGE_BLOCKS:
+                raise QueryError(400, "limit must be between 1 and %d" % \
+                    self.MAX_PAGE_BLOCKS)
+        if start < lowest:
+            raise QueryError(404, "blocks below height %d have been pruned" % lowest)
+        blocks = []
+        if start == self.blockchain.base - 1:
+            # the snapshot's block is kept on its own
+            blocks.append(self.blockchain.get_block_at(start))
+        blocks += self.blockchain.get_blocks_after(start + len(blocks) - 1, \
+            limit - len(blocks))
+        next_start = start + len(blocks)
+        if next_start > self.blockchain.get_height():
+            next_start = None
+        return { "blocks" : [block_json(block) for block in blocks], \
+            "next_start" : next_start }
+
+    def __miners(self):
+        counts = self.blockchain.get_miner_counts()
+        total = sum(counts.values())
+        miners = sorted(counts.items(), key = lambda item: (-item[1], item[0]))
+        return {
+            "blocks" : total,
+            "from_height" : self.blockchain.base,
+            "miners" : [{ "miner" : miner, "blocks" : count, \
+                "share" : float(count) / total } for miner, count in miners]
+        }
+
+    # stops serving and closes the connections that are still open, any
+    # request they are still making is answered with an error
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.httpd.close_connections(self.CLOSE_TIMEOUT)
+        self.chain_lock.acquire_write()
+        self.closed = True
+        self.chain_lock.release_write()
+
+# parses a non negative integer from a request
+# params:
+#   -value: the string
+#   -name: what it is, for the error
+# returns:
+#   -the integer
+# raises:
+#   -QueryError if it isn't a non negative integer
+def _parse_height(value, name):
+    if not value.isdigit():
+        raise QueryError(400, "invalid %s %s" % (name, value))
+    return int(value)
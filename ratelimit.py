@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# ratelimit
+# token buckets limiting how many messages of each type a node handles from
+# a peer. a bucket holds up to burst tokens and refills at rate tokens a
+# second, and each message handled takes a token. a peer that sends faster
+# than the rate for long enough to empty the bucket has its messages shed
+# until the bucket refills
+
+import threading
+
+class TokenBucket(object):
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    # params:
+    #   -rate: tokens added a second
+    #   -burst: the most tokens the bucket holds, and the tokens it starts with
+    #   -now: the current time
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    # takes a token if there is one
+    # params:
+    #   -now: the current time
+    # returns:
+    #   -0 if a token was taken, otherwise the seconds until one is available
+    def take(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter(object):
+
+    # params:
+    #   -limits: map of message type to the (rate, burst) of its buckets,
+    #   types that aren't in it are never limited
+    def __init__(self, limits):
+        self.limits = limits
+        # map of (key, message type) to its TokenBucket
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    # takes a token from the bucket of a message type for a key
+    # params:
+    #   -key: whose bucket, such as a peer's id
+    #   -msg_type: the type of the message
+    #   -now: the current time
+    # returns:
+    #   -0 if the message may be handled, otherwise the seconds until it may
+    def take(self, key, msg_type, now):
+        limit = self.limits.get(msg_type)
+        if limit == None:
+            return 0
+        with self.lock:
+            bucket = self.buckets.get((key, msg_type))
+            if bucket == None:
+                bucket = self.buckets[(key, msg_type)] = TokenBucket(limit[0], limit[1], now)
+            return bucket.take(now)
+
+    # forgets the buckets of a key, such as a peer that has gone
+    def forget(self, key):
+        with self.lock:
+            for bucket_key in [k for k in self.buckets if k[0] == key]:
+                del self.buckets[bucket_key]
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# rwlock
+# a reader/writer lock: any number of threads can hold it for reading at once
+# while a writer has it to itself. waiting writers hold off new readers so a
+# steady stream of readers can't starve them. both sides are reentrant and the
+# thread holding it for writing can also take it for reading
+
+import thread
+import threading
+import time
+
+class RWLock(object):
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        # map of thread id to the number of times it holds the lock for reading
+        self.readers = {}
+        self.writer = None
+        self.writer_count = 0
+        self.writers_waiting = 0
+        # time threads have spent waiting for the lock
+        self.read_wait_seconds = 0.0
+        self.write_wait_seconds = 0.0
+
+    def acquire_read(self):
+        me = thread.get_ident()
+        with self.cond:
+            if self.writer == me or self.readers.has_key(me):
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return
+            start = time.time()
+            while self.writer != None or self.writers_waiting > 0:
+                self.cond.wait()
+            self.read_wait_seconds += time.time() - start
+            self.readers[me] = 1
+
+    def release_read(self):
+        me = thread.get_ident()
+        with self.cond:
+            count = self.readers[me] - 1
+            if count > 0:
+                self.readers[me] = count
+                return
+            del self.readers[me]
+            if len(self.readers) == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        me = thread.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writer_count += 1
+                return
+            if self.readers.has_key(me):
+                raise RuntimeError("a read lock can't be upgraded to a write lock")
+            start = time.time()
+            self.writers_waiting += 1
+            while self.writer != None or len(self.readers) > 0:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.write_wait_seconds += time.time() - start
+            self.writer = me
+            self.writer_count = 1
+
+    def release_write(self):
+        with self.cond:
+            self.writer_count -= 1
+            if self.writer_count == 0:
+                self.writer = None
+                self.cond.notify_all()
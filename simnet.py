@@ -0,0 +1,317 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# simnet
+# an in-memory network for running many nodes in one process on a virtual
+# clock. messages between nodes are delivered by a single scheduler after
+# the latency and bandwidth of the link they cross, may be lost, and are
+# dropped between partitioned nodes. time only moves forward as the scheduler
+# runs events, so minutes of network time can pass in seconds and the same
+# seed always gives the same run. nodes are given a transport from
+# SimNetwork.transport() instead of TCP:
+#
+#   network = SimNetwork(latency = 0.05, seed = 1)
+#   first = BlockchainNode(10000, [], transport = network.transport())
+#   second = BlockchainNode(10000, [first.id], transport = network.transport())
+#   network.run(600)
+#
+# simulated nodes mine by guessing the magic number, proof of work needs
+# real worker processes
+
+import errno
+import heapq
+import itertools
+import logging
+import random
+import socket
+import wirecodec
+
+class SimNetwork(object):
+
+    # the virtual clock starts here so block timestamps look like real ones
+    START_TIME = 1500000000.0
+    # the first port handed out to transports listening on port 0
+    FIRST_PORT = 10000
+
+    # params:
+    #   -latency: seconds a message takes to cross a link once it is sent
+    #   -jitter: up to this many seconds are added to the latency at random
+    #   -bandwidth: bytes per second a link carries, unlimited if None
+    #   -loss: the chance a message is lost
+    #   -seed: seeds every random choice made by the network and its nodes
+    def __init__(self, latency = 0.05, jitter = 0.0, bandwidth = None, loss = 0.0, \
+        seed = 0):
+        self.defaults = { "latency" : latency, "jitter" : jitter, \
+            "bandwidth" : bandwidth, "loss" : loss }
+        # map of (source host, destination host) to the settings that differ
+        # from the defaults for that direction of a link
+        self.links = {}
+        # map of (source host, destination host) to [time the link is free to
+        # send, time the last message on it arrives] so messages keep their order
+        self.link_state = {}
+        self.rand = random.Random(seed)
+        self.now = self.START_TIME
+        # scheduled events as (time, sequence, callback, args)
+        self.events = []
+        self.sequence = itertools.count()
+        # map of (host, port) to the SimTransport listening there
+        self.listeners = {}
+        # map of host to its partition group, None when the network is whole
+        self.groups = None
+        self.hosts = itertools.count(1)
+        self.ports = {}
+        # the transport whose node is handling a message or task right now
+        self.current = None
+        self.events_run = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.messages_delivered = 0
+        self.messages_lost = 0
+        self.messages_partitioned = 0
+
+    # creates a transport for a new node with an address of its own
+    # returns:
+    #   -a SimTransport
+    def transport(self):
+        n = next(self.hosts)
+        return SimTransport(self, "10.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255))
+
+    # schedules a callback on the virtual clock
+    # params:
+    #   -delay: seconds from now to run the callback
+    #   -callback: the function to call
+    #   -args: the arguments to call it with
+    def call_later(self, delay, callback, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), \
+            callback, args))
+
+    # runs scheduled events in time order, moving the clock forward
+    # params:
+    #   -seconds: how far to move the clock, until no events are left if None
+    def run(self, seconds = None):
+        end = None
+        if seconds != None:
+            end = self.now + seconds
+        while len(self.events) > 0 and (end == None or self.events[0][0] <= end):
+            when, _, callback, args = heapq.heappop(self.events)
+            self.now = when
+            self.events_run += 1
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception("exception running simulated event")
+        if end != None:
+            self.now = end
+
+    # changes the settings of the link between two hosts, in both directions
+    # params:
+    #   -a, b: the hosts, or node ids of the form host:port
+    #   -settings: any of latency, jitter, bandwidth and loss
+    def set_link(self, a, b, **settings):
+        a = _host(a)
+        b = _host(b)
+        for key in ((a, b), (b, a)):
+            self.links.setdefault(key, {}).update(settings)
+
+    # splits the network so that only hosts in the same group reach each other,
+    # hosts not in any group reach only each other
+    # params:
+    #   -groups: lists of hosts or node ids
+    def partition(self, *groups):
+        self.groups = {}
+        for i, group in enumerate(groups):
+            for member in group:
+                self.groups[_host(member)] = i + 1
+        logging.info("network partitioned into %d groups", len(groups))
+
+    # joins the network back together
+    def heal(self):
+        self.groups = None
+        logging.info("network partition healed")
+
+    # determines if two hosts can reach each other
+    def reachable(self, a, b):
+        return self.groups == None or self.groups.get(a, 0) == self.groups.get(b, 0)
+
+    # opens a connection, which fails like a refused or timed out TCP connect
+    # if nothing is listening or the listener is on the other side of a
+    # partition
+    # params:
+    #   -source: the SimTransport connecting
+    #   -host, port: the address to connect to
+    # returns:
+    #   -a SimConnection
+    def connect(self, source, host, port):
+        if not self.listeners.has_key((host, port)):
+            raise socket.error(errno.ECONNREFUSED, "connection refused")
+        if not self.reachable(source.host, host):
+            raise socket.timeout("timed out")
+        return SimConnection(self, source, (host, port))
+
+    # sends a framed message across the link between two hosts
+    # params:
+    #   -source: the SimTransport sending
+    #   -address: the (host, port) it is sent to
+    #   -data: the length prefixed message
+    def transmit(self, source, address, data):
+        key = (source.host, address[0])
+        settings = self.links.get(key)
+        if settings == None:
+            settings = self.defaults
+        else:
+            settings = dict(self.defaults, **settings)
+        self.messages_sent += 1
+        self.bytes_sent += len(data)
+        if settings["loss"] > 0 and self.rand.random() < settings["loss"]:
+            self.messages_lost += 1
+            return
+        state = self.link_state.get(key)
+        if state == None:
+            state = self.link_state[key] = [self.now, self.now]
+        # a link carries one message at a time and delivers them in order
+        sent = max(self.now, state[0])
+        if settings["bandwidth"] != None:
+            sent += len(data) / float(settings["bandwidth"])
+        state[0] = sent
+        arrival = sent + settings["latency"]
+        if settings["jitter"] > 0:
+            arrival += self.rand.random() * settings["jitter"]
+        arrival = max(arrival, state[1])
+        state[1] = arrival
+        heapq.heappush(self.events, (arrival, next(self.sequence), self.__deliver, \
+            (source.host, address, data)))
+
+    # hands a message to the node it was sent to if it's still there and
+    # reachable when the message arrives
+    def __deliver(self, source_host, address, data):
+        target = self.listeners.get(address)
+        if target == None:
+            return
+        if not self.reachable(source_host, address[0]):
+            self.messages_partitioned += 1
+            return
+        self.messages_delivered += 1
+        target.receive(data)
+
+    # runs a node's callback, noting which node is running
+    def run_as(self, transport, callback, *args):
+        self.current = transport
+        try:
+            callback(*args)
+        finally:
+            self.current = None
+
+    # picks a free port on a host
+    def free_port(self, host):
+        port = self.ports.get(host, self.FIRST_PORT)
+        while self.listeners.has_key((host, port)):
+            port += 1
+        self.ports[host] = port + 1
+        return port
+
+    # gets the network's counters
+    # returns:
+    #   -a dictionary of statistics
+    def stats(self):
+        return {
+            "time" : self.now - self.START_TIME,
+            "events" : self.events_run,
+            "messages_sent" : self.messages_sent,
+            "bytes_sent" : self.bytes_sent,
+            "messages_delivered" : self.messages_delivered,
+            "messages_lost" : self.messages_lost,
+            "messages_partitioned" : self.messages_partitioned
+        }
+
+def _host(member):
+    return member.rpartition(":")[0] or member
+
+# a connection from a node to another over the simulated network, sends never
+# block and whether a message arrives is decided by the network
+class SimConnection(object):
+
+    def __init__(self, network, source, address):
+        self.network = network
+        self.source = source
+        self.address = address
+        self.closed = False
+
+    def send(self, data):
+        if self.closed:
+            raise socket.error(errno.EBADF, "connection closed")
+        self.network.transmit(self.source, self.address, data)
+
+    # determines if the node at the other end is still listening
+    def alive(self):
+        return not self.closed and self.network.listeners.has_key(self.address)
+
+    def close(self):
+        self.closed = True
+
+# a node's transport on the simulated network, see the transport module for
+# what each method does
+class SimTransport(object):
+
+    threaded = False
+
+    def __init__(self, network, host):
+        self.network = network
+        self.host = host
+        self.port = None
+        self.on_message = None
+        self.stopped = False
+        self.bad_messages = 0
+        self.refused_connections = 0
+
+    def time(self):
+        return self.network.now
+
+    def new_random(self):
+        return random.Random(self.network.rand.random())
+
+    def resolve(self, host, port):
+        return host, port
+
+    def listen(self, port, queue_size = 5):
+        if port == 0:
+            port = self.network.free_port(self.host)
+        if self.network.listeners.has_key((self.host, port)):
+            raise socket.error(errno.EADDRINUSE, "address already in use")
+        self.port = port
+        self.network.listeners[(self.host, port)] = self
+        return self.host, port
+
+    def connect(self, host, port):
+        return self.network.connect(self, host, port)
+
+    # runs a task every interval seconds of virtual time until stopped, the
+    # first run comes at a random point in the first interval so nodes don't
+    # all run their tasks at the same moment
+    def call_every(self, interval, callback):
+        def periodic():
+            if self.stopped:
+                return
+            self.network.run_as(self, callback)
+            self.network.call_later(interval, periodic)
+        self.network.call_later(self.network.rand.random() * interval, periodic)
+
+    def serve(self, on_message):
+        self.on_message = on_message
+
+    def stop(self):
+        self.stopped = True
+        if self.port != None:
+            self.network.listeners.pop((self.host, self.port), None)
+
+    # hands a message that arrived to the node
+    # params:
+    #   -data: the length prefixed message
+    def receive(self, data):
+        if self.on_message == None or self.stopped:
+            return
+        try:
+            self.network.run_as(self, self.on_message, data[wirecodec.LENGTH_STRUCT.size:])
+        except wirecodec.WireFormatError as e:
+            logging.info("dropping bad message to %s: %s", self.host, e)
+            self.bad_messages += 1
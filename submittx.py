@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# submittx
+# submits transactions to a blockchainnode with SUBMIT_TX
+
+# usage: submittx [-h] [-d] --node HOST:PORT [--sender SENDER] [--fee FEE]
+#                 [--count N] PAYLOAD
+
+# positional arguments:
+#   PAYLOAD               the transaction's data, numbered when --count is more than 1
+
+# optional arguments:
+#   -h, --help            parameter help
+#   -d, --debug           flag that sets log level to DEBUG (INFO by default)
+#   --node HOST:PORT      the node to submit the transactions to
+#   --sender SENDER       the id the transactions are from (client by default)
+#   --fee FEE             the fee each transaction pays (0 by default)
+#   --count N             the number of transactions to submit (1 by default)
+
+import argparse
+from blockchainmsg import BlockchainMessage
+from blockchainpeer import BlockchainPeer
+import logging
+import socket
+import sys
+from transaction import Transaction
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="submittx")
+    argparser.add_argument("-d", "--debug", action="store_const", const=logging.DEBUG,
+        dest="log_level", default=logging.INFO)
+    argparser.add_argument("--node", required=True)
+    argparser.add_argument("--sender", default="client")
+    argparser.add_argument("--fee", type=int, default=0)
+    argparser.add_argument("--count", type=int, default=1)
+    argparser.add_argument("payload")
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - " \
+        "%(levelname)s - %(message)s")
+
+    host, _, port = args.node.rpartition(":")
+    if host == "" or not port.isdigit():
+        argparser.error("invalid --node %s, expecting host:port" % args.node)
+    node = BlockchainPeer(host, int(port))
+    # the node answers nothing, so its version can't be learned, but every
+    # node that understands SUBMIT_TX understands the binary wire format
+    node.protocol_version = BlockchainMessage.TX_VERSION
+
+    try:
+        for i in xrange(args.count):
+            payload = args.payload
+            if args.count > 1:
+                payload = "%s %d" % (payload, i)
+            tx = Transaction(args.sender, payload, args.fee)
+            node.send_msg_now(args.sender, BlockchainMessage.SUBMIT_TX, tx)
+            logging.info("submitted transaction %s", tx.txid)
+    except socket.error as e:
+        logging.error("socket error submitting to %s: %s", args.node, e)
+        sys.exit(1)
+    finally:
+        node.close()
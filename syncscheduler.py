@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# syncscheduler
+# decides when a node asks its peers for their tips and which peer it syncs
+# from. the tip each peer last reported, announced or answered a poll with is
+# kept so the node can tell whether it is behind and who is furthest ahead.
+# polling is only a fallback for missed announcements: it happens after a
+# jittered interval that shrinks to the minimum while the node is behind and
+# doubles up to the maximum while it is in sync. the scheduler also times how
+# long the node stays behind its best peer
+
+import threading
+
+class SyncScheduler(object):
+
+    # seconds between polls of the peers' tips, and how far either way an
+    # interval is moved at random so nodes don't poll in step
+    MIN_INTERVAL = 5
+    MAX_INTERVAL = 60
+    JITTER = 0.2
+
+    # params:
+    #   -rand: the random number generator jittering the intervals
+    #   -now: the current time
+    def __init__(self, rand, now):
+        self.rand = rand
+        # map of peer id to (block hash, height, work or None if the peer
+        # didn't say) of the tip it last reported
+        self.peer_tips = {}
+        self.interval = self.MIN_INTERVAL
+        self.next_poll = now + self.__jittered(self.interval)
+        # when the node first fell behind its best peer, None when it isn't
+        self.behind_since = None
+        self.lock = threading.Lock()
+
+    def __jittered(self, interval):
+        return interval * (1 + self.rand.uniform(-self.JITTER, self.JITTER))
+
+    # records the tip a peer reported
+    # params:
+    #   -peerid: the peer's id
+    #   -block_hash: the hash of its latest block
+    #   -height: the height of its latest block
+    #   -work: the cumulative work of its blockchain, None if unknown
+    #   -ours: the node's ChainTip
+    #   -now: the current time
+    # returns:
+    #   -true if the peer is ahead of the node
+    def peer_tip(self, peerid, block_hash, height, work, ours, now):
+        ahead = self.__ahead(height, work, ours)
+        with self.lock:
+            self.peer_tips[peerid] = (block_hash, height, work)
+            if ahead and self.behind_since == None:
+                self.behind_since = now
+        return ahead
+
+    # determines if a reported tip is ahead of the node's, by work when the
+    # peer said how much its blockchain has and by height when it didn't
+    def __ahead(self, height, work, ours):
+        if work != None:
+            return work > ours.work
+        return height > ours.height
+
+    # picks the peer furthest ahead of the node
+    # params:
+    #   -ours: the node's ChainTip
+    # returns:
+    #   -the id of the peer with the most work ahead of the node, None if no
+    #   peer is known to be ahead
+    def best_peer(self, ours):
+        with self.lock:
+            tips = self.peer_tips.items()
+        best = None
+        for peerid, (block_hash, height, work) in tips:
+            if not self.__ahead(height, work, ours) or (ours.block != None and \
+                block_hash == ours.block.hash):
+                continue
+            key = (work != None, work, height)
+            if best == None or key > best[0]:
+                best = (key, peerid)
+        if best == None:
+            return None
+        return best[1]
+
+    # determines how many blocks the node is behind the highest tip reported
+    # params:
+    #   -ours: the node's ChainTip
+    # returns:
+    #   -the number of blocks, 0 if no peer is higher
+    def lag(self, ours):
+        with self.lock:
+            heights = [height for block_hash, height, work in self.peer_tips.values()]
+        return max([0] + [height - ours.height for height in heights])
+
+    # notes that the node's tip has changed
+    # params:
+    #   -ours: the node's new ChainTip
+    #   -now: the current time
+    # returns:
+    #   -the seconds the node was behind for if it has now caught up with
+    #   every peer known to be ahead, None otherwise
+    def tip_changed(self, ours, now):
+        with self.lock:
+            if self.behind_since == None:
+                return None
+            tips = self.peer_tips.values()
+        for block_hash, height, work in tips:
+            if self.__ahead(height, work, ours):
+                return None
+        with self.lock:
+            if self.behind_since == None:
+                return None
+            lag = now - self.behind_since
+            self.behind_since = None
+            return lag
+
+    # determines if the peers should be polled for their tips
+    def poll_due(self, now):
+        return now >= self.next_poll
+
+    # schedules the next poll after polling, sooner if the node is behind
+    # params:
+    #   -behind: true if a peer is known to be ahead of the node
+    #   -now: the current time
+    def polled(self, behind, now):
+        if behind:
+            self.interval = self.MIN_INTERVAL
+        else:
+            self.interval = min(self.MAX_INTERVAL, self.interval * 2)
+        self.next_poll = now + self.__jittered(self.interval)
+
+    # brings the next poll forward to the minimum interval, used when an
+    # announcement shows the node is more than a block behind in case syncing
+    # from the peer that made it fails
+    def hurry(self, now):
+        self.interval = self.MIN_INTERVAL
+        self.next_poll = min(self.next_poll, now + self.__jittered(self.interval))
+
+    # forgets the tip of a peer that has gone
+    def forget(self, peerid):
+        with self.lock:
+            self.peer_tips.pop(peerid, None)
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# transaction
+# class used to represent a transaction carried in a block. a transaction is an
+# application defined payload from a sender along with the fee it offers the
+# miner that includes it
+
+import hashlib
+import time
+
+class Transaction(object):
+
+    # the largest payload a transaction can carry, in bytes
+    MAX_PAYLOAD = 256
+    # the longest sender id
+    MAX_SENDER = 64
+    # the largest fee, so it fits the signed 64 bit field it is encoded in
+    MAX_FEE = 2 ** 63 - 1
+
+    FIELDS = ("sender", "payload", "fee", "timestamp", "txid")
+
+    __slots__ = FIELDS
+
+    # params:
+    #   -sender: the id of whoever created the transaction
+    #   -payload: the transaction's data as a string
+    #   -fee: what the transaction pays the miner, a non negative integer no
+    #   larger than MAX_FEE
+    #   -timestamp: when the transaction was created, now if None
+    def __init__(self, sender, payload, fee = 0, timestamp = None):
+        self.sender = sender
+        self.payload = payload
+        self.fee = fee
+        if timestamp == None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+        self.txid = self.compute_txid()
+
+    # the canonical string a transaction is identified by
+    # returns:
+    #   -the serialized transaction
+    def serialize(self):
+        return "%d:%s%d:%s%d:%r" % (len(self.sender), self.sender, \
+            len(self.payload), self.payload, self.fee, self.timestamp)
+
+    # computes the transaction's id, the SHA-256 hash of its serialized form
+    # returns:
+    #   -the id as a hex string
+    def compute_txid(self):
+        return hashlib.sha256(self.serialize()).hexdigest()
+
+    # the number of bytes the transaction takes up, used to rank transactions
+    # by fee per byte
+    # returns:
+    #   -the size in bytes
+    def size(self):
+        return len(self.sender) + len(self.payload) + 16
+
+    # determines if the transaction is well formed and its id is right
+    # returns:
+    #   -true if the transaction is valid
+    def is_valid(self):
+        return isinstance(self.sender, str) and isinstance(self.payload, str) and \
+            isinstance(self.fee, (int, long)) and 0 <= self.fee <= self.MAX_FEE and \
+            isinstance(self.timestamp, float) and \
+            len(self.sender) <= self.MAX_SENDER and \
+            len(self.payload) <= self.MAX_PAYLOAD and \
+            self.compute_txid() == self.txid
+
+    # recreates a transaction from fields received from a peer without
+    # recomputing its id
+    # params:
+    #   -sender, payload, fee, timestamp, txid: the transaction's fields
+    # returns:
+    #   -the Transaction
+    @classmethod
+    def restore(cls, sender, payload, fee, timestamp, txid):
+        tx = cls.__new__(cls)
+        tx.sender = sender
+        tx.payload = payload
+        tx.fee = fee
+        tx.timestamp = timestamp
+        tx.txid = txid
+        return tx
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def __setstate__(self, state):
+        for name in self.FIELDS:
+            setattr(self, name, state.get(name))
+
+    def __repr__(self):
+        return "{ txid: %s, sender: %s, fee: %d, payload: %d bytes }" % \
+            (self.txid, self.sender, self.fee, len(self.payload))
@@ -0,0 +1,365 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# transport
+# how nodes reach each other. a transport listens for connections and hands
+# the node every whole message it receives, opens connections to peers for
+# sending, runs the node's periodic tasks and tells the time. TcpTransport is
+# the real network, simnet.SimNetwork provides an in-memory one with a virtual
+# clock. the node and its peers only go through these methods:
+#   -threaded: true if the transport runs in real time with threads, serve()
+#   blocking until shutdown, false if every node is run from one scheduler
+#   -time(): the current time
+#   -new_random(): a random number generator for the node
+#   -resolve(host, port): the (host, port) to connect to
+#   -listen(port, queue_size): starts listening, returns the (host, port)
+#   -connect(host, port): opens a connection with send(data), alive() and close()
+#   -call_every(interval, callback): runs a task periodically while serving
+#   -serve(on_message): passes each message payload received to on_message
+#   -stop(): stops serving
+# on_message may raise wirecodec.WireFormatError for a bad message, which
+# drops the connection it came on and is counted in bad_messages. connections
+# turned away because too many are open are counted in refused_connections
+
+from eventloop import EventLoop
+import errno
+import logging
+from random import SystemRandom
+import select
+import socket
+import threading
+import time
+import wirecodec
+
+# cache of (host, port) -> resolved (ip, port) so reconnecting to a peer
+# doesn't cost a dns lookup every time
+_resolved_addrs = {}
+_resolved_addrs_lock = threading.Lock()
+
+# resolves a host and port to an IPv4 address, consulting the cache first
+# params:
+#   -host: the host name or ip of the peer
+#   -port: the port of the peer
+# returns:
+#   -an (ip, port) tuple suitable for socket.connect
+def resolve_addr(host, port):
+    key = (host, port)
+    with _resolved_addrs_lock:
+        if key in _resolved_addrs:
+            return _resolved_addrs[key]
+    addrinfo = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+    addr = addrinfo[0][4]
+    with _resolved_addrs_lock:
+        _resolved_addrs[key] = addr
+    return addr
+
+# a connection to a peer over TCP, only ever written to
+class TcpConnection(object):
+
+    # params:
+    #   -sock: the connected socket
+    def __init__(self, sock):
+        self.sock = sock
+
+    # sends all of data, blocking for up to the socket's timeout
+    def send(self, data):
+        self.sock.sendall(data)
+
+    # determines if the connection is still usable. the peer never writes back
+    # on it so if it is readable the peer has closed it
+    # returns:
+    #   -true if the connection can be used to send, false otherwise
+    def alive(self):
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return len(readable) == 0
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+class TcpTransport(object):
+
+    threaded = True
+    # seconds accept() waits before the periodic tasks are checked
+    LISTEN_TIMEOUT = 5
+    # seconds to wait for a connection to open and for a send to complete
+    CONNECT_TIMEOUT = 5
+    SEND_TIMEOUT = 10
+    # the most connections served at once, more are closed as they are
+    # accepted
+    MAX_CONNECTIONS = 256
+    # seconds to wait on shutdown for connection threads to finish
+    CLOSE_TIMEOUT = 2
+
+    # params:
+    #   -use_event_loop: true to serve every connection from a single threaded
+    #   event loop, false for a thread per connection
+    #   -max_msg_sizes: map of message type to the largest message accepted,
+    #   wirecodec.MAX_MESSAGE_SIZES if None
+    #   -max_connections: the most connections served at once,
+    #   MAX_CONNECTIONS if None
+    def __init__(self, use_event_loop = False, max_msg_sizes = None, \
+        max_connections = None):
+        self.use_event_loop = use_event_loop
+        self.max_msg_sizes = max_msg_sizes
+        if max_connections == None:
+            max_connections = self.MAX_CONNECTIONS
+        self.max_connections = max_connections
+        self.serversock = None
+        self.loop = None
+        # map of connections to the FrameReader assembling their next message
+        # for the event loop
+        self.connreaders = {}
+        # periodic tasks as [interval, next run, callback]
+        self.tasks = []
+        self.stopped = False
+        self.on_message = None
+        # map of each connection served by a thread of its own to the thread
+        self.connthreads = {}
+        self.connthreads_lock = threading.Lock()
+        # connections dropped for a malformed or oversized message and
+        # connections closed because max_connections were open
+        self.bad_messages = 0
+        self.refused_connections = 0
+
+    def time(self):
+        return time.time()
+
+    def new_random(self):
+        return SystemRandom()
+
+    def resolve(self, host, port):
+        return resolve_addr(host, port)
+
+    # initializes the server socket
+    # params:
+    #   -port: the port on which the server socket should listen, 0 for any
+    #   -queue_size: the number of connections that will be queued
+    #   (not socket.accept()'ed) before refusing connections
+    # returns:
+    #   -the (host, port) being listened on
+    def listen(self, port, queue_size = 5):
+        logging.debug("initializing server socket")
+        # IPv4 (AF_INET) TCP (SOCK_STREAM) socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # allow for the socket to be reclaimed before it's TIMEWAIT
+        # period is finished
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", port))
+        sock.settimeout(self.LISTEN_TIMEOUT)
+        addrinfo = socket.getaddrinfo("", port, socket.AF_INET, socket.SOCK_STREAM)
+        sock.listen(queue_size)
+        self.serversock = sock
+        # the port actually bound, which is only known after binding for 0
+        return addrinfo[0][4][0], sock.getsockname()[1]
+
+    # opens a new connection to a peer
+    # returns:
+    #   -the TcpConnection
+    def connect(self, host, port):
+        sock = socket.create_connection((host, port), self.CONNECT_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.SEND_TIMEOUT)
+        return TcpConnection(sock)
+
+    # runs a task every interval seconds while serving, from the accept loop
+    # or the event loop
+    # params:
+    #   -interval: seconds between runs of the task
+    #   -callback: the function to call
+    def call_every(self, interval, callback):
+        self.tasks.append([interval, time.time() + interval, callback])
+
+    # serves connections until stop() is called or ctrl+c is pressed
+    # params:
+    #   -on_message: called with the payload of each message received
+    def serve(self, on_message):
+        self.on_message = on_message
+        if self.use_event_loop:
+            self.__run_event_loop()
+        else:
+            self.__run_accept_loop()
+            self.__close_connections()
+        logging.debug("closing server socket")
+        self.serversock.close()
+
+    def stop(self):
+        self.stopped = True
+        if self.loop != None:
+            self.loop.stop()
+
+    # runs the tasks that are due (accept loop)
+    def __run_due_tasks(self):
+        now = time.time()
+        for task in self.tasks:
+            if task[1] <= now:
+                task[1] = now + task[0]
+                try:
+                    task[2]()
+                except Exception:
+                    logging.exception("exception running periodic task")
+
+    # turns away a connection accepted while max_connections are open
+    # params:
+    #   -clientsock: the connection to close
+    #   -clientaddr: the (host, port) it came from
+    def __refuse_connection(self, clientsock, clientaddr):
+        logging.info("too many connections - refusing %s:%d", clientaddr[0], clientaddr[1])
+        self.refused_connections += 1
+        clientsock.close()
+
+    # accepts connections and handles each one in its own thread, up to
+    # max_connections at once, running the periodic tasks whenever accept()
+    # returns or times out
+    def __run_accept_loop(self):
+        while not self.stopped:
+            try:
+                logging.debug("listening for peer connections")
+                clientsock, clientaddr = self.serversock.accept()
+                with self.connthreads_lock:
+                    full = len(self.connthreads) >= self.max_connections
+                    if not full:
+                        clientsock.settimeout(None)
+                        peerconn_thread = threading.Thread(target = \
+                            self.__handlepeerconnectandrecv, args = [ clientsock ])
+                        # connections are long lived, don't let them hold up
+                        # shutdown
+                        peerconn_thread.daemon = True
+                        self.connthreads[clientsock] = peerconn_thread
+                        peerconn_thread.start()
+                if full:
+                    self.__refuse_connection(clientsock, clientaddr)
+            except socket.timeout:
+                pass
+            except KeyboardInterrupt:
+                logging.debug("ctrl+c pressed")
+                self.stopped = True
+                continue
+            self.__run_due_tasks()
+
+    # handles an incoming connection from another blockchainnode. connections
+    # are long lived so messages are read off of the socket until the peer
+    # closes it
+    # params:
+    #   -clientsock: the client socket extracted from the accepted connection
+    def __handlepeerconnectandrecv(self, clientsock):
+        try:
+            host, port = clientsock.getpeername()
+        except socket.error:
+            # the peer is already gone
+            host, port = "unknown", 0
+        logging.info("handling peer connection from: %s:%d", host, port)
+        reader = wirecodec.FrameReader(self.max_msg_sizes)
+        try:
+            while not self.stopped:
+                payload = reader.read_message(clientsock)
+                if payload == None:
+                    logging.debug("peer %s:%d closed the connection", host, port)
+                    break
+                self.on_message(payload)
+        except EOFError:
+            logging.info("connection from %s:%d closed mid message", host, port)
+        except wirecodec.WireFormatError as e:
+            logging.info("dropping connection from %s:%d, bad message: %s", \
+                host, port, e)
+            self.bad_messages += 1
+        except Exception:
+            logging.error("An exception occured handling connection/receving message")
+            raise
+        finally:
+            logging.debug("cleaning up client socket")
+            with self.connthreads_lock:
+                self.connthreads.pop(clientsock, None)
+            clientsock.close()
+
+    # wakes the connection threads by shutting their connections down and
+    # waits for them to finish, so none is still running when the
+    # interpreter exits (accept loop)
+    def __close_connections(self):
+        with self.connthreads_lock:
+            connthreads = self.connthreads.items()
+        for clientsock, thread in connthreads:
+            try:
+                clientsock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        deadline = time.time() + self.CLOSE_TIMEOUT
+        for clientsock, thread in connthreads:
+            thread.join(max(0, deadline - time.time()))
+
+    # serves every connection from a single threaded event loop where accepting,
+    # reading messages and the periodic tasks are independent tasks rather than
+    # being driven by accept() timing out
+    def __run_event_loop(self):
+        self.loop = EventLoop()
+        self.serversock.setblocking(0)
+        self.loop.add_reader(self.serversock, self.__accept_connections)
+        for interval, _, callback in self.tasks:
+            self.loop.call_every(interval, callback)
+        try:
+            if not self.stopped:
+                self.loop.run()
+        except KeyboardInterrupt:
+            logging.debug("ctrl+c pressed")
+        self.stopped = True
+        for clientsock in self.connreaders.keys():
+            self.__close_connection(clientsock)
+
+    # accepts all pending connections on the server socket (event loop)
+    # params:
+    #   -serversock: the listening socket that became readable
+    def __accept_connections(self, serversock):
+        while True:
+            try:
+                clientsock, clientaddr = serversock.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if len(self.connreaders) >= self.max_connections:
+                self.__refuse_connection(clientsock, clientaddr)
+                continue
+            logging.info("handling peer connection from: %s:%d", clientaddr[0], clientaddr[1])
+            clientsock.setblocking(0)
+            self.connreaders[clientsock] = wirecodec.FrameReader(self.max_msg_sizes)
+            self.loop.add_reader(clientsock, self.__read_connection)
+
+    # reads what is available on a connection and passes the message on once
+    # it has been completely received (event loop)
+    # params:
+    #   -clientsock: the connection that became readable
+    def __read_connection(self, clientsock):
+        try:
+            payload = self.connreaders[clientsock].read_from(clientsock)
+            if payload != None:
+                self.on_message(payload)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            logging.info("error reading from connection: %s", e)
+            self.__close_connection(clientsock)
+        except EOFError:
+            logging.debug("peer closed the connection")
+            self.__close_connection(clientsock)
+        except wirecodec.WireFormatError as e:
+            logging.info("dropping connection, bad message: %s", e)
+            self.bad_messages += 1
+            self.__close_connection(clientsock)
+        except Exception:
+            logging.exception("An exception occured handling connection/receving message")
+            self.__close_connection(clientsock)
+
+    # stops watching and closes a connection (event loop)
+    # params:
+    #   -clientsock: the connection to close
+    def __close_connection(self, clientsock):
+        self.loop.remove_reader(clientsock)
+        if self.connreaders.has_key(clientsock):
+            del self.connreaders[clientsock]
+        clientsock.close()
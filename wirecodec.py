@@ -0,0 +1,479 @@
+#!/usr/bin/python
+# Brian Quinn - CS645 Network Security
+# Project 3
+
+# wirecodec
+# encodes and decodes BlockchainMessages for the wire, either with the compact
+# binary format or with pickle for peers that predate it
+
+from block import Block
+from blockchainmsg import BlockchainMessage
+from transaction import Transaction
+import binascii
+import cPickle
+import cStringIO
+import pickle
+import struct
+
+# first byte of every binary encoded message, never the first byte of a pickle
+WIRE_MAGIC = 0xb7
+# version of the binary layout, bumped whenever the layout changes
+WIRE_VERSION = 1
+
+# pickle is used for peers at protocol version 0
+PICKLE_ENCODING = 0
+
+# value tags
+TAG_NONE = "N"
+TAG_TRUE = "t"
+TAG_FALSE = "f"
+TAG_INT = "i"
+TAG_BIGINT = "I"
+TAG_FLOAT = "d"
+TAG_BYTES = "s"
+TAG_UNICODE = "u"
+TAG_LIST = "L"
+TAG_TUPLE = "T"
+TAG_DICT = "D"
+TAG_BLOCK = "B"
+TAG_TRANSACTION = "X"
+
+# errors besides WireFormatError that decoding a malformed binary message can
+# raise: bad digits or utf-8, an unhashable dict key, nesting past the
+# recursion limit
+DECODE_ERRORS = (struct.error, ValueError, TypeError, RuntimeError)
+# errors unpickling a malformed pickle can raise
+UNPICKLE_ERRORS = (cPickle.UnpicklingError, pickle.UnpicklingError, EOFError, \
+    ValueError, TypeError, KeyError, IndexError, AttributeError, ImportError)
+
+# block flags
+BLOCK_GENESIS_PREV_HASH = 0x01
+BLOCK_HAS_POW = 0x02
+BLOCK_HAS_TXS = 0x04
+
+HEADER_STRUCT = struct.Struct("!BBB")
+LENGTH_STRUCT = struct.Struct("!I")
+SHORT_LENGTH_STRUCT = struct.Struct("!H")
+INT_STRUCT = struct.Struct("!q")
+FLOAT_STRUCT = struct.Struct("!d")
+# index, timestamp, flags, previous hash, hash
+BLOCK_STRUCT = struct.Struct("!QdB32s32s")
+# where the raw hash starts in an encoded block, so it can be read without
+# decoding the block
+BLOCK_HASH_OFFSET = BLOCK_STRUCT.size - 32
+# difficulty, nonce
+POW_STRUCT = struct.Struct("!BQ")
+# fee, timestamp, txid
+TX_STRUCT = struct.Struct("!qd32s")
+
+# largest message accepted for each message type, anything not listed here
+# is held to DEFAULT_MAX_MESSAGE_SIZE
+DEFAULT_MAX_MESSAGE_SIZE = 64 * 1024
+MAX_MESSAGE_SIZES = {
+    BlockchainMessage.FULL_BLOCKCHAIN : 256 * 1024 * 1024,
+    BlockchainMessage.BLOCKS : 16 * 1024 * 1024,
+    # a compressed chunk of blocks, see chainstream.MAX_CHUNK_BYTES
+    BlockchainMessage.CHAIN_CHUNK : 5 * 1024 * 1024,
+    BlockchainMessage.NEW_BLOCK : 1024 * 1024,
+    BlockchainMessage.LATEST_BLOCK : 1024 * 1024,
+    # the block a snapshot ends with, along with its work
+    BlockchainMessage.SNAPSHOT : 1024 * 1024
+}
+
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 63) - 1
+
+# the only globals a pickle received from a peer may reference
+SAFE_PICKLE_GLOBALS = set([
+    ("copy_reg", "_reconstructor"),
+    ("__builtin__", "object"),
+    ("blockchainmsg", "BlockchainMessage"),
+    ("block", "Block"),
+    ("transaction", "Transaction")
+])
+
+class WireFormatError(ValueError):
+    pass
+
+class MessageTooLargeError(WireFormatError):
+    pass
+
+# reads length prefixed messages off of a socket. the header is read first and
+# then a buffer of the declared length is preallocated and filled in place with
+# recv_into, so a message is never copied or concatenated while it arrives
+class FrameReader(object):
+
+    # bytes of a binary message needed to learn its type
+    TYPE_PREFIX_SIZE = HEADER_STRUCT.size
+
+    # params:
+    #   -max_sizes: map of message type to the largest message accepted for
+    #   that type, MAX_MESSAGE_SIZES if None
+    #   -default_max_size: the largest message accepted for a type not in
+    #   max_sizes
+    def __init__(self, max_sizes = None, default_max_size = DEFAULT_MAX_MESSAGE_SIZE):
+        if max_sizes == None:
+            max_sizes = MAX_MESSAGE_SIZES
+        self.max_sizes = max_sizes
+        self.default_max_size = default_max_size
+        # pickles don't say what they contain until they are decoded so they
+        # are held to the largest limit of any type
+        self.pickle_max_size = max([default_max_size] + max_sizes.values())
+        self.header = bytearray(LENGTH_STRUCT.size)
+        self.reset()
+
+    # discards any partially read message and waits for a new header
+    def reset(self):
+        self.length = None
+        self.payload = None
+        self.target = memoryview(self.header)
+        self.filled = 0
+        self.checked_type = False
+
+    # reads whatever is available into the message being assembled, one recv
+    # per call, so it can be driven by an event loop on a non-blocking socket
+    # params:
+    #   -sock: the socket to read from
+    # returns:
+    #   -the payload (a bytearray) once a whole message has been read, None
+    #   if more data is needed
+    # raises:
+    #   -EOFError if the peer closed the connection
+    #   -MessageTooLargeError if the message is larger than allowed
+    def read_from(self, sock):
+        if self.filled < len(self.target):
+            n = sock.recv_into(self.target[self.filled:])
+            if n == 0:
+                raise EOFError("connection closed")
+            self.filled += n
+
+        while self.filled == len(self.target):
+            if self.length == None:
+                self.length = LENGTH_STRUCT.unpack_from(self.header)[0]
+                if self.length > self.pickle_max_size:
+                    raise MessageTooLargeError("message of %d bytes is larger " \
+                        "than any allowed" % self.length)
+                self.payload = bytearray(self.length)
+                self.target = memoryview(self.payload)
+                self.filled = 0
+                # read the type prefix first so the limit is enforced before
+                # the rest of the message is accepted
+                if self.length > self.TYPE_PREFIX_SIZE:
+                    self.target = self.target[:self.TYPE_PREFIX_SIZE]
+            elif not self.checked_type:
+                self.checked_type = True
+                self.__check_size()
+                self.target = memoryview(self.payload)
+            else:
+                payload = self.payload
+                self.reset()
+                return payload
+        return None
+
+    # reads one whole message off of a blocking socket
+    # params:
+    #   -sock: the socket to read from
+    # returns:
+    #   -the payload, or None if the peer closed the connection between messages
+    def read_message(self, sock):
+        while True:
+            try:
+                payload = self.read_from(sock)
+            except EOFError:
+                if self.length == None and self.filled == 0:
+                    return None
+                raise
+            if payload != None:
+                return payload
+
+    def __check_size(self):
+        if self.length == 0 or not is_binary(self.payload):
+            limit = self.pickle_max_size
+            msg_type = "pickle"
+        else:
+            msg_type = self.payload[2]
+            limit = self.max_sizes.get(msg_type, self.default_max_size)
+        if self.length > limit:
+            raise MessageTooLargeError("%s message of %d bytes exceeds the " \
+                "limit of %d" % (BlockchainMessage.TYPE_NAMES.get(msg_type, \
+                msg_type), self.length, limit))
+
+# encodes a message to be sent to a peer
+# params:
+#   -msg: the BlockchainMessage to encode
+#   -encoding: the peer's protocol version, PICKLE_ENCODING for legacy peers
+# returns:
+#   -the encoded message as a string
+def encode_message(msg, encoding = WIRE_VERSION):
+    if encoding == PICKLE_ENCODING:
+        return pickle.dumps(msg)
+    out = [HEADER_STRUCT.pack(WIRE_MAGIC, WIRE_VERSION, msg.msg_type)]
+    _encode_str(out, msg.senderid)
+    _encode_value(out, msg.data)
+    return "".join(out)
+
+# decodes a message received from a peer
+# params:
+#   -payload: the encoded message (string, buffer or bytearray), a bytearray
+#   is decoded in place
+# returns:
+#   -the decoded BlockchainMessage
+# raises:
+#   -WireFormatError if the message is malformed
+def decode_message(payload):
+    if len(payload) == 0:
+        raise WireFormatError("empty message")
+    if not is_binary(payload):
+        try:
+            msg = _safe_unpickle(str(payload))
+        except UNPICKLE_ERRORS as e:
+            raise WireFormatError("malformed pickle: %s" % e)
+        # a pickle can hold any value made of the safe globals
+        if not isinstance(msg, BlockchainMessage) or \
+            not isinstance(getattr(msg, "senderid", None), str) or \
+            not isinstance(getattr(msg, "msg_type", None), int) or \
+            not hasattr(msg, "data"):
+            raise WireFormatError("pickle doesn't hold a message")
+        return msg
+    magic, version, msg_type = _unpack(HEADER_STRUCT, payload, 0)
+    if version != WIRE_VERSION:
+        raise WireFormatError("unsupported wire version: %d" % version)
+    try:
+        senderid, offset = _decode_str(payload, HEADER_STRUCT.size)
+        data, offset = _decode_value(payload, offset)
+    except DECODE_ERRORS as e:
+        raise WireFormatError("malformed message: %s" % e)
+    if offset != len(payload):
+        raise WireFormatError("trailing bytes after message")
+    return BlockchainMessage(senderid, msg_type, data)
+
+# determines if an encoded message uses the binary format
+# params:
+#   -payload: the encoded message
+# returns:
+#   -true if the message is binary encoded, false if it is a pickle
+def is_binary(payload):
+    first = payload[0]
+    if not isinstance(first, int):
+        first = ord(first)
+    return first == WIRE_MAGIC
+
+def _safe_unpickle(data):
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.find_global = _find_safe_global
+    return unpickler.load()
+
+def _find_safe_global(module, name):
+    if (module, name) not in SAFE_PICKLE_GLOBALS:
+        raise WireFormatError("refusing to unpickle %s.%s" % (module, name))
+    return getattr(__import__(module), name)
+
+def _encode_str(out, value):
+    out.append(SHORT_LENGTH_STRUCT.pack(len(value)))
+    out.append(value)
+
+def _decode_str(payload, offset):
+    length = _unpack(SHORT_LENGTH_STRUCT, payload, offset)[0]
+    offset += SHORT_LENGTH_STRUCT.size
+    return _slice(payload, offset, length), offset + length
+
+def _slice(payload, offset, length):
+    if offset + length > len(payload):
+        raise WireFormatError("message truncated")
+    return str(payload[offset:offset + length])
+
+def _unpack(layout, payload, offset):
+    if offset + layout.size > len(payload):
+        raise WireFormatError("message truncated")
+    return layout.unpack_from(payload, offset)
+
+def _encode_value(out, value):
+    if value is None:
+        out.append(TAG_NONE)
+    elif value is True:
+        out.append(TAG_TRUE)
+    elif value is False:
+        out.append(TAG_FALSE)
+    elif isinstance(value, (int, long)):
+        if INT_MIN <= value <= INT_MAX:
+            out.append(TAG_INT)
+            out.append(INT_STRUCT.pack(value))
+        else:
+            digits = str(value)
+            out.append(TAG_BIGINT)
+            _encode_str(out, digits)
+    elif isinstance(value, float):
+        out.append(TAG_FLOAT)
+        out.append(FLOAT_STRUCT.pack(value))
+    elif isinstance(value, str):
+        out.append(TAG_BYTES)
+        out.append(LENGTH_STRUCT.pack(len(value)))
+        out.append(value)
+    elif isinstance(value, unicode):
+        encoded = value.encode("utf-8")
+        out.append(TAG_UNICODE)
+        out.append(LENGTH_STRUCT.pack(len(encoded)))
+        out.append(encoded)
+    elif isinstance(value, Block):
+        out.append(TAG_BLOCK)
+        _encode_block(out, value)
+    elif isinstance(value, Transaction):
+        out.append(TAG_TRANSACTION)
+        _encode_transaction(out, value)
+    elif isinstance(value, (list, tuple)):
+        if isinstance(value, tuple):
+            out.append(TAG_TUPLE)
+        else:
+            out.append(TAG_LIST)
+        out.append(LENGTH_STRUCT.pack(len(value)))
+        for item in value:
+            _encode_value(out, item)
+    elif isinstance(value, dict):
+        out.append(TAG_DICT)
+        out.append(LENGTH_STRUCT.pack(len(value)))
+        for key, item in value.iteritems():
+            _encode_value(out, key)
+            _encode_value(out, item)
+    else:
+        raise WireFormatError("can't encode value of type %s" % type(value))
+
+def _decode_value(payload, offset):
+    tag = _slice(payload, offset, 1)
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    elif tag == TAG_TRUE:
+        return True, offset
+    elif tag == TAG_FALSE:
+        return False, offset
+    elif tag == TAG_INT:
+        return _unpack(INT_STRUCT, payload, offset)[0], offset + INT_STRUCT.size
+    elif tag == TAG_BIGINT:
+        digits, offset = _decode_str(payload, offset)
+        return long(digits), offset
+    elif tag == TAG_FLOAT:
+        return _unpack(FLOAT_STRUCT, payload, offset)[0], offset + FLOAT_STRUCT.size
+    elif tag == TAG_BYTES or tag == TAG_UNICODE:
+        length = _unpack(LENGTH_STRUCT, payload, offset)[0]
+        offset += LENGTH_STRUCT.size
+        value = _slice(payload, offset, length)
+        if tag == TAG_UNICODE:
+            value = value.decode("utf-8")
+        return value, offset + length
+    elif tag == TAG_BLOCK:
+        return _decode_block(payload, offset)
+    elif tag == TAG_TRANSACTION:
+        return _decode_transaction(payload, offset)
+    elif tag == TAG_LIST or tag == TAG_TUPLE:
+        count = _unpack(LENGTH_STRUCT, payload, offset)[0]
+        offset += LENGTH_STRUCT.size
+        items = []
+        for i in xrange(count):
+            item, offset = _decode_value(payload, offset)
+            items.append(item)
+        if tag == TAG_TUPLE:
+            return tuple(items), offset
+        return items, offset
+    elif tag == TAG_DICT:
+        count = _unpack(LENGTH_STRUCT, payload, offset)[0]
+        offset += LENGTH_STRUCT.size
+        items = {}
+        for i in xrange(count):
+            key, offset = _decode_value(payload, offset)
+            items[key], offset = _decode_value(payload, offset)
+        return items, offset
+    raise WireFormatError("unknown value tag: %r" % tag)
+
+def _encode_block(out, block):
+    flags = 0
+    if block.previous_hash == 0:
+        flags |= BLOCK_GENESIS_PREV_HASH
+        prev_hash = "\0" * 32
+    else:
+        prev_hash = binascii.unhexlify(block.previous_hash)
+    if block.difficulty != None:
+        flags |= BLOCK_HAS_POW
+    if block.transactions != None:
+        flags |= BLOCK_HAS_TXS
+    out.append(BLOCK_STRUCT.pack(block.index, block.timestamp, flags, \
+        prev_hash, binascii.unhexlify(block.hash)))
+    if block.difficulty != None:
+        out.append(POW_STRUCT.pack(block.difficulty, block.nonce))
+    _encode_str(out, block.mined_by)
+    _encode_value(out, block.data)
+    if block.transactions != None:
+        out.append(binascii.unhexlify(block.merkle_root))
+        out.append(LENGTH_STRUCT.pack(len(block.transactions)))
+        for tx in block.transactions:
+            _encode_transaction(out, tx)
+
+def _decode_block(payload, offset):
+    index, timestamp, flags, prev_hash, block_hash = \
+        _unpack(BLOCK_STRUCT, payload, offset)
+    offset += BLOCK_STRUCT.size
+    if flags & BLOCK_GENESIS_PREV_HASH:
+        prev_hash = 0
+    else:
+        prev_hash = binascii.hexlify(prev_hash)
+    difficulty = None
+    nonce = None
+    if flags & BLOCK_HAS_POW:
+        difficulty, nonce = _unpack(POW_STRUCT, payload, offset)
+        offset += POW_STRUCT.size
+    miner, offset = _decode_str(payload, offset)
+    data, offset = _decode_value(payload, offset)
+    merkle_root = None
+    transactions = None
+    if flags & BLOCK_HAS_TXS:
+        merkle_root = binascii.hexlify(_slice(payload, offset, 32))
+        offset += 32
+        count = _unpack(LENGTH_STRUCT, payload, offset)[0]
+        offset += LENGTH_STRUCT.size
+        if count > Block.MAX_TRANSACTIONS:
+            raise WireFormatError("block has too many transactions: %d" % count)
+        transactions = []
+        for i in xrange(count):
+            tx, offset = _decode_transaction(payload, offset)
+            transactions.append(tx)
+    block = Block.restore(index, prev_hash, timestamp, data, miner, \
+        binascii.hexlify(block_hash), difficulty, nonce, merkle_root, transactions)
+    return block, offset
+
+def _encode_transaction(out, tx):
+    _encode_str(out, tx.sender)
+    _encode_str(out, tx.payload)
+    try:
+        out.append(TX_STRUCT.pack(tx.fee, tx.timestamp, binascii.unhexlify(tx.txid)))
+    except struct.error as e:
+        raise WireFormatError("can't encode transaction: %s" % e)
+
+def _decode_transaction(payload, offset):
+    sender, offset = _decode_str(payload, offset)
+    tx_payload, offset = _decode_str(payload, offset)
+    fee, timestamp, txid = _unpack(TX_STRUCT, payload, offset)
+    tx = Transaction.restore(sender, tx_payload, fee, timestamp, binascii.hexlify(txid))
+    return tx, offset + TX_STRUCT.size
+
+# encodes a single block in the binary layout, used for storing blocks
+# params:
+#   -block: the block to encode
+# returns:
+#   -the encoded block as a string
+def encode_block(block):
+    out = []
+    _encode_block(out, block)
+    return "".join(out)
+
+# decodes a single block encoded by encode_block
+# params:
+#   -payload: the buffer holding the encoded block
+#   -offset: where in the buffer the block starts
+# returns:
+#   -the decoded Block
+# raises:
+#   -WireFormatError if the block is malformed
+def decode_block(payload, offset = 0):
+    try:
+        return _decode_block(payload, offset)[0]
+    except DECODE_ERRORS as e:
+        raise WireFormatError("malformed block: %s" % e)